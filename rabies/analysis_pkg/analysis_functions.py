@@ -15,9 +15,8 @@ def seed_based_FC(dict_file, seed_dict, seed_name):
     from rabies.utils import run_command, recover_3D
     from rabies.analysis_pkg.analysis_math import vcorrcoef
 
-    import pickle
-    with open(dict_file, 'rb') as handle:
-        data_dict = pickle.load(handle)
+    from rabies.analysis_pkg.data_store import load_data_dict
+    data_dict = load_data_dict(dict_file)
     bold_file = data_dict['bold_file']
     mask_file = data_dict['mask_file']
     timeseries = data_dict['timeseries']
@@ -51,22 +50,57 @@ def seed_based_FC(dict_file, seed_dict, seed_name):
     return corr_map_file,seed_timecourse_csv
 
 
+def multi_seed_FC(dict_file):
+    import os
+    import numpy as np
+    import SimpleITK as sitk
+    import pathlib
+    import pandas as pd
+    from rabies.utils import recover_4D
+    from rabies.analysis_pkg.analysis_math import standardize_timeseries
+
+    from rabies.analysis_pkg.data_store import load_data_dict
+    data_dict = load_data_dict(dict_file)
+    bold_file = data_dict['bold_file']
+    mask_file = data_dict['mask_file']
+    timeseries = data_dict['timeseries']
+    seed_idx = data_dict['seed_idx'] # seed by voxel masks, resampled once in load_maps_dict
+
+    # mean timecourse of every seed, from a single product with the seed averaging weights
+    num_voxels = seed_idx.sum(axis=1)
+    seed_timeseries = timeseries.dot((seed_idx/num_voxels.clip(min=1)[:,np.newaxis]).T)
+
+    # all correlation maps are derived from one product between standardized timeseries
+    # voxels or seeds with constant timecourses obtain a correlation of 0
+    corrs = standardize_timeseries(seed_timeseries).T.dot(standardize_timeseries(timeseries))
+    seed_timeseries[:,num_voxels==0] = np.nan
+
+    filename_split = pathlib.Path(bold_file).name.rsplit(".nii")[0]
+    corr_map_file = os.path.abspath(filename_split+'_multi_seed_corr_map.nii.gz')
+    sitk.WriteImage(recover_4D(mask_file, corrs, bold_file), corr_map_file)
+
+    # the seed timecourses are saved with one column per seed, following the order of --seed_list
+    seed_timecourse_csv = os.path.abspath(filename_split+'_multi_seed_timecourse.csv')
+    pd.DataFrame(seed_timeseries).to_csv(seed_timecourse_csv, header=False, index=False)
+
+    return corr_map_file,seed_timecourse_csv
+
+
 '''
 FC matrix
 '''
 
 
-def run_FC_matrix(dict_file, roi_type='parcellated'):
+def run_FC_matrix(dict_file, roi_type='parcellated', voxelwise_FC=None):
     import os
     import pandas as pd
     import SimpleITK as sitk
     import numpy as np
     import pathlib  # Better path manipulation
-    from rabies.analysis_pkg.analysis_functions import parcellated_FC_matrix, plot_matrix
+    from rabies.analysis_pkg.analysis_functions import parcellated_FC_matrix, voxelwise_FC_matrix, plot_matrix
 
-    import pickle
-    with open(dict_file, 'rb') as handle:
-        data_dict = pickle.load(handle)
+    from rabies.analysis_pkg.data_store import load_data_dict
+    data_dict = load_data_dict(dict_file)
 
 
     bold_file = data_dict['bold_file']
@@ -80,32 +114,100 @@ def run_FC_matrix(dict_file, roi_type='parcellated'):
     if roi_type == 'parcellated':
         corr_matrix,roi_labels = parcellated_FC_matrix(timeseries, atlas_idx, roi_list)
         matrix_df = pd.DataFrame(corr_matrix, index=roi_labels, columns=roi_labels)
+        plot_matrix(figname, corr_matrix)
+
+        data_file = os.path.abspath(filename_split[0]+'_FC_matrix.csv')
+        matrix_df.to_csv(data_file, sep=',')
     elif roi_type == 'voxelwise':
-        corr_matrix = np.corrcoef(timeseries.T)
-        matrix_df = pd.DataFrame(corr_matrix)
+        if voxelwise_FC is None:
+            voxelwise_FC = {'dtype':'float32', 'sparsification':'none', 'threshold':0}
+        # the voxelwise matrix is too large to be held in memory and is written by blocks to disk instead
+        data_file, plot_matrix_array = voxelwise_FC_matrix(timeseries, os.path.abspath(filename_split[0]), 
+            dtype=voxelwise_FC['dtype'], sparsification=voxelwise_FC['sparsification'], threshold=voxelwise_FC['threshold'])
+        plot_matrix(figname, plot_matrix_array)
     else:
         raise ValueError(
             f"Invalid --ROI_type provided: {roi_type}. Must be either 'parcellated' or 'voxelwise.'")
-    plot_matrix(figname, corr_matrix)
-
-    data_file = os.path.abspath(filename_split[0]+'_FC_matrix.csv')
-    matrix_df.to_csv(data_file, sep=',')
     return data_file, figname
 
 
+def voxelwise_FC_matrix(timeseries, out_prefix, dtype='float32', sparsification='none', threshold=0, block_size=1000, plot_size=1000):
+    """
+    Computes the voxelwise correlation matrix by blocks of rows, from timeseries standardized once.
+    If sparsification is 'none', the dense matrix is written to a memory-mapped .npy file of the 
+    specified dtype. Otherwise, the dense matrix is never stored, and a sparse CSR adjacency matrix 
+    (self-connections excluded) is saved as .npz, where edges are selected with:
+        top_k: the threshold value defines the number of strongest edges kept for each voxel
+        absolute: keep the edges with an absolute correlation above the threshold
+        proportional: keep the proportion of strongest edges over the whole matrix defined by the threshold
+    Returns the output file, and a correlation matrix over a subsample of plot_size voxels for plotting.
+    """
+    from scipy import sparse
+    from rabies.analysis_pkg.analysis_math import standardize_timeseries, corrcoef_blocks
+
+    Z = standardize_timeseries(timeseries)
+    num_voxels = Z.shape[1]
+
+    if sparsification=='none':
+        data_file = out_prefix+'_FC_matrix.npy'
+        corr_matrix = np.lib.format.open_memmap(data_file, mode='w+', dtype=dtype, shape=(num_voxels, num_voxels))
+        for start, end, block in corrcoef_blocks(Z, block_size):
+            corr_matrix[start:end] = block
+        corr_matrix.flush()
+        del corr_matrix
+    else:
+        if sparsification=='proportional':
+            if not (0 < threshold <= 1):
+                raise ValueError(f"The proportion of edges kept must be between 0 and 1, {threshold} was provided.")
+            # a first pass derives the distribution of absolute correlations, to find the threshold matching the proportion
+            bins = np.linspace(0, 1, 10001)
+            counts = np.zeros(len(bins)-1)
+            for start, end, block in corrcoef_blocks(Z, block_size):
+                block[np.arange(end-start), np.arange(start, end)] = 0
+                counts += np.histogram(np.abs(block), bins=bins)[0]
+            counts[0] -= num_voxels # remove the diagonal
+            num_edges = int(threshold*num_voxels*(num_voxels-1))
+            cumulative = np.cumsum(counts[::-1])[::-1] # number of edges above each bin
+            abs_threshold = bins[:-1][cumulative >= num_edges].max()
+        elif sparsification=='top_k':
+            k = int(threshold)
+            if not 0 < k < num_voxels:
+                raise ValueError(f"The number of edges per voxel must be between 1 and {num_voxels-1}, {threshold} was provided.")
+        elif sparsification=='absolute':
+            abs_threshold = threshold
+        else:
+            raise ValueError(
+                f"Invalid sparsification {sparsification}. Must be 'none', 'top_k', 'absolute' or 'proportional'.")
+
+        # scipy.sparse does not support float16, so the sparse values are stored at least as float32
+        sparse_dtype = np.promote_types(dtype, np.float32)
+        sparse_blocks = []
+        for start, end, block in corrcoef_blocks(Z, block_size):
+            rows = np.arange(end-start)
+            block[rows, np.arange(start, end)] = 0 # remove self-connections
+            if sparsification=='top_k':
+                cols = np.argpartition(-np.abs(block), k-1, axis=1)[:, :k]
+                rows = np.repeat(rows, k)
+                cols = cols.flatten()
+            else:
+                rows, cols = np.nonzero(np.abs(block) >= abs_threshold)
+            sparse_blocks.append(sparse.csr_matrix((block[rows, cols].astype(sparse_dtype), (rows, cols)), shape=block.shape))
+        data_file = out_prefix+'_FC_matrix_sparse.npz'
+        sparse.save_npz(data_file, sparse.vstack(sparse_blocks, format='csr'))
+
+    # downsampled view of the matrix for plotting
+    plot_idx = np.linspace(0, num_voxels-1, min(num_voxels, plot_size)).astype(int)
+    plot_matrix_array = Z[:, plot_idx].T.dot(Z[:, plot_idx])
+    return data_file, plot_matrix_array
+
+
 def parcellated_FC_matrix(sub_timeseries, atlas_idx, roi_list):
-    
-    timeseries_dict = {}
-    for i in roi_list:
-        roi_mask = np.asarray(atlas_idx == i, dtype=bool)
-        # extract the voxel timeseries within the mask, and take the mean ROI timeseries
-        timeseries_dict[str(i)] = sub_timeseries[:,roi_mask].mean(axis=1)
-
-    roi_labels = list(timeseries_dict.keys())
-    sub_timeseries = []
-    for roi in roi_labels:
-        sub_timeseries.append(timeseries_dict[roi])
-    corr_matrix = np.corrcoef(sub_timeseries)
+    from rabies.analysis_pkg.parcellation import get_parcellation
+    # the mean ROI timeseries are extracted with a single sparse averaging operator over all ROIs
+    roi_timeseries = get_parcellation(atlas_idx, roi_list).transform(sub_timeseries)
+
+    roi_labels = [str(i) for i in roi_list]
+    corr_matrix = np.corrcoef(roi_timeseries.T)
     return corr_matrix,roi_labels
 
 
@@ -125,14 +227,20 @@ ICA
 '''
 
 
-def run_group_ICA(bold_file_list, mask_file, dim, random_seed):
+def run_group_ICA(bold_file_list, mask_file, dim, random_seed, backend='melodic'):
     import os
     import pandas as pd
+    from rabies.utils import flatten_list
+    merged = flatten_list(list(bold_file_list))
+
+    if backend=='native':
+        from rabies.analysis_pkg.analysis_functions import run_group_ICA_native
+        out_dir = os.path.abspath('group_melodic.ica')
+        IC_file = run_group_ICA_native(merged, mask_file, out_dir, dim, random_seed)
+        return out_dir, IC_file
 
     # create a filelist.txt
     file_path = os.path.abspath('filelist.txt')
-    from rabies.utils import flatten_list
-    merged = flatten_list(list(bold_file_list))
     df = pd.DataFrame(data=merged)
     df.to_csv(file_path, header=False, sep=',', index=False)
 
@@ -144,25 +252,65 @@ def run_group_ICA(bold_file_list, mask_file, dim, random_seed):
     return out_dir, IC_file
 
 
-def run_DR_ICA(dict_file,network_weighting):
+def run_group_ICA_native(bold_files, mask_file, out_dir, dim, random_seed, migp_dim=500):
+    '''
+    Group-ICA without FSL. The scans are read one at a time, in a random order, and reduced 
+    incrementally with MIGP; the spatial ICA is then conducted on the reduced matrix. The 
+    Z-statistical maps are written as melodic_IC.nii.gz in out_dir, and can be provided to 
+    --prior_maps.
+    '''
     import os
-    import pandas as pd
-    import pathlib  # Better path manipulation
+    import numpy as np
     import SimpleITK as sitk
-    from rabies.utils import recover_4D
+    from rabies.utils import get_masker
+    from rabies.analysis_pkg.analysis_math import MIGP
+    from rabies.confound_correction_pkg.mod_ICA_AROMA.native_ICA_AROMA import spatial_ICA
+
+    os.makedirs(out_dir, exist_ok=True)
+    masker = get_masker(mask_file)
+    if dim>0:
+        migp_dim = max(migp_dim, 2*dim)
+    migp = MIGP(num_components=migp_dim)
+    rng = np.random.default_rng(random_seed)
+    for bold_file in rng.permutation(bold_files):
+        migp.update(masker.extract(str(bold_file), dtype=np.float32))
+    if migp.reduced.shape[0] > migp.num_components:
+        migp.reduce()
+
+    mix, z_maps = spatial_ICA(migp.reduced, dim=dim, random_seed=random_seed, variance_normalize=False, 
+                              num_observations=migp.num_observations)
+    # as for MELODIC, the sign of each component is set so that its largest tail is positive
+    skew = ((z_maps-z_maps.mean(axis=1, keepdims=True))**3).mean(axis=1)
+    z_maps *= np.where(skew<0, -1, 1)[:,np.newaxis]
+
+    IC_file = f'{out_dir}/melodic_IC.nii.gz'
+    sitk.WriteImage(masker.recover(z_maps, ref_4d=bold_files[0]), IC_file)
+    return IC_file
+
+
+def run_DR_ICA(dict_file,network_weighting):
     from rabies.analysis_pkg.analysis_math import dual_regression
+    from rabies.analysis_pkg.analysis_functions import write_DR_outputs
 
-    import pickle
-    with open(dict_file, 'rb') as handle:
-        data_dict = pickle.load(handle)
+    from rabies.analysis_pkg.data_store import load_data_dict
+    data_dict = load_data_dict(dict_file)
     bold_file = data_dict['bold_file']
     mask_file = data_dict['mask_file']
     timeseries = data_dict['timeseries']
     prior_map_vectors = data_dict['prior_map_vectors']
 
-    filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
-
     DR = dual_regression(prior_map_vectors, timeseries)
+    return write_DR_outputs(DR, bold_file, mask_file, network_weighting)
+
+
+def write_DR_outputs(DR, bold_file, mask_file, network_weighting):
+    import os
+    import pandas as pd
+    import pathlib  # Better path manipulation
+    import SimpleITK as sitk
+    from rabies.utils import recover_4D
+
+    filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
 
     if network_weighting=='absolute':
         DR_C = DR['C']*DR['S']
@@ -180,13 +328,79 @@ def run_DR_ICA(dict_file,network_weighting):
     return DR_maps_filename, dual_regression_timecourse_csv
 
 
+def run_group_DR(dict_file_list, network_weighting, memory_gb=1.0):
+    # computes dual regression for all scans in a single process; scans are streamed from disk
+    # and stacked into batches fitting within memory_gb, and the spatial regression projector
+    # is computed once for the whole dataset since all scans share the commonspace mask and priors
+    import numpy as np
+    from rabies.utils import flatten_list
+    from rabies.analysis_pkg.analysis_math import dual_regression_batch
+    from rabies.analysis_pkg.least_squares import get_solver
+    from rabies.analysis_pkg.analysis_functions import write_DR_outputs
+
+    dict_file_list = flatten_list(list(dict_file_list))
+    memory_budget = memory_gb*1e9
+
+    DR_maps_filename_list = []
+    dual_regression_timecourse_csv_list = []
+    batch_info = []
+    batch = None
+    prior_map_vectors = None
+    projector = None
+
+    def process_batch(batch, batch_info):
+        DR_list = dual_regression_batch(prior_map_vectors, batch[:len(batch_info)], projector=projector)
+        for DR,(bold_file, mask_file) in zip(DR_list, batch_info):
+            DR_maps_filename, dual_regression_timecourse_csv = write_DR_outputs(DR, bold_file, mask_file, network_weighting)
+            DR_maps_filename_list.append(DR_maps_filename)
+            dual_regression_timecourse_csv_list.append(dual_regression_timecourse_csv)
+
+    from rabies.analysis_pkg.data_store import load_data_dict
+    for i,dict_file in enumerate(dict_file_list):
+        data_dict = load_data_dict(dict_file)
+        timeseries = data_dict['timeseries']
+        if projector is None:
+            # the priors are shared by all scans, so the spatial regression projector is computed once
+            prior_map_vectors = np.array(data_dict['prior_map_vectors'])
+            projector = get_solver(prior_map_vectors.T).projector()
+
+        # scans with a different number of timepoints (e.g. after censoring) start a new batch
+        if batch is not None and (len(batch_info)==batch.shape[0] or not batch.shape[1:]==timeseries.shape):
+            process_batch(batch, batch_info)
+            batch = None
+            batch_info = []
+        if batch is None:
+            batch_size = int(max(memory_budget//timeseries.nbytes, 1))
+            batch_size = min(batch_size, len(dict_file_list)-i)
+            batch = np.empty([batch_size]+list(timeseries.shape), dtype=timeseries.dtype)
+        batch[len(batch_info)] = timeseries
+        batch_info.append((data_dict['bold_file'], data_dict['mask_file']))
+        del data_dict, timeseries
+
+    if len(batch_info)>0:
+        process_batch(batch, batch_info)
+
+    return DR_maps_filename_list, dual_regression_timecourse_csv_list
+
+
+def select_DR_outputs(dict_file, DR_maps_filename_list, dual_regression_timecourse_csv_list):
+    # select the outputs from run_group_DR associated with a given scan
+    import pathlib
+    from rabies.utils import flatten_list
+    filename_template = pathlib.Path(dict_file).name.rsplit("_data_dict")[0]
+    for DR_maps_filename, dual_regression_timecourse_csv in zip(flatten_list(list(DR_maps_filename_list)), flatten_list(list(dual_regression_timecourse_csv_list))):
+        if pathlib.Path(DR_maps_filename).name == filename_template+'_DR_maps.nii.gz':
+            return DR_maps_filename, dual_regression_timecourse_csv
+    raise ValueError(f"No dual regression outputs associated with {filename_template} were found.")
+
+
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
-    File, BaseInterface
+    File, Directory, BaseInterface
 )
 
 class NeuralPriorRecoveryInputSpec(BaseInterfaceInputSpec):
-    dict_file = File(exists=True, mandatory=True, desc="Dictionary with prepared analysis data.")
+    dict_file = Directory(exists=True, mandatory=True, desc="Directory storing the prepared analysis data.")
     prior_bold_idx = traits.List(desc="The index for the ICA components that correspond to bold sources.")
     NPR_temporal_comp = traits.Int(
         desc="number of data-driven temporal components to compute.")
@@ -222,9 +436,8 @@ class NeuralPriorRecovery(BaseInterface):
         from rabies.utils import recover_4D
         from rabies.analysis_pkg.analysis_math import spatiotemporal_prior_fit
 
-        import pickle
-        with open(self.inputs.dict_file, 'rb') as handle:
-            data_dict = pickle.load(handle)
+        from rabies.analysis_pkg.data_store import load_data_dict
+        data_dict = load_data_dict(self.inputs.dict_file)
         bold_file = data_dict['bold_file']
         mask_file = data_dict['mask_file']
         timeseries = data_dict['timeseries']
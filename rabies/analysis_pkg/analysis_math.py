@@ -1,33 +1,27 @@
 import numpy as np
+from .least_squares import LeastSquaresSolver, get_solver
+from .correlation import vcorrcoef, elementwise_corrcoef, elementwise_spearman
+
+
+def standardize_timeseries(timeseries, dtype=np.float32):
+    # timeseries of shape num_observations X num_element
+    # returns a centered copy with unit L2-norm columns, so that Z.T.dot(Z) gives Pearson's r
+    Z = np.array(timeseries, dtype=dtype)
+    Z -= Z.mean(axis=0)
+    norm = np.sqrt(np.einsum('ij,ij->j', Z, Z))
+    norm[norm == 0] = np.inf # constant elements are given a correlation of 0
+    Z /= norm
+    return Z
+
+
+def corrcoef_blocks(Z, block_size=1000):
+    # Z is a standardized timeseries from standardize_timeseries
+    # iterates over row blocks of the element by element correlation matrix, without computing the full matrix
+    num_element = Z.shape[1]
+    for start in range(0, num_element, block_size):
+        end = min(start+block_size, num_element)
+        yield start, end, Z[:, start:end].T.dot(Z)
 
-def vcorrcoef(X, y):  # return a correlation between each row of X with y
-    Xm = np.reshape(np.mean(X, axis=1), (X.shape[0], 1))
-    ym = np.mean(y)
-    r_num = np.sum((X-Xm)*(y-ym), axis=1)
-    r_den = np.sqrt(np.sum((X-Xm)**2, axis=1)*np.sum((y-ym)**2))
-    r = r_num/r_den
-    return r
-
-
-def elementwise_corrcoef(X, Y):
-    # X and Y are each of shape num_observations X num_element
-    # computes the correlation between each element of X and Y
-    Xm = X.mean(axis=0)
-    Ym = Y.mean(axis=0)
-    r_num = np.sum((X-Xm)*(Y-Ym), axis=0)
-
-    r_den = np.sqrt(np.sum((X-Xm)**2, axis=0)*np.sum((Y-Ym)**2, axis=0))
-    r = r_num/r_den
-    return r
-
-
-def elementwise_spearman(X,Y):    
-    order = X.argsort(axis=0)
-    X_ranks = order.argsort(axis=0)
-    order = Y.argsort(axis=0)
-    Y_ranks = order.argsort(axis=0)
-    return elementwise_corrcoef(X_ranks, Y_ranks)
-    
 
 def dice_coefficient(mask1,mask2):
     dice = np.sum(mask1*mask2)*2.0 / (np.sum(mask1) + np.sum(mask2))
@@ -40,9 +34,9 @@ LINEAR REGRESSION --- CLOSED-FORM SOLUTION
 
 
 def closed_form(X, Y, intercept=False):  # functions that computes the Least Squares Estimates
-    if intercept:
-        X = np.concatenate((X, np.ones([X.shape[0], 1])), axis=1)
-    return np.linalg.inv(X.transpose().dot(X)).dot(X.transpose()).dot(Y)
+    # solved through a Cholesky factorization of X (or its pseudo-inverse if X is rank-deficient)
+    # rather than an explicit inverse; see LeastSquaresSolver to re-use the factorization across calls
+    return LeastSquaresSolver(X, intercept=intercept).solve(Y)
 
 
 def mse(X, Y, w):  # function that computes the Mean Square Error (MSE)
@@ -61,7 +55,8 @@ def dual_regression(all_IC_vectors, timeseries):
     X = all_IC_vectors.T
     Y = timeseries.T
     # for one given volume, it's values can be expressed through a linear combination of the components
-    W = closed_form(X, Y, intercept=False).T
+    # the factorization of the prior maps is cached, since it is shared across scans
+    W = get_solver(X).solve(Y).T
     W /= np.sqrt((W ** 2).sum(axis=0)) # the temporal domain is variance-normalized so that the weights are contained in the spatial maps
 
     # for a given voxel timeseries, it's signal can be explained a linear combination of the component timecourses
@@ -75,6 +70,79 @@ def dual_regression(all_IC_vectors, timeseries):
     return DR
 
 
+def dual_regression_batch(all_IC_vectors, timeseries_stack, projector=None):
+    ### batched version of dual_regression for a stack of scans sharing the same mask and number of timepoints
+    ### timeseries_stack: scan by time by voxel array
+    ### projector: the spatial regression projector of all_IC_vectors (component by voxel), if already computed
+    ### returns a list with one DR dictionary per scan, identical to the outputs of dual_regression
+    # the spatial regression projector is shared across all scans
+    if projector is None:
+        projector = get_solver(all_IC_vectors.T).projector() # component by voxel
+    W = np.matmul(timeseries_stack, projector.T) # scan by time by component
+    W /= np.sqrt((W ** 2).sum(axis=1, keepdims=True)) # the temporal domain is variance-normalized
+
+    # temporal regression solved on the batched normal equations
+    Wt = W.transpose(0,2,1)
+    try:
+        C = np.linalg.solve(np.matmul(Wt, W), np.matmul(Wt, timeseries_stack)).transpose(0,2,1) # scan by voxel by component
+    except np.linalg.LinAlgError: # a singular set of timecourses is handled scan by scan
+        C = np.array([closed_form(W[i], timeseries_stack[i]).T for i in range(W.shape[0])])
+
+    S = np.sqrt((C ** 2).sum(axis=1)) # scan by component
+    C /= S[:,np.newaxis,:]
+
+    return [{'C':C[i], 'W':W[i], 'S':S[i]} for i in range(W.shape[0])]
+
+
+'''
+INCREMENTAL GROUP PCA
+'''
+
+
+class MIGP():
+    """
+    MELODIC's Incremental Group-PCA (Smith et al. 2014). The timeseries of each scan are appended
+    to a running reduced matrix, which is brought back to its leading num_components eigen-timeseries
+    whenever it exceeds twice that number of rows. The reduced matrix approximates the principal 
+    subspace of the temporal concatenation of all scans, while the memory usage is bounded by 
+    num_components and the length of a single scan rather than the size of the cohort.
+
+    num_components: number of eigen-timeseries kept in the reduced matrix
+    dtype: the dtype in which the reduced matrix is held
+    """
+
+    def __init__(self, num_components=500, dtype=np.float32):
+        self.num_components = int(num_components)
+        self.dtype = dtype
+        self.reduced = None
+        self.num_scans = 0
+        self.num_observations = 0 # the total number of timepoints across scans
+
+    def update(self, timeseries):
+        # timeseries: time by voxel matrix of a scan; it is centered and variance-normalized voxelwise
+        Y = np.array(timeseries, dtype=self.dtype)
+        Y -= Y.mean(axis=0)
+        std = Y.std(axis=0)
+        std[std == 0] = 1
+        Y /= std
+        if self.reduced is None:
+            self.reduced = Y
+        else:
+            self.reduced = np.concatenate((self.reduced, Y), axis=0)
+        self.num_scans += 1
+        self.num_observations += Y.shape[0]
+        if self.reduced.shape[0] > 2*self.num_components:
+            self.reduce()
+
+    def reduce(self):
+        # projects the reduced matrix onto its leading eigen-timeseries, i.e. S.dot(V.T) from its SVD
+        W = self.reduced
+        eigenvalues, eigenvectors = np.linalg.eigh(W.dot(W.T).astype(np.float64))
+        leading = eigenvectors[:, np.argsort(eigenvalues)[::-1][:self.num_components]]
+        self.reduced = leading.T.astype(self.dtype).dot(W)
+        return self.reduced
+
+
 '''
 Convergence through alternating minimization using OLS
 '''
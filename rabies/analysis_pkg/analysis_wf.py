@@ -4,7 +4,7 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 from nipype import Function
 
-from .analysis_functions import run_group_ICA, run_DR_ICA, run_FC_matrix, seed_based_FC
+from .analysis_functions import run_group_ICA, run_DR_ICA, run_FC_matrix, seed_based_FC, multi_seed_FC, run_group_DR, select_DR_outputs
 
 
 def init_analysis_wf(opts, commonspace_cr=False, name="analysis_wf"):
@@ -13,7 +13,7 @@ def init_analysis_wf(opts, commonspace_cr=False, name="analysis_wf"):
     subject_inputnode = pe.Node(niu.IdentityInterface(
         fields=['dict_file', 'token']), name='subject_inputnode')
     group_inputnode = pe.Node(niu.IdentityInterface(
-        fields=['bold_file_list', 'commonspace_mask', 'token']), name='group_inputnode')
+        fields=['bold_file_list', 'dict_file_list', 'commonspace_mask', 'token']), name='group_inputnode')
     outputnode = pe.Node(niu.IdentityInterface(fields=['group_ICA_dir', 'IC_file', 'dual_regression_timecourse_csv',
                                                        'DR_nii_file', 'matrix_data_file', 'matrix_fig', 'corr_map_file', 'seed_timecourse_csv', 'joined_corr_map_file', 
                                                        'sub_token', 'group_token','NPR_prior_timecourse_csv', 'NPR_extra_timecourse_csv',
@@ -33,10 +33,6 @@ def init_analysis_wf(opts, commonspace_cr=False, name="analysis_wf"):
         if not commonspace_cr:
             raise ValueError(
                 'Outputs from confound regression must be in commonspace to run seed-based analysis. Try running confound regression again without --nativespace_analysis.')
-        seed_based_FC_node = pe.Node(Function(input_names=['dict_file', 'seed_dict', 'seed_name'],
-                                              output_names=['corr_map_file', 'seed_timecourse_csv'],
-                                              function=seed_based_FC),
-                                     name='seed_based_FC', mem_gb=1*opts.scale_min_memory)
         seed_dict = {}
         name_list = []
         for file in opts.seed_list:
@@ -47,39 +43,89 @@ def init_analysis_wf(opts, commonspace_cr=False, name="analysis_wf"):
             seed_name = pathlib.Path(file).name.rsplit(".nii")[0]
             name_list.append(seed_name)
             seed_dict[seed_name] = file
-        seed_based_FC_node.iterables = ('seed_name', name_list)
-        seed_based_FC_node.inputs.seed_dict = seed_dict
 
-        # create a joinnode to provide also combined seed maps
-        seed_FC_joinnode = pe.JoinNode(niu.IdentityInterface(fields=['joined_corr_map_file']),
-                                                name='seed_FC_joinnode',
-                                                joinsource='seed_based_FC',
-                                                joinfield=['joined_corr_map_file'])
-
-
-        workflow.connect([
-            (subject_inputnode, seed_based_FC_node, [
-                ("dict_file", "dict_file"),
-                ]),
-            (seed_based_FC_node, outputnode, [
-                ("corr_map_file", "corr_map_file"),
-                ("seed_timecourse_csv", "seed_timecourse_csv"),
-                ]),
-            (seed_based_FC_node, seed_FC_joinnode, [
-                ("corr_map_file", "joined_corr_map_file"),
-                ]),
-            (seed_FC_joinnode, outputnode, [
-                ("joined_corr_map_file", "joined_corr_map_file"),
-                ]),
-            ])
+        if opts.multi_seed_FC:
+            # all seeds are processed in a single node per scan, outputing a 4D map with one volume per seed
+            multi_seed_FC_node = pe.Node(Function(input_names=['dict_file'],
+                                                  output_names=['corr_map_file', 'seed_timecourse_csv'],
+                                                  function=multi_seed_FC),
+                                         name='multi_seed_FC', mem_gb=1*opts.scale_min_memory)
+
+            workflow.connect([
+                (subject_inputnode, multi_seed_FC_node, [
+                    ("dict_file", "dict_file"),
+                    ]),
+                (multi_seed_FC_node, outputnode, [
+                    ("corr_map_file", "corr_map_file"),
+                    ("seed_timecourse_csv", "seed_timecourse_csv"),
+                    ("corr_map_file", "joined_corr_map_file"),
+                    ]),
+                ])
+        else:
+            seed_based_FC_node = pe.Node(Function(input_names=['dict_file', 'seed_dict', 'seed_name'],
+                                                  output_names=['corr_map_file', 'seed_timecourse_csv'],
+                                                  function=seed_based_FC),
+                                         name='seed_based_FC', mem_gb=1*opts.scale_min_memory)
+            seed_based_FC_node.iterables = ('seed_name', name_list)
+            seed_based_FC_node.inputs.seed_dict = seed_dict
+
+            # create a joinnode to provide also combined seed maps
+            seed_FC_joinnode = pe.JoinNode(niu.IdentityInterface(fields=['joined_corr_map_file']),
+                                                    name='seed_FC_joinnode',
+                                                    joinsource='seed_based_FC',
+                                                    joinfield=['joined_corr_map_file'])
+
+
+            workflow.connect([
+                (subject_inputnode, seed_based_FC_node, [
+                    ("dict_file", "dict_file"),
+                    ]),
+                (seed_based_FC_node, outputnode, [
+                    ("corr_map_file", "corr_map_file"),
+                    ("seed_timecourse_csv", "seed_timecourse_csv"),
+                    ]),
+                (seed_based_FC_node, seed_FC_joinnode, [
+                    ("corr_map_file", "joined_corr_map_file"),
+                    ]),
+                (seed_FC_joinnode, outputnode, [
+                    ("joined_corr_map_file", "joined_corr_map_file"),
+                    ]),
+                ])
 
     if opts.DR_ICA or opts.data_diagnosis:
 
-        DR_ICA = pe.Node(Function(input_names=['dict_file', 'network_weighting'],
-                                  output_names=['DR_maps_filename', 'dual_regression_timecourse_csv'],
-                                  function=run_DR_ICA),
-                         name='DR_ICA', mem_gb=1*opts.scale_min_memory)
-        DR_ICA.inputs.network_weighting = opts.network_weighting
+        if opts.group_DR['apply']:
+            if not commonspace_cr:
+                raise ValueError(
+                    'Outputs from confound regression must be in commonspace to run --group_DR. Try running confound regression again without --nativespace_analysis.')
+            # dual regression is computed for all scans at once, and the outputs for each scan are then selected
+            group_DR = pe.Node(Function(input_names=['dict_file_list', 'network_weighting', 'memory_gb'],
+                                    output_names=['DR_maps_filename_list', 'dual_regression_timecourse_csv_list'],
+                                    function=run_group_DR),
+                            name='group_DR', mem_gb=1*opts.scale_min_memory+opts.group_DR['memory_gb'])
+            group_DR.inputs.network_weighting = opts.network_weighting
+            group_DR.inputs.memory_gb = opts.group_DR['memory_gb']
+
+            DR_ICA = pe.Node(Function(input_names=['dict_file', 'DR_maps_filename_list', 'dual_regression_timecourse_csv_list'],
+                                    output_names=['DR_maps_filename', 'dual_regression_timecourse_csv'],
+                                    function=select_DR_outputs),
+                            name='DR_ICA')
+
+            workflow.connect([
+                (group_inputnode, group_DR, [
+                    ("dict_file_list", "dict_file_list"),
+                    ]),
+                (group_DR, DR_ICA, [
+                    ("DR_maps_filename_list", "DR_maps_filename_list"),
+                    ("dual_regression_timecourse_csv_list", "dual_regression_timecourse_csv_list"),
+                    ]),
+                ])
+        else:
+            DR_ICA = pe.Node(Function(input_names=['dict_file', 'network_weighting'],
+                                    output_names=['DR_maps_filename', 'dual_regression_timecourse_csv'],
+                                    function=run_DR_ICA),
+                            name='DR_ICA', mem_gb=1*opts.scale_min_memory)
+            DR_ICA.inputs.network_weighting = opts.network_weighting
 
         workflow.connect([
             (subject_inputnode, DR_ICA, [
@@ -96,12 +142,13 @@ def init_analysis_wf(opts, commonspace_cr=False, name="analysis_wf"):
         if not commonspace_cr:
             raise ValueError(
                 'Outputs from confound regression must be in commonspace to run group-ICA. Try running confound regression again without --nativespace_analysis.')
-        group_ICA = pe.Node(Function(input_names=['bold_file_list', 'mask_file', 'dim', 'random_seed'],
+        group_ICA = pe.Node(Function(input_names=['bold_file_list', 'mask_file', 'dim', 'random_seed', 'backend'],
                                      output_names=['out_dir', 'IC_file'],
                                      function=run_group_ICA),
                             name='group_ICA', mem_gb=1*opts.scale_min_memory)
         group_ICA.inputs.dim = opts.group_ica['dim']
         group_ICA.inputs.random_seed = opts.group_ica['random_seed']
+        group_ICA.inputs.backend = opts.group_ica['backend']
 
         workflow.connect([
             (group_inputnode, group_ICA, [
@@ -138,11 +185,12 @@ def init_analysis_wf(opts, commonspace_cr=False, name="analysis_wf"):
 
 
     if opts.FC_matrix:
-        FC_matrix = pe.Node(Function(input_names=['dict_file', 'roi_type'],
+        FC_matrix = pe.Node(Function(input_names=['dict_file', 'roi_type', 'voxelwise_FC'],
                                      output_names=['data_file', 'figname'],
                                      function=run_FC_matrix),
                             name='FC_matrix', mem_gb=1*opts.scale_min_memory)
         FC_matrix.inputs.roi_type = opts.ROI_type
+        FC_matrix.inputs.voxelwise_FC = opts.voxelwise_FC
 
         workflow.connect([
             (subject_inputnode, FC_matrix, [
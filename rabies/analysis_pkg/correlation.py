@@ -0,0 +1,76 @@
+import numpy as np
+
+'''
+CHUNKED CORRELATION AND RANK KERNELS
+'''
+
+
+def _centered(A, dtype):
+    # returns a centered copy of A along the first axis, and the sum of squares of each column
+    A = np.array(A, dtype=dtype)
+    A -= A.mean(axis=0)
+    return A, np.einsum('ij,ij->j', A, A)
+
+
+def vcorrcoef(X, y, chunk_size=10000, dtype=np.float64):  # return a correlation between each row of X with y
+    # X is processed by chunks of rows, so that only a chunk-sized centered copy is held in memory at once
+    X = np.asarray(X)
+    y, y_ss = _centered(np.asarray(y).reshape(-1, 1), dtype)
+    r = np.empty(X.shape[0], dtype=dtype)
+    for start in range(0, X.shape[0], chunk_size):
+        end = min(start+chunk_size, X.shape[0])
+        Xc, X_ss = _centered(X[start:end].T, dtype)
+        r[start:end] = y[:, 0].dot(Xc)/np.sqrt(X_ss*y_ss)
+    return r
+
+
+def elementwise_corrcoef(X, Y, chunk_size=10000, dtype=np.float64):
+    # X and Y are each of shape num_observations X num_element
+    # computes the correlation between each element of X and Y
+    # if X or Y has a single element (e.g. a scan-level variable), it is correlated with every element of the other
+    X = np.asarray(X)
+    Y = np.asarray(Y)
+    scalar = X.ndim == 1 and Y.ndim == 1
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+    if Y.ndim == 1:
+        Y = Y.reshape(-1, 1)
+    num_element = np.broadcast_shapes(X.shape, Y.shape)[1]
+
+    # a single-element input is only centered once
+    if X.shape[1] == 1:
+        X_fixed = _centered(X, dtype)
+    if Y.shape[1] == 1:
+        Y_fixed = _centered(Y, dtype)
+
+    r = np.empty(num_element, dtype=dtype)
+    for start in range(0, num_element, chunk_size):
+        end = min(start+chunk_size, num_element)
+        Xc, X_ss = X_fixed if X.shape[1] == 1 else _centered(X[:, start:end], dtype)
+        Yc, Y_ss = Y_fixed if Y.shape[1] == 1 else _centered(Y[:, start:end], dtype)
+        if Xc.shape[1] == 1:
+            r_num = Xc[:, 0].dot(Yc)
+        elif Yc.shape[1] == 1:
+            r_num = Yc[:, 0].dot(Xc)
+        else:
+            r_num = np.einsum('ij,ij->j', Xc, Yc)
+        r[start:end] = r_num/np.sqrt(X_ss*Y_ss)
+    if scalar:
+        return r[0]
+    return r
+
+
+def rankdata(X):
+    # ranks along the first axis, where tied values are given their average rank
+    from scipy.stats import rankdata as scipy_rankdata
+    X = np.asarray(X)
+    if X.shape[0] == 0:
+        return X.astype(float)
+    return scipy_rankdata(X, axis=0)
+
+
+def elementwise_spearman(X, Y, chunk_size=10000, dtype=np.float64, Y_ranks=None):
+    # Y_ranks can be provided if Y was already ranked, e.g. when correlating multiple variables with the same maps
+    if Y_ranks is None:
+        Y_ranks = rankdata(Y)
+    return elementwise_corrcoef(rankdata(X), Y_ranks, chunk_size=chunk_size, dtype=dtype)
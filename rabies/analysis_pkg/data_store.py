@@ -0,0 +1,75 @@
+import os
+import json
+import pickle
+import numpy as np
+
+'''
+PER-SCAN ANALYSIS STORE
+'''
+
+
+def save_data_dict(data_dict, store_dir):
+    '''
+    Saves a dictionary of analysis inputs as a directory, where each array is stored as its own
+    .npy file, in its original precision. Other values are stored in a metadata.json file, or are
+    pickled individually if they can't be represented in JSON (e.g. pandas DataFrames).
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    metadata = {'arrays':[], 'pickled':[], 'values':{}}
+    for key, value in data_dict.items():
+        if isinstance(value, np.ndarray) and not value.dtype==object:
+            np.save(f'{store_dir}/{key}.npy', value)
+            metadata['arrays'].append(key)
+            continue
+        try:
+            json.dumps(value)
+            metadata['values'][key] = value
+        except TypeError:
+            with open(f'{store_dir}/{key}.pkl', 'wb') as handle:
+                pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            metadata['pickled'].append(key)
+
+    with open(f'{store_dir}/metadata.json', 'w') as handle:
+        json.dump(metadata, handle, indent=4)
+    return store_dir
+
+
+class DataStore():
+    """
+    Read access to a directory written by save_data_dict, with the same key indexing as the
+    original dictionary. Values are only loaded when accessed, and arrays are memory-mapped,
+    so that a node only reads the data it uses. Arrays are mapped copy-on-write: they can be
+    modified in memory without affecting the files on disk.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(f'{store_dir}/metadata.json', 'r') as handle:
+            self.metadata = json.load(handle)
+        self._loaded = {}
+
+    def keys(self):
+        return self.metadata['arrays']+self.metadata['pickled']+list(self.metadata['values'].keys())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key in self.metadata['values']:
+            return self.metadata['values'][key]
+        if key not in self._loaded:
+            if key in self.metadata['arrays']:
+                try:
+                    self._loaded[key] = np.load(f'{self.store_dir}/{key}.npy', mmap_mode='c')
+                except ValueError: # empty arrays can't be memory-mapped
+                    self._loaded[key] = np.load(f'{self.store_dir}/{key}.npy')
+            elif key in self.metadata['pickled']:
+                with open(f'{self.store_dir}/{key}.pkl', 'rb') as handle:
+                    self._loaded[key] = pickle.load(handle)
+            else:
+                raise KeyError(key)
+        return self._loaded[key]
+
+
+def load_data_dict(store_dir):
+    return DataStore(store_dir)
@@ -4,8 +4,8 @@ import matplotlib.pyplot as plt
 import nilearn
 from rabies.visualization import otsu_scaling, plot_3d
 from rabies.analysis_pkg.analysis_math import elementwise_spearman, elementwise_corrcoef, dice_coefficient
-from rabies.utils import recover_3D
-from rabies.confound_correction_pkg.utils import smooth_image
+from rabies.utils import recover_3D, get_masker
+from rabies.confound_correction_pkg.utils import smooth_array, fwhm_to_sigma
 import tempfile
 
 
@@ -34,7 +34,6 @@ def get_maps(prior, prior_list, corr_variable, mask_file, smoothing=False, non_p
 
     maps = []
     maps.append(prior)
-    volume_indices=sitk.GetArrayFromImage(sitk.ReadImage(mask_file)).astype(bool)    
 
     Y=np.array(prior_list)
     if non_parametric:
@@ -48,10 +47,13 @@ def get_maps(prior, prior_list, corr_variable, mask_file, smoothing=False, non_p
     maps.append(average)
     maps.append(network_var)
         
+    if non_parametric: # the ranks of the maps are computed once and shared across the variables
+        from rabies.analysis_pkg.correlation import rankdata
+        Y_ranks = rankdata(Y)
     for variable in corr_variable:    
         X=np.array(variable)
         if non_parametric:
-            corr_map = elementwise_spearman(X,Y)
+            corr_map = elementwise_spearman(X,Y,Y_ranks=Y_ranks)
         else:
             corr_map = elementwise_corrcoef(X,Y)
         maps.append(corr_map)
@@ -59,8 +61,13 @@ def get_maps(prior, prior_list, corr_variable, mask_file, smoothing=False, non_p
     if smoothing:
         import nibabel as nb
         affine = nb.load(mask_file).affine[:3,:3]
-        for i in range(len(maps)):
-            maps[i] = sitk.GetArrayFromImage(smooth_image(recover_3D(mask_file,maps[i]), affine, 0.3))[volume_indices]
+        # all maps are smoothed at once as a stack of 3D volumes
+        masker = get_masker(mask_file)
+        stack = np.zeros([len(maps), int(np.prod(masker.shape))], dtype=np.float32)
+        stack[:, masker.flat_indices] = np.array(maps)
+        stack = smooth_array(stack.reshape((len(maps),)+masker.shape), fwhm_to_sigma(affine, 0.3)[::-1], 
+                             mask=masker.volume_indices, copy=False)
+        maps = list(masker.extract(stack, dtype=float))
     
     return maps
 
@@ -2,7 +2,7 @@ import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from rabies.utils import copyInfo_3DImage, recover_3D
+from rabies.utils import copyInfo_3DImage, recover_3D, get_masker
 from rabies.analysis_pkg import analysis_functions
 import SimpleITK as sitk
 import nilearn.plotting
@@ -63,11 +63,8 @@ def process_data(data_dict, analysis_dict, prior_bold_idx, prior_confound_idx, N
 
     '''Temporal Features'''
     DR_W = np.array(pd.read_csv(analysis_dict['dual_regression_timecourse_csv'], header=None))
-    DR_array = sitk.GetArrayFromImage(
-        sitk.ReadImage(analysis_dict['dual_regression_nii']))
-    DR_C = np.zeros([DR_array.shape[0], volume_indices.sum()])
-    for i in range(DR_array.shape[0]):
-        DR_C[i, :] = (DR_array[i, :, :, :])[volume_indices]
+    masker = get_masker(data_dict['mask_file'])
+    DR_C = masker.extract(analysis_dict['dual_regression_nii'], dtype=float)
 
     temporal_info['DR_all'] = DR_W
 
@@ -95,12 +92,7 @@ def process_data(data_dict, analysis_dict, prior_bold_idx, prior_confound_idx, N
     prior_fit_out = {'C': [], 'W': []}
     if (NPR_temporal_comp>-1) or (NPR_spatial_comp>-1):
         prior_fit_out['W'] = np.array(pd.read_csv(analysis_dict['NPR_prior_timecourse_csv'], header=None))
-        C_array = sitk.GetArrayFromImage(
-            sitk.ReadImage(analysis_dict['NPR_prior_filename']))
-        C = np.zeros([C_array.shape[0], volume_indices.sum()])
-        for i in range(C_array.shape[0]):
-            C[i, :] = (C_array[i, :, :, :])[volume_indices]
-        prior_fit_out['C'] = C
+        prior_fit_out['C'] = masker.extract(analysis_dict['NPR_prior_filename'], dtype=float)
 
     spatial_info['prior_maps'] = data_dict['prior_map_vectors'][prior_bold_idx]
     spatial_info['DR_BOLD'] = DR_C[prior_bold_idx]
@@ -75,9 +75,8 @@ def init_diagnosis_wf(analysis_opts, commonspace_bold, preprocess_opts, split_na
     if (commonspace_bold or preprocess_opts.bold_only) and not len(split_name_list)<3:
 
         def prep_scan_data(dict_file, analysis_dict, spatial_info):
-            import pickle
-            with open(dict_file, 'rb') as handle:
-                data_dict = pickle.load(handle)
+            from rabies.analysis_pkg.data_store import load_data_dict
+            data_dict = load_data_dict(dict_file)
 
             scan_data={}
 
@@ -97,10 +96,16 @@ def init_diagnosis_wf(analysis_opts, commonspace_bold, preprocess_opts, split_na
             brain_mask = sitk.GetArrayFromImage(mask_img)
             volume_indices = brain_mask.astype(bool)            
 
+            seed_map_files = analysis_dict['seed_map_files']
+            if isinstance(seed_map_files, str): # a single 4D file from --multi_seed_FC
+                seed_map_files = [seed_map_files]
             seed_list=[]
-            for seed_map in analysis_dict['seed_map_files']:
-                seed_list.append(np.asarray(
-                    sitk.GetArrayFromImage(sitk.ReadImage(seed_map)))[volume_indices])
+            for seed_map in seed_map_files:
+                seed_array = np.asarray(sitk.GetArrayFromImage(sitk.ReadImage(seed_map)))
+                if len(seed_array.shape)==4: # one volume per seed
+                    seed_list += [seed_volume[volume_indices] for seed_volume in seed_array]
+                else:
+                    seed_list.append(seed_array[volume_indices])
             scan_data['seed_list'] = seed_list
 
             scan_data['name_source'] = data_dict['name_source']
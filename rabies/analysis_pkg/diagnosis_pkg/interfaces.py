@@ -6,7 +6,7 @@ from rabies.analysis_pkg.diagnosis_pkg import diagnosis_functions
 
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
-    File, BaseInterface
+    File, Directory, BaseInterface
 )
 
 class PrepMasksInputSpec(BaseInterfaceInputSpec):
@@ -74,7 +74,7 @@ class PrepMasks(BaseInterface):
 
 
 class ScanDiagnosisInputSpec(BaseInterfaceInputSpec):
-    dict_file = File(exists=True, mandatory=True, desc="Dictionary with prepared analysis data.")
+    dict_file = Directory(exists=True, mandatory=True, desc="Directory storing the prepared analysis data.")
     analysis_dict = traits.Dict(
         desc="A dictionary regrouping relevant outputs from analysis.")
     prior_bold_idx = traits.List(
@@ -115,9 +115,8 @@ class ScanDiagnosis(BaseInterface):
     output_spec = ScanDiagnosisOutputSpec
 
     def _run_interface(self, runtime):
-        import pickle
-        with open(self.inputs.dict_file, 'rb') as handle:
-            data_dict = pickle.load(handle)
+        from rabies.analysis_pkg.data_store import load_data_dict
+        data_dict = load_data_dict(self.inputs.dict_file)
 
         # convert to an integer list
         prior_bold_idx = [int(i) for i in self.inputs.prior_bold_idx]
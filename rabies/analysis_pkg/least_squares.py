@@ -0,0 +1,150 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from scipy import linalg
+
+'''
+FACTORIZATION-BASED LEAST SQUARES
+'''
+
+
+class LeastSquaresSolver():
+    """
+    Ordinary least-squares solver for a fixed design matrix X, solving Y = X.dot(W).
+    The factorization of X is computed once at initialization, and can then be re-used
+    for any number of right-hand sides Y. The normal equations are solved with a Cholesky
+    factorization of the Gram matrix X.T.dot(X); if X is rank-deficient or too ill-conditioned
+    for the Cholesky route, the solver falls back on the SVD-based pseudo-inverse of X, which
+    provides the minimum-norm solution instead of failing.
+
+    X: observation by regressor matrix
+    intercept: whether to append an intercept column at the end of X
+    cond_tol: the Cholesky route is rejected if the ratio between the smallest and largest
+        diagonal element of the Cholesky factor falls below this value
+    block_size: the number of columns of Y processed at once when computing residuals or
+        predictions; bounds the size of temporary arrays
+    """
+
+    def __init__(self, X, intercept=False, cond_tol=1e-7, block_size=10000):
+        X = np.asarray(X)
+        if X.ndim == 1:
+            X = X.reshape(-1, 1)
+        if intercept:
+            X = np.concatenate((X, np.ones([X.shape[0], 1], dtype=X.dtype)), axis=1)
+        self.X = X
+        self.block_size = block_size
+        self.rank_deficient = False
+        self._cho = None
+        self._pinv = None
+
+        if X.shape[1] == 0:  # an empty design explains nothing
+            return
+
+        try:
+            cho = linalg.cho_factor(X.T.dot(X), lower=False, check_finite=False)
+            diag = np.abs(np.diag(cho[0]))
+            if not np.isfinite(diag).all() or diag.min() <= diag.max()*cond_tol:
+                raise linalg.LinAlgError
+            self._cho = cho
+        except linalg.LinAlgError:
+            self.rank_deficient = True
+            self._pinv = np.linalg.pinv(X)
+
+    @property
+    def num_regressors(self):
+        return self.X.shape[1]
+
+    def solve(self, Y):
+        # returns the regressor by feature matrix of coefficients W
+        Y = np.asarray(Y)
+        vector = Y.ndim == 1
+        if vector:
+            Y = Y.reshape(-1, 1)
+        if not Y.shape[0] == self.X.shape[0]:
+            raise ValueError(
+                f"The number of observations in Y ({Y.shape[0]}) does not match the design matrix ({self.X.shape[0]}).")
+
+        if self.num_regressors == 0:
+            W = np.zeros([0, Y.shape[1]])
+        elif self._cho is not None:
+            W = linalg.cho_solve(self._cho, self.X.T.dot(Y), check_finite=False)
+        else:
+            W = self._pinv.dot(Y)
+        if vector:
+            W = W[:, 0]
+        return W
+
+    def projector(self):
+        # returns the regressor by observation matrix P such that W = P.dot(Y)
+        if self.num_regressors == 0:
+            return np.zeros([0, self.X.shape[0]])
+        elif self._cho is not None:
+            return linalg.cho_solve(self._cho, self.X.T, check_finite=False)
+        else:
+            return self._pinv
+
+    def predict(self, Y):
+        # returns the fitted values X.dot(W)
+        return self.X.dot(self.solve(Y))
+
+    def residuals(self, Y, keep_intercept=False, out=None, W=None):
+        '''
+        Returns Y-X.dot(W), computed over blocks of columns of Y so that the fitted values
+        are never materialized for the whole array. If keep_intercept is True, the fitted
+        contribution of the last regressor (the intercept) is added back. Providing out=Y
+        computes the residuals in place. If the coefficients W were already obtained from
+        solve(Y), they can be provided to avoid solving again.
+        '''
+        Y = np.asarray(Y)
+        vector = Y.ndim == 1
+        if vector:
+            Y = Y.reshape(-1, 1)
+        if out is None:
+            out = np.empty(Y.shape, dtype=np.result_type(Y.dtype, self.X.dtype))
+        elif vector:
+            out = out.reshape(-1, 1)
+
+        num_features = Y.shape[1]
+        block_size = num_features if self.block_size is None else max(int(self.block_size), 1)
+        if keep_intercept:
+            X = self.X[:, :-1]
+        else:
+            X = self.X
+        for start in range(0, num_features, block_size):
+            end = min(start+block_size, num_features)
+            if W is None:
+                W_block = self.solve(Y[:, start:end])
+            else:
+                W_block = np.asarray(W).reshape(self.num_regressors, -1)[:, start:end]
+            if keep_intercept:
+                W_block = W_block[:-1, :]
+            out[:, start:end] = Y[:, start:end] - X.dot(W_block)
+        if vector:
+            out = out[:, 0]
+        return out
+
+
+_solver_cache = OrderedDict()
+_solver_cache_size = 16
+
+
+def get_solver(X, intercept=False):
+    '''
+    Returns a LeastSquaresSolver for X, re-using the factorization if the same design
+    matrix was already factorized within this process. This is meant for designs that
+    are re-used across calls (e.g. detrending regressors, confound designs, prior maps).
+    '''
+    X = np.ascontiguousarray(X)
+    key = (X.shape, X.dtype.str, bool(intercept), hashlib.sha1(X.tobytes()).hexdigest())
+    if key in _solver_cache:
+        _solver_cache.move_to_end(key)
+        return _solver_cache[key]
+    solver = LeastSquaresSolver(X, intercept=intercept)
+    _solver_cache[key] = solver
+    if len(_solver_cache) > _solver_cache_size:
+        _solver_cache.popitem(last=False)
+    return solver
+
+
+def clear_solver_cache():
+    _solver_cache.clear()
@@ -62,7 +62,7 @@ def init_main_analysis_wf(preprocess_opts, cr_opts, analysis_opts):
                                          container="data_diagnosis_datasink"),
                                 name="data_diagnosis_datasink")
 
-    load_maps_dict_node = pe.Node(Function(input_names=['mask_file', 'WM_mask_file', 'CSF_mask_file', 'atlas_file', 'atlas_ref', 'preprocess_anat_template', 'prior_maps', 'transform_list','inverse_list'],
+    load_maps_dict_node = pe.Node(Function(input_names=['mask_file', 'WM_mask_file', 'CSF_mask_file', 'atlas_file', 'atlas_ref', 'preprocess_anat_template', 'prior_maps', 'transform_list','inverse_list', 'seed_list'],
                                            output_names=[
                                                'maps_dict'],
                                        function=load_maps_dict),
@@ -72,6 +72,11 @@ def init_main_analysis_wf(preprocess_opts, cr_opts, analysis_opts):
         raise ValueError("--prior_maps doesn't exists.")
     else:
         load_maps_dict_node.inputs.prior_maps = os.path.abspath(analysis_opts.prior_maps)
+    if analysis_opts.multi_seed_FC:
+        # seeds are resampled once for the reference space, and shared across scans
+        load_maps_dict_node.inputs.seed_list = [os.path.abspath(file) for file in analysis_opts.seed_list]
+    else:
+        load_maps_dict_node.inputs.seed_list = []
 
 
     if commonspace_bold or preprocess_opts.bold_only:
@@ -120,10 +125,10 @@ def init_main_analysis_wf(preprocess_opts, cr_opts, analysis_opts):
         ])
 
 
-    analysis_split_joinnode = pe.JoinNode(niu.IdentityInterface(fields=['file_list', 'mask_file']),
+    analysis_split_joinnode = pe.JoinNode(niu.IdentityInterface(fields=['file_list', 'dict_file_list', 'mask_file']),
                                          name='analysis_split_joinnode',
                                          joinsource='main_split',
-                                         joinfield=['file_list'])
+                                         joinfield=['file_list', 'dict_file_list'])
 
     if commonspace_bold or preprocess_opts.bold_only:
         workflow.connect([
@@ -145,8 +150,12 @@ def init_main_analysis_wf(preprocess_opts, cr_opts, analysis_opts):
         (load_sub_dict_node, analysis_wf, [
             ("dict_file", "subject_inputnode.dict_file"),
             ]),
+        (load_sub_dict_node, analysis_split_joinnode, [
+            ("dict_file", "dict_file_list"),
+            ]),
         (analysis_split_joinnode, analysis_wf, [
             ("file_list", "group_inputnode.bold_file_list"),
+            ("dict_file_list", "group_inputnode.dict_file_list"),
             ("mask_file", "group_inputnode.commonspace_mask"),
             ]),
         (analysis_wf, analysis_datasink, [
@@ -230,13 +239,14 @@ def init_main_analysis_wf(preprocess_opts, cr_opts, analysis_opts):
 
 
 # this function handles masks/maps that can be either common across subjects in commonspace, or resampled into individual spaces
-def load_maps_dict(mask_file, WM_mask_file, CSF_mask_file, atlas_file, atlas_ref, preprocess_anat_template, prior_maps, transform_list, inverse_list):
+def load_maps_dict(mask_file, WM_mask_file, CSF_mask_file, atlas_file, atlas_ref, preprocess_anat_template, prior_maps, transform_list, inverse_list, seed_list=[]):
     import numpy as np
     import SimpleITK as sitk
     import os
     import pathlib  # Better path manipulation
     from rabies.utils import resample_image_spacing
-    from rabies.analysis_pkg.utils import resample_prior_maps, compute_edge_mask
+    from rabies.analysis_pkg.utils import resample_prior_maps, compute_edge_mask, resample_seed_masks
+    from rabies.analysis_pkg.parcellation import find_atlas_labels
     mask_img = sitk.ReadImage(mask_file)
     mask_array = sitk.GetArrayFromImage(mask_img)
     volume_indices = mask_array.astype(bool)
@@ -261,42 +271,36 @@ def load_maps_dict(mask_file, WM_mask_file, CSF_mask_file, atlas_file, atlas_ref
     # prepare the list ROI numbers from the atlas for FC matrices
     # get the complete set of original ROI integers 
     atlas_data = sitk.GetArrayFromImage(sitk.ReadImage(atlas_ref)).astype(int)
-    roi_list = []
-    for i in range(1, atlas_data.max()+1):
-        if np.max(i == atlas_data):  # include integers that do have labelled voxels
-            roi_list.append(i)
+    roi_list = find_atlas_labels(atlas_data) # include integers that do have labelled voxels
+
+    # seed masks for --multi_seed_FC, in the order of --seed_list
+    seed_names = [pathlib.Path(file).name.rsplit(".nii")[0] for file in seed_list]
+    seed_idx = resample_seed_masks(seed_list, mask_file)
 
     return {'mask_file':mask_file, 'volume_indices':volume_indices, 'WM_idx':WM_idx, 'CSF_idx':CSF_idx, 
-            'atlas_idx':atlas_idx, 'edge_idx':edge_idx, 'template_file':template_file, 'prior_map_vectors':prior_map_vectors, 'roi_list':roi_list}
+            'atlas_idx':atlas_idx, 'edge_idx':edge_idx, 'template_file':template_file, 'prior_map_vectors':prior_map_vectors, 'roi_list':roi_list,
+            'seed_names':seed_names, 'seed_idx':seed_idx}
 
 
 # this function loads subject-specific data
 def load_sub_input_dict(maps_dict, bold_file, CR_data_dict, VE_file, STD_file, CR_STD_file, random_CR_STD_file, corrected_CR_STD_file, name_source):
-    import pickle
     import pathlib
     import os
     import numpy as np
     import SimpleITK as sitk
+    from rabies.analysis_pkg.data_store import save_data_dict
+    from rabies.utils import get_masker
+
+    masker = get_masker(maps_dict['mask_file'])
+
+    # the timeseries are kept in the native precision of the scan
+    timeseries = masker.extract(bold_file)
 
-    volume_indices = maps_dict['volume_indices']
-
-    data_img = sitk.ReadImage(bold_file)
-    data_array = sitk.GetArrayFromImage(data_img)
-    num_volumes = data_array.shape[0]
-    timeseries = np.zeros([num_volumes, volume_indices.sum()])
-    for i in range(num_volumes):
-        timeseries[i, :] = (data_array[i, :, :, :])[volume_indices]
-
-    VE_spatial = sitk.GetArrayFromImage(
-        sitk.ReadImage(VE_file))[volume_indices]
-    temporal_std = sitk.GetArrayFromImage(
-        sitk.ReadImage(STD_file))[volume_indices]
-    predicted_std = sitk.GetArrayFromImage(
-        sitk.ReadImage(CR_STD_file))[volume_indices]
-    random_CR_std = sitk.GetArrayFromImage(
-        sitk.ReadImage(random_CR_STD_file))[volume_indices]
-    corrected_CR_std = sitk.GetArrayFromImage(
-        sitk.ReadImage(corrected_CR_STD_file))[volume_indices]
+    VE_spatial = masker.extract(VE_file)
+    temporal_std = masker.extract(STD_file)
+    predicted_std = masker.extract(CR_STD_file)
+    random_CR_std = masker.extract(random_CR_STD_file)
+    corrected_CR_std = masker.extract(corrected_CR_STD_file)
 
     sub_dict = {'bold_file':bold_file, 'name_source':name_source, 'CR_data_dict':CR_data_dict, 
             'timeseries':timeseries, 'VE_spatial':VE_spatial, 'temporal_std':temporal_std,
@@ -308,9 +312,8 @@ def load_sub_input_dict(maps_dict, bold_file, CR_data_dict, VE_file, STD_file, C
         sub_dict[k] = maps_dict[k]
 
     filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
-    dict_file = os.path.abspath(f'{filename_split[0]}_data_dict.pkl')
-    with open(dict_file, 'wb') as handle:
-        pickle.dump(sub_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # each array is saved as a separate .npy file, which can be memory-mapped by the analysis nodes
+    dict_file = save_data_dict(sub_dict, os.path.abspath(f'{filename_split[0]}_data_dict'))
 
     return dict_file
 
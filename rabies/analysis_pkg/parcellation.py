@@ -0,0 +1,83 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from scipy import sparse
+
+'''
+LABEL-INDEXED PARCELLATION
+'''
+
+
+def find_atlas_labels(atlas_data):
+    # returns the sorted list of positive integer labels that have labelled voxels, in a single pass over the atlas
+    atlas_data = np.asarray(atlas_data).astype(int).flatten()
+    counts = np.bincount(atlas_data[atlas_data > 0])
+    return [int(i) for i in np.nonzero(counts)[0]]
+
+
+class Parcellation():
+    """
+    Averages voxel timeseries within the parcels of an atlas. A sparse parcel by voxel 
+    averaging operator is built once from the atlas labels, so that the parcel timeseries 
+    of a scan (or of a stack of scans) are derived with a single sparse matrix product, 
+    instead of one pass over the data for each label.
+
+    atlas_idx: vector of atlas labels for each voxel
+    roi_list: the labels defining each parcel; parcels without any voxel in atlas_idx 
+        return NaN timeseries. If None, the labels found in atlas_idx are used.
+    """
+
+    def __init__(self, atlas_idx, roi_list=None):
+        atlas_idx = np.asarray(atlas_idx).astype(int).flatten()
+        if roi_list is None:
+            roi_list = find_atlas_labels(atlas_idx)
+        self.roi_list = list(roi_list)
+        labels = np.asarray(self.roi_list, dtype=int)
+        num_rois = len(labels)
+
+        # find the parcel index associated to each voxel
+        sorter = np.argsort(labels)
+        pos = np.searchsorted(labels[sorter], atlas_idx).clip(max=max(num_rois-1, 0))
+        if num_rois > 0:
+            voxel_idx = np.nonzero(labels[sorter][pos] == atlas_idx)[0]
+        else:
+            voxel_idx = np.zeros(0, dtype=int)
+        roi_idx = sorter[pos[voxel_idx]]
+
+        self.counts = np.bincount(roi_idx, minlength=num_rois)
+        weights = 1/self.counts[roi_idx]
+        self.operator = sparse.csr_matrix((weights, (roi_idx, voxel_idx)), shape=(num_rois, len(atlas_idx)))
+        self.empty = self.counts == 0
+
+    @property
+    def num_rois(self):
+        return len(self.roi_list)
+
+    def transform(self, timeseries):
+        # timeseries: time by voxel array, or scan by time by voxel stack
+        # returns the parcel timeseries of shape time by parcel (or scan by time by parcel)
+        timeseries = np.asarray(timeseries)
+        shape = timeseries.shape
+        Y = timeseries.reshape(-1, shape[-1])
+        roi_timeseries = np.asarray(self.operator.dot(Y.T).T)
+        roi_timeseries[:, self.empty] = np.nan
+        return roi_timeseries.reshape(shape[:-1]+(self.num_rois,))
+
+
+_parcellation_cache = OrderedDict()
+_parcellation_cache_size = 8
+
+
+def get_parcellation(atlas_idx, roi_list=None):
+    # returns a cached Parcellation, so that the operator is built once per atlas and mask
+    atlas_idx = np.ascontiguousarray(atlas_idx)
+    key = (atlas_idx.shape, atlas_idx.dtype.str, None if roi_list is None else tuple(roi_list), 
+           hashlib.sha1(atlas_idx.tobytes()).hexdigest())
+    if key in _parcellation_cache:
+        _parcellation_cache.move_to_end(key)
+        return _parcellation_cache[key]
+    parcellation = Parcellation(atlas_idx, roi_list=roi_list)
+    _parcellation_cache[key] = parcellation
+    if len(_parcellation_cache) > _parcellation_cache_size:
+        _parcellation_cache.popitem(last=False)
+    return parcellation
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import numpy as np
 import SimpleITK as sitk
 
@@ -35,23 +36,41 @@ def resample_prior_maps(in_file, ref_file, transforms = [], inverses = []):
     return combined
 
 
+_seed_cache = OrderedDict()
+_seed_cache_size = 64
+
+
+def resample_seed_masks(seed_files, mask_file):
+    # resamples a list of seed masks onto the reference mask, and returns a seed by voxel boolean array
+    # of the voxels within the mask. Resampled seeds are cached in the process, keyed on the seed file and
+    # the mask content, so that each seed is resampled only once for a given reference space.
+    import os
+    import hashlib
+    import pathlib
+    from rabies.utils import exec_applyTransforms
+
+    mask_array = sitk.GetArrayFromImage(sitk.ReadImage(mask_file))
+    volume_indices = mask_array.astype(bool)
+    mask_hash = hashlib.sha1(np.ascontiguousarray(mask_array).tobytes()).hexdigest()
+
+    seed_idx = np.zeros([len(seed_files), volume_indices.sum()], dtype=bool)
+    for i, seed_file in enumerate(seed_files):
+        seed_file = os.path.abspath(seed_file)
+        key = (seed_file, os.path.getmtime(seed_file), mask_hash)
+        if key in _seed_cache:
+            _seed_cache.move_to_end(key)
+        else:
+            seed_name = pathlib.Path(seed_file).name.rsplit(".nii")[0]
+            resampled = os.path.abspath(f'{seed_name}_resampled.nii.gz')
+            exec_applyTransforms(transforms=[], inverses=[], input_image=seed_file, ref_image=mask_file, output_image=resampled, mask=True)
+            _seed_cache[key] = sitk.GetArrayFromImage(sitk.ReadImage(resampled))[volume_indices].astype(bool)
+            if len(_seed_cache) > _seed_cache_size:
+                _seed_cache.popitem(last=False)
+        seed_idx[i] = _seed_cache[key]
+    return seed_idx
+
+
 def compute_edge_mask(mask_array, num_edge_voxels=1):
-    import numpy as np
-    #custom function for computing edge mask from an input brain mask
-    shape = mask_array.shape
-
-    #iterate through all voxels from the three dimensions and look if it contains surrounding voxels
-    edge_mask = np.zeros(shape, dtype=bool)
-    num_voxel = 0
-    while num_voxel < num_edge_voxels:
-        for x in range(shape[0]):
-            for y in range(shape[1]):
-                for z in range(shape[2]):
-                    #only look if the voxel is part of the mask
-                    if mask_array[x, y, z]:
-                        if (mask_array[x-1:x+2, y-1:y+2, z-1:z+2] == 0).sum() > 0:
-                            edge_mask[x, y, z] = 1
-        mask_array = mask_array-edge_mask
-        num_voxel += 1
-
-    return edge_mask
\ No newline at end of file
+    #computes an edge mask from an input brain mask, including voxels within num_edge_voxels of the outside of the mask
+    from rabies.morphology import edge_mask
+    return edge_mask(mask_array, num_edge_voxels=num_edge_voxels)
\ No newline at end of file
@@ -208,7 +208,14 @@ This was conducted by iteratively removing frames which present outlier DVARS va
         i+=1
         methods+=f"Then, motion sources were then automatically removed using a modified version of the ICA-AROMA classifier[{references[aroma]}], \
 where classifier parameters and anatomical masks are instead adapted for rodent images. "
-        if not opts.ica_aroma['dim']==0:
+        if opts.ica_aroma['backend']=='native':
+            if opts.ica_aroma['dim']==0:
+                dim_desc = "a number of components estimated from the PCA eigenspectrum"
+            else:
+                dim_desc = f"{opts.ica_aroma['dim']} components"
+            methods+=f"Specifically {dim_desc} were derived for each image independently using FastICA, following the \
+steps of the MELODIC-ICA algorithm, before classification. "
+        elif not opts.ica_aroma['dim']==0:
             references[melodic]=i
             i+=1
             methods+=f"Specifically {opts.ica_aroma['dim']} components were derived for each image independently using MELODIC-ICA algorithm[{melodic}] \
@@ -58,6 +58,7 @@ def init_confound_correction_wf(cr_opts, name="confound_correction_wf"):
             CR_data_dict: dictionary object storing extra data computed during confound correction
             background_mask_fig: a figure showing the automatically-generated mask of the image background 
                 for --image_scaling background_noise.
+            strategy_outputs: dictionary with the outputs from each of the --strategies
     """
 
     workflow = pe.Workflow(name=name)
@@ -65,9 +66,14 @@ def init_confound_correction_wf(cr_opts, name="confound_correction_wf"):
                         'bold_file', 'brain_mask', 'csf_mask', 'confounds_file', 'FD_file', 'raw_input_file']), name='inputnode')
     outputnode = pe.Node(niu.IdentityInterface(fields=[
                          'cleaned_path', 'aroma_out', 'VE_file', 'STD_file', 'CR_STD_file', 
-                         'random_CR_STD_file_path', 'corrected_CR_STD_file_path', 'frame_mask_file', 'CR_data_dict', 'background_mask_fig']), name='outputnode')
-    regress_node = pe.Node(Regress(cr_opts=cr_opts),
-                           name='regress', mem_gb=1*cr_opts.scale_min_memory)
+                         'random_CR_STD_file_path', 'corrected_CR_STD_file_path', 'frame_mask_file', 'CR_data_dict', 'background_mask_fig', 
+                         'strategy_outputs']), name='outputnode')
+    if cr_opts.smoothing_filter is None:
+        regress_n_procs = 1
+    else:
+        regress_n_procs = int(cr_opts.local_threads/4)+1
+    regress_node = pe.Node(Regress(cr_opts=cr_opts, n_procs=regress_n_procs),
+                           name='regress', mem_gb=1*cr_opts.scale_min_memory, n_procs=regress_n_procs)
 
     prep_CR_node = pe.Node(Function(input_names=['bold_file', 'confounds_file', 'FD_file', 'cr_opts'],
                                               output_names=['data_dict'],
@@ -101,6 +107,7 @@ def init_confound_correction_wf(cr_opts, name="confound_correction_wf"):
             ("data_dict", "CR_data_dict"),
             ("aroma_out", "aroma_out"),
             ("background_mask_fig", "background_mask_fig"),
+            ("strategy_outputs", "strategy_outputs"),
             ]),
         ])
 
@@ -120,6 +127,8 @@ class RegressInputSpec(BaseInterfaceInputSpec):
                       desc="CSF mask.")
     cr_opts = traits.Any(
         exists=True, mandatory=True, desc="Processing specs.")
+    n_procs = traits.Int(1, usedefault=True,
+                         desc="Number of threads used to smooth volumes in parallel.")
 
 class RegressOutputSpec(TraitedSpec):
     cleaned_path = File(exists=True, mandatory=True,
@@ -142,6 +151,8 @@ class RegressOutputSpec(TraitedSpec):
         desc="Output directory from ICA-AROMA.")
     background_mask_fig = traits.Str(
         desc="Figure to visualize the quality of background noise mapping.")
+    strategy_outputs = traits.Dict(
+        desc="A dictionary with the outputs from each of the --strategies, with the same keys as the main outputs.")
 
 class Regress(BaseInterface):
     '''
@@ -181,112 +192,182 @@ class Regress(BaseInterface):
     def _run_interface(self, runtime):
         import os
         import numpy as np
-        import pandas as pd
         import SimpleITK as sitk
-        from rabies.utils import recover_3D,recover_4D
-        from rabies.confound_correction_pkg.utils import temporal_censoring,lombscargle_fill, exec_ICA_AROMA,butterworth, phase_randomized_regressors, smooth_image, remove_trend, get_background_mask
-        from rabies.analysis_pkg.analysis_functions import closed_form
+        from rabies.utils import get_masker
+        from rabies.confound_correction_pkg.utils import compute_DVARS, get_strategy_opts
 
         ### set null returns in case the workflow is interrupted
         empty_img = sitk.GetImageFromArray(np.empty([1,1]))
         empty_file = os.path.abspath('empty.nii.gz')
         sitk.WriteImage(empty_img, empty_file)
 
-        setattr(self, 'cleaned_path', empty_file)
-        setattr(self, 'VE_file_path', empty_file)
-        setattr(self, 'STD_file_path', empty_file)
-        setattr(self, 'CR_STD_file_path', empty_file)
-        setattr(self, 'random_CR_STD_file_path', empty_file)
-        setattr(self, 'corrected_CR_STD_file_path', empty_file)
-        setattr(self, 'frame_mask_file', empty_file)
-        setattr(self, 'data_dict', empty_file)
-        setattr(self, 'aroma_out', empty_file)
-        setattr(self, 'background_mask_fig', empty_file)
+        empty_outputs = {'cleaned_path':empty_file, 'VE_file_path':empty_file, 'STD_file_path':empty_file, 'CR_STD_file_path':empty_file, 
+                         'random_CR_STD_file_path':empty_file, 'corrected_CR_STD_file_path':empty_file, 'frame_mask_file':empty_file, 
+                         'data_dict':empty_file, 'aroma_out':empty_file, 'background_mask_fig':empty_file}
+        for key in empty_outputs.keys():
+            setattr(self, key, empty_outputs[key])
+        setattr(self, 'strategy_outputs', {})
         ###
 
         bold_file = self.inputs.bold_file
         brain_mask_file = self.inputs.brain_mask_file
-        CSF_mask_file = self.inputs.CSF_mask_file
         data_dict = self.inputs.data_dict
         cr_opts = self.inputs.cr_opts
 
+        masker = get_masker(brain_mask_file)
+
+        # with --voxel_streaming, the timeseries are held in float32 and the voxelwise steps are applied 
+        # by blocks of voxels, so that the float64 intermediates are bounded by the block size
+        streaming = cr_opts.voxel_streaming['apply']
+        if streaming:
+            block_size = int(cr_opts.voxel_streaming['block_size'])
+            storage_dtype = np.float32
+        else:
+            block_size = None
+            storage_dtype = float
+        num_voxels = masker.num_voxels
+        if block_size is None or block_size<1:
+            block_size = max(num_voxels,1)
+        voxel_blocks = [slice(start, min(start+block_size, num_voxels)) for start in range(0, num_voxels, block_size)]
+
+        data_img = sitk.ReadImage(bold_file, sitk.sitkFloat32)
+        if cr_opts.TR=='auto':
+            TR = float(data_img.GetSpacing()[3])
+        else:
+            TR = float(cr_opts.TR)
+        timeseries = masker.extract(data_img, dtype=storage_dtype)
+        del data_img
+        timeseries = timeseries[data_dict['time_range'],:]
+
+        # the scan is loaded once, and the intermediate outputs which are identical across --strategies 
+        # (censoring masks, detrended and filtered timeseries) are computed once and stored in 'cache'
+        shared = {'masker':masker, 'TR':TR, 'storage_dtype':storage_dtype, 'voxel_blocks':voxel_blocks, 
+                  'timeseries':timeseries, 'DVARS':compute_DVARS(timeseries, block_size=block_size), 
+                  'multi_strategy':len(cr_opts.strategies)>0, 'cache':{}}
+
+        outputs = self._apply_strategy(cr_opts, os.getcwd(), shared)
+        if outputs is not None:
+            for key in outputs.keys():
+                setattr(self, key, outputs[key])
+
+        strategy_outputs = {}
+        for strategy in cr_opts.strategies:
+            strategy_opts = get_strategy_opts(cr_opts, strategy)
+            strategy_out = os.path.abspath(strategy['name'])
+            os.makedirs(strategy_out, exist_ok=True)
+            outputs = self._apply_strategy(strategy_opts, strategy_out, shared)
+            if outputs is None:
+                outputs = dict(empty_outputs)
+            strategy_outputs[strategy['name']] = outputs
+        setattr(self, 'strategy_outputs', strategy_outputs)
+
+        return runtime
+
+    def _apply_strategy(self, cr_opts, cr_out, shared):
+        # applies the confound correction steps for a given set of options, and writes the outputs in cr_out
+        # returns a dictionary of the outputs, or None if the scan was removed from further processing
+        import os
+        import numpy as np
+        import pandas as pd
+        import SimpleITK as sitk
+        from rabies.utils import recover_3D
+        from rabies.confound_correction_pkg.utils import temporal_censoring,lombscargle_fill, exec_ICA_AROMA,butterworth, phase_randomized_regressors, smooth_image, remove_trend, get_background_mask, MomentAccumulator, select_confound_timecourses
+        from rabies.analysis_pkg.least_squares import LeastSquaresSolver
+
+        bold_file = self.inputs.bold_file
+        brain_mask_file = self.inputs.brain_mask_file
+        CSF_mask_file = self.inputs.CSF_mask_file
+        data_dict = self.inputs.data_dict
+
         FD_trace=data_dict['FD_trace']
-        confounds_array=data_dict['confounds_array']
         confounds_file=data_dict['confounds_csv']
         time_range=data_dict['time_range']
         confounds_6rigid_array=data_dict['confounds_6rigid_array']
+        if cr_opts.conf_list==self.inputs.cr_opts.conf_list:
+            confounds_array=data_dict['confounds_array']
+        elif len(cr_opts.conf_list)==0:
+            confounds_array=confounds_6rigid_array
+        else:
+            confounds_array=select_confound_timecourses(cr_opts.conf_list,confounds_file,data_dict['FD_csv'])[list(time_range)]
 
-        cr_out = os.getcwd()
         import pathlib  # Better path manipulation
         filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
 
-        brain_mask = sitk.GetArrayFromImage(sitk.ReadImage(brain_mask_file, sitk.sitkFloat32))
-        volume_indices = brain_mask.astype(bool)
-
-        data_img = sitk.ReadImage(bold_file, sitk.sitkFloat32)
-        data_array = sitk.GetArrayFromImage(data_img)
-        num_volumes = data_array.shape[0]
-        timeseries = np.zeros([num_volumes, volume_indices.sum()])
-        for i in range(num_volumes):
-            timeseries[i, :] = (data_array[i, :, :, :])[volume_indices]
-        timeseries = timeseries[time_range,:]
-
-        if cr_opts.TR=='auto':
-            TR = float(data_img.GetSpacing()[3])
-        else:
-            TR = float(cr_opts.TR)
+        masker = shared['masker']
+        TR = shared['TR']
+        storage_dtype = shared['storage_dtype']
+        voxel_blocks = shared['voxel_blocks']
+        num_voxels = masker.num_voxels
+        cache = shared['cache']
+        multi_strategy = shared['multi_strategy']
+        empty_file = os.path.abspath('empty.nii.gz')
 
         '''
         scaling based on background noise
         '''
         if cr_opts.image_scaling=='background_noise':
-            background_mask, data_array, background_mask_fig_path = get_background_mask(self.inputs.raw_input_file, plotting=True)
-            # based on Gudbjartsson and Patz (1995, Magn Reson Med.), there's a linear relationship between the mean 
-            # in the background noise and the scanner noise signal variability in the Fourrier domain
-            scaling_factor = data_array[:,background_mask].flatten().mean() # we take the mean as a proxy for signal standard deviation in Fourier domain
-            timeseries = timeseries/scaling_factor
+            if not 'background_noise' in cache:
+                background_mask, background_mean, background_mask_fig_path = get_background_mask(self.inputs.raw_input_file, plotting=True)
+                # based on Gudbjartsson and Patz (1995, Magn Reson Med.), there's a linear relationship between the mean 
+                # in the background noise and the scanner noise signal variability in the Fourrier domain
+                scaling_factor = background_mean # we take the mean as a proxy for signal standard deviation in Fourier domain
+                cache['background_noise'] = (scaling_factor, background_mask_fig_path)
+            background_scaling, background_mask_fig_path = cache['background_noise']
         else:
+            background_scaling = 1
             background_mask_fig_path = empty_file
-        
 
-        '''
-        #1 - Compute and apply frame censoring mask (from FD and/or DVARS thresholds)
-        '''
-        frame_mask,FD_trace,DVARS = temporal_censoring(timeseries, FD_trace, 
-                cr_opts.frame_censoring['FD_censoring'], cr_opts.frame_censoring['FD_threshold'], cr_opts.frame_censoring['DVARS_censoring'], cr_opts.frame_censoring['minimum_timepoint'])
-        if frame_mask is None:
-            return runtime
+        apply_filter = (not cr_opts.highpass is None) or (not cr_opts.lowpass is None)
 
-        '''
-        #2 - If --match_number_timepoints is selected, each scan is matched to the defined minimum_timepoint number of frames.
-        '''
-        if cr_opts.match_number_timepoints:
-            if (not cr_opts.highpass is None) or (not cr_opts.lowpass is None):
-                # if frequency filtering is applied, avoid selecting timepoints that would be removed with --edge_cutoff
-                num_cut = int(cr_opts.edge_cutoff/TR)
-                if not num_cut==0:
-                    frame_mask[:num_cut]=0
-                    frame_mask[-num_cut:]=0
-
-                    if frame_mask.sum()<int(cr_opts.frame_censoring['minimum_timepoint']):
-                        from nipype import logging
-                        log = logging.getLogger('nipype.workflow')
-                        log.warning(f"CONFOUND CORRECTION LEFT LESS THAN {str(cr_opts.frame_censoring['minimum_timepoint'])} VOLUMES. THIS SCAN WILL BE REMOVED FROM FURTHER PROCESSING.")
-                        return runtime
-
-            # randomly shuffle indices that haven't been censored, then remove an extra subset above --minimum_timepoint
-            num_timepoints = len(frame_mask)
-            time_idx=np.array(range(num_timepoints))
-            perm = np.random.permutation(time_idx[frame_mask])
-            # selecting the subset of extra timepoints, and censoring them
-            subset_idx = perm[cr_opts.frame_censoring['minimum_timepoint']:]
-            frame_mask[subset_idx]=0
-            # keep track of the original number of timepoints for tDOF estimation, to evaluate latter if the correction was succesful
-            number_extra_timepoints = len(subset_idx)
-        else:
-            number_extra_timepoints = 0
+        censoring_key = ('censoring', background_scaling, tuple(sorted(cr_opts.frame_censoring.items())), cr_opts.match_number_timepoints, 
+                         apply_filter and cr_opts.match_number_timepoints and int(cr_opts.edge_cutoff/TR))
+        if not censoring_key in cache:
+            '''
+            #1 - Compute and apply frame censoring mask (from FD and/or DVARS thresholds)
+            '''
+            frame_mask,FD_trace,DVARS = temporal_censoring(shared['timeseries'], FD_trace, 
+                    cr_opts.frame_censoring['FD_censoring'], cr_opts.frame_censoring['FD_threshold'], cr_opts.frame_censoring['DVARS_censoring'], cr_opts.frame_censoring['minimum_timepoint'], 
+                    DVARS=shared['DVARS']/background_scaling)
+            if frame_mask is None:
+                cache[censoring_key] = None
+                return None
+
+            '''
+            #2 - If --match_number_timepoints is selected, each scan is matched to the defined minimum_timepoint number of frames.
+            '''
+            if cr_opts.match_number_timepoints:
+                if apply_filter:
+                    # if frequency filtering is applied, avoid selecting timepoints that would be removed with --edge_cutoff
+                    num_cut = int(cr_opts.edge_cutoff/TR)
+                    if not num_cut==0:
+                        frame_mask[:num_cut]=0
+                        frame_mask[-num_cut:]=0
+
+                        if frame_mask.sum()<int(cr_opts.frame_censoring['minimum_timepoint']):
+                            from nipype import logging
+                            log = logging.getLogger('nipype.workflow')
+                            log.warning(f"CONFOUND CORRECTION LEFT LESS THAN {str(cr_opts.frame_censoring['minimum_timepoint'])} VOLUMES. THIS SCAN WILL BE REMOVED FROM FURTHER PROCESSING.")
+                            cache[censoring_key] = None
+                            return None
+
+                # randomly shuffle indices that haven't been censored, then remove an extra subset above --minimum_timepoint
+                num_timepoints = len(frame_mask)
+                time_idx=np.array(range(num_timepoints))
+                perm = np.random.permutation(time_idx[frame_mask])
+                # selecting the subset of extra timepoints, and censoring them
+                subset_idx = perm[cr_opts.frame_censoring['minimum_timepoint']:]
+                frame_mask[subset_idx]=0
+                # keep track of the original number of timepoints for tDOF estimation, to evaluate latter if the correction was succesful
+                number_extra_timepoints = len(subset_idx)
+            else:
+                number_extra_timepoints = 0
+            # the censoring is shared across strategies, so that the same random subset of timepoints is used with --match_number_timepoints
+            cache[censoring_key] = (frame_mask,FD_trace,DVARS,number_extra_timepoints)
+        if cache[censoring_key] is None:
+            return None
+        frame_mask,FD_trace,DVARS,number_extra_timepoints = cache[censoring_key]
+        frame_mask = frame_mask.copy()
 
-        timeseries = timeseries[frame_mask]
         confounds_array = confounds_array[frame_mask]
 
         '''
@@ -300,50 +381,92 @@ class Regress(BaseInterface):
         else:
             raise ValueError(f"--detrending_order must be 'linear' or 'quadratic', not {cr_opts.detrending_order}")
 
-        # save grand mean prior to detrending
-        timeseries_ = remove_trend(timeseries, frame_mask, second_order=second_order, keep_intercept=True)
-        grand_mean = timeseries_.mean()
-        voxelwise_mean = timeseries_.mean(axis=0)
+        detrending_key = ('detrending', background_scaling, frame_mask.tobytes(), second_order)
+        if not detrending_key in cache:
+            if multi_strategy:
+                timeseries = shared['timeseries'][frame_mask]
+            else:
+                # with a single strategy, the loaded timeseries are not needed further, so the censored frames 
+                # are removed by moving the kept frames up in place, and the following steps are applied in place
+                timeseries = shared['timeseries']
+                shared['timeseries'] = None
+                for i,frame in enumerate(np.flatnonzero(frame_mask)):
+                    if not i==frame:
+                        timeseries[i] = timeseries[frame]
+                timeseries = timeseries[:frame_mask.sum()]
+            if not background_scaling==1:
+                timeseries /= background_scaling
+
+            # the timeseries are detrended in place by blocks of voxels; the fitted intercept is the temporal 
+            # mean of each voxel, which is recorded prior to its removal for the grand mean
+            voxelwise_mean = np.zeros(num_voxels)
+            for block in voxel_blocks:
+                timeseries_ = remove_trend(timeseries[:,block], frame_mask, second_order=second_order, keep_intercept=True)
+                voxelwise_mean[block] = timeseries_.mean(axis=0)
+                timeseries[:,block] = timeseries_-voxelwise_mean[block]
+            del timeseries_
+
+            '''
+            #4 - Apply ICA-AROMA.
+            '''
+            if cr_opts.ica_aroma['apply']:
+                confounds_6rigid_array=confounds_6rigid_array[frame_mask,:]
+                confounds_6rigid_array = remove_trend(confounds_6rigid_array, frame_mask, second_order=second_order, keep_intercept=False) # apply detrending to the confounds too
+
+                if cr_opts.ica_aroma['backend']=='native':
+                    # the ICA, classification and denoising are conducted in memory on the masked timeseries
+                    from rabies.confound_correction_pkg.mod_ICA_AROMA.native_ICA_AROMA import run_ICA_AROMA_native
+                    from rabies.morphology import edge_mask
+                    aroma_out = f'{cr_out}/aroma_out'
+                    csf_vector = masker.extract(CSF_mask_file).astype(bool)
+                    edge_vector = masker.extract(edge_mask(masker.volume_indices, num_edge_voxels=1))
+                    timeseries, motionICs = run_ICA_AROMA_native(aroma_out, timeseries, confounds_6rigid_array, TR, csf_vector, edge_vector, 
+                                                                  dim=cr_opts.ica_aroma['dim'], random_seed=cr_opts.ica_aroma['random_seed'])
+                    # if AROMA failed, returns empty outputs
+                    if timeseries is None:
+                        cache[detrending_key] = None
+                        return None
+                else:
+                    # write intermediary output files for timeseries and 6 rigid body parameters
+                    timeseries_img = masker.recover(timeseries, ref_4d=bold_file, dtype=storage_dtype)
+                    inFile = f'{cr_out}/{filename_split[0]}_aroma_input.nii.gz'
+                    sitk.WriteImage(timeseries_img, inFile)
+                    del timeseries_img
+
+                    df = pd.DataFrame(confounds_6rigid_array)
+                    df.columns = ['mov1', 'mov2', 'mov3', 'rot1', 'rot2', 'rot3']
+                    mc_file = f'{cr_out}/{filename_split[0]}_aroma_input.csv'
+                    df.to_csv(mc_file)
+
+                    cleaned_file, aroma_out = exec_ICA_AROMA(inFile, mc_file, brain_mask_file, CSF_mask_file, TR, cr_opts.ica_aroma['dim'], random_seed=cr_opts.ica_aroma['random_seed'])
+                    # if AROMA failed, returns empty outputs
+                    if cleaned_file is None:
+                        cache[detrending_key] = None
+                        return None
+
+                    data_img = sitk.ReadImage(cleaned_file, sitk.sitkFloat32)
+                    timeseries = masker.extract(data_img, dtype=storage_dtype)
+                    del data_img
+            else:
+                aroma_out = empty_file
+            cache[detrending_key] = (timeseries, voxelwise_mean, aroma_out)
+        if cache[detrending_key] is None:
+            return None
+        timeseries, voxelwise_mean, aroma_out = cache[detrending_key]
+        if not multi_strategy:
+            del cache[detrending_key]
+        grand_mean = voxelwise_mean.mean()
 
-        timeseries = remove_trend(timeseries, frame_mask, second_order=second_order, keep_intercept=False)
         confounds_array = remove_trend(confounds_array, frame_mask, second_order=second_order, keep_intercept=False)
 
-        '''
-        #4 - Apply ICA-AROMA.
-        '''
-        if cr_opts.ica_aroma['apply']:
-            # write intermediary output files for timeseries and 6 rigid body parameters
-            timeseries_img = recover_4D(brain_mask_file, timeseries, bold_file)
-            inFile = f'{cr_out}/{filename_split[0]}_aroma_input.nii.gz'
-            sitk.WriteImage(timeseries_img, inFile)
-
-            confounds_6rigid_array=confounds_6rigid_array[frame_mask,:]
-            confounds_6rigid_array = remove_trend(confounds_6rigid_array, frame_mask, second_order=second_order, keep_intercept=False) # apply detrending to the confounds too
-            df = pd.DataFrame(confounds_6rigid_array)
-            df.columns = ['mov1', 'mov2', 'mov3', 'rot1', 'rot2', 'rot3']
-            mc_file = f'{cr_out}/{filename_split[0]}_aroma_input.csv'
-            df.to_csv(mc_file)
-
-            cleaned_file, aroma_out = exec_ICA_AROMA(inFile, mc_file, brain_mask_file, CSF_mask_file, TR, cr_opts.ica_aroma['dim'], random_seed=cr_opts.ica_aroma['random_seed'])
-            # if AROMA failed, returns empty outputs
-            if cleaned_file is None:
-                return runtime
-            setattr(self, 'aroma_out', aroma_out)
-
-            data_img = sitk.ReadImage(cleaned_file, sitk.sitkFloat32)
-            data_array = sitk.GetArrayFromImage(data_img)
-            num_volumes = data_array.shape[0]
-            timeseries = np.zeros([num_volumes, volume_indices.sum()])
-            for i in range(num_volumes):
-                timeseries[i, :] = (data_array[i, :, :, :])[volume_indices]
-
-        if (not cr_opts.highpass is None) or (not cr_opts.lowpass is None):
+        # the confound-side operations are conducted once, prior to the voxelwise steps
+        censoring_mask = frame_mask.copy() # the censoring mask prior to the removal of the edges
+        if apply_filter:
             '''
             #5 - If frequency filtering and frame censoring are applied, simulate data in censored timepoints using the Lomb-Scargle periodogram, 
                 as suggested in Power et al. (2014, Neuroimage), for both the fMRI timeseries and nuisance regressors prior to filtering.
             '''
-            timeseries_filled = lombscargle_fill(x=timeseries,time_step=TR,time_mask=frame_mask)
-            confounds_filled = lombscargle_fill(x=confounds_array,time_step=TR,time_mask=frame_mask)
+            confounds_filled = lombscargle_fill(x=confounds_array,time_step=TR,time_mask=censoring_mask)
 
             '''
             #6 - As recommended in Lindquist et al. (2019, Human brain mapping), make the nuisance regressors orthogonal
@@ -352,13 +475,6 @@ class Regress(BaseInterface):
             confounds_filtered = butterworth(confounds_filled, TR=TR,
                                     high_pass=cr_opts.highpass, low_pass=cr_opts.lowpass)
 
-            '''
-            #7 - Apply highpass and/or lowpass filtering on the fMRI timeseries (with simulated timepoints).
-            '''
-
-            timeseries_filtered = butterworth(timeseries_filled, TR=TR,
-                                    high_pass=cr_opts.highpass, low_pass=cr_opts.lowpass)
-
             # correct for edge effects of the filters
             num_cut = int(cr_opts.edge_cutoff/TR)
             if len(frame_mask)<2*num_cut:
@@ -368,112 +484,185 @@ class Regress(BaseInterface):
                 frame_mask[:num_cut]=0
                 frame_mask[-num_cut:]=0
 
-
-            '''
-            #8 - Re-apply the frame censoring mask onto filtered fMRI timeseries and nuisance regressors, taking out the
-                simulated timepoints. Edge artefacts from frequency filtering can also be removed as recommended in Power et al. (2014, Neuroimage).
-            '''
             # re-apply the masks to take out simulated data points, and take off the edges
-            timeseries = timeseries_filtered[frame_mask]
             confounds_array = confounds_filtered[frame_mask]
         
         if frame_mask.sum()<int(cr_opts.frame_censoring['minimum_timepoint']):
             from nipype import logging
             log = logging.getLogger('nipype.workflow')
             log.warning(f"CONFOUND CORRECTION LEFT LESS THAN {str(cr_opts.frame_censoring['minimum_timepoint'])} VOLUMES. THIS SCAN WILL BE REMOVED FROM FURTHER PROCESSING.")
-            return runtime
+            return None
 
-        '''
-        #9 - Apply confound regression using the selected nuisance regressors.
-        '''
-        # voxels that have a NaN value are set to 0
-        nan_voxels = np.isnan(timeseries).sum(axis=0)>1
-        timeseries[:,nan_voxels] = 0
+        if apply_filter:
+            # the filtered timeseries are stored across strategies only when several strategies are applied
+            filtering_key = ('filtering', detrending_key, cr_opts.highpass, cr_opts.lowpass, frame_mask.tobytes())
+            if filtering_key in cache:
+                filtered_timeseries, filtered_ready = cache[filtering_key], True
+            else:
+                filtered_timeseries = np.empty([frame_mask.sum(), num_voxels], dtype=storage_dtype) if multi_strategy else None
+                filtered_ready = False
 
         # estimate the VE from the CR selection, or 6 rigid motion parameters if no CR is applied
-        X=confounds_array
-        Y=timeseries
-        try:
-            predicted = X.dot(closed_form(X,Y))
-            res = Y-predicted
-        except:
+        solver = LeastSquaresSolver(confounds_array)
+        if solver.rank_deficient:
             from nipype import logging
             log = logging.getLogger('nipype.workflow')
-            log.warning("SINGULAR MATRIX ERROR DURING CONFOUND REGRESSION. THIS SCAN WILL BE REMOVED FROM FURTHER PROCESSING.")
-            empty_img = sitk.GetImageFromArray(np.empty([1,1]))
-            empty_file = os.path.abspath('empty.nii.gz')
-            sitk.WriteImage(empty_img, empty_file)
-
-            return runtime
-
-        VE_spatial = 1-(res.var(axis=0)/Y.var(axis=0))
-        VE_temporal = 1-(res.var(axis=1)/Y.var(axis=1))
+            log.warning("The confound regressors are rank-deficient. The minimum-norm least-squares solution is used for confound regression.")
 
         # estimate the fit from CR with randomized regressors as in BRIGHT AND MURPHY 2015
         randomized_confounds_array = phase_randomized_regressors(confounds_array, frame_mask, TR=TR)
-        X=randomized_confounds_array 
-        Y = timeseries
-        predicted_random = X.dot(closed_form(X,Y))
+        random_solver = LeastSquaresSolver(randomized_confounds_array)
+
+        # the fitted confound timeseries (predicted=X.dot(W)) are never materialized; their statistics are 
+        # derived from the coefficients W and the mean/second moment of the regressors, e.g. var(predicted)=W.T.dot(cov(X)).dot(W)
+        def regressor_moments(X):
+            X_mean = X.mean(axis=0)
+            X_gram = X.T.dot(X)/X.shape[0]
+            return X_mean, X_gram, X_gram-np.outer(X_mean, X_mean)
+        X = confounds_array
+        X_mean, X_gram, X_cov = regressor_moments(X)
+        X_random_mean, X_random_gram, X_random_cov = regressor_moments(randomized_confounds_array)
+        def quadratic_form(A, W): # the diagonal of W.T.dot(A).dot(W)
+            return (A.dot(W)*W).sum(axis=0)
+
+        # the cleaned blocks are written directly into the volumes of the output image
+        cleaned_volumes = masker.empty_volumes(frame_mask.sum(), dtype=storage_dtype)
+        VE_spatial = np.zeros(num_voxels)
+        temporal_std = np.zeros(num_voxels)
+        predicted_std = np.zeros(num_voxels)
+        predicted_random_std = np.zeros(num_voxels)
+        corrected_predicted_std = np.zeros(num_voxels)
+        Y_moments = MomentAccumulator(axis=1)
+        cleaned_moments = MomentAccumulator()
+        # sums across voxels at each timepoint for the residuals, and of the predicted timeseries across all values
+        res_sum = np.zeros(frame_mask.sum())
+        res_sum_squares = np.zeros(frame_mask.sum())
+        predicted_sum = 0
+        predicted_sum_squares = 0
+        predicted_WWt = np.zeros([X.shape[1], X.shape[1]]) # sum over voxels of the outer product of the scaled coefficients
+
+        for block in voxel_blocks:
+            if apply_filter and filtered_ready:
+                Y = filtered_timeseries[:,block].astype(float)
+            elif apply_filter:
+                Y = timeseries[:,block].astype(float)
+                '''
+                #7 - Apply highpass and/or lowpass filtering on the fMRI timeseries (with simulated timepoints).
+                '''
+                Y_filled = lombscargle_fill(x=Y,time_step=TR,time_mask=censoring_mask)
+                Y_filtered = butterworth(Y_filled, TR=TR,
+                                        high_pass=cr_opts.highpass, low_pass=cr_opts.lowpass)
+                del Y_filled
+
+                '''
+                #8 - Re-apply the frame censoring mask onto filtered fMRI timeseries and nuisance regressors, taking out the
+                    simulated timepoints. Edge artefacts from frequency filtering can also be removed as recommended in Power et al. (2014, Neuroimage).
+                '''
+                Y = Y_filtered[frame_mask]
+                del Y_filtered
+                if filtered_timeseries is not None:
+                    filtered_timeseries[:,block] = Y
+            else:
+                Y = timeseries[:,block].astype(float)
 
-        if len(cr_opts.conf_list) > 0:
-            # if confound regression is applied
-            timeseries = res
+            '''
+            #9 - Apply confound regression using the selected nuisance regressors.
+            '''
+            # voxels that have a NaN value are set to 0
+            nan_voxels = np.isnan(Y).sum(axis=0)>1
+            Y[:,nan_voxels] = 0
 
-        '''
-        #10 - Scaling of timeseries variance.
-        '''
-        if cr_opts.image_scaling=='global_variance':
-            scaling_factor = timeseries.std()
-            timeseries = timeseries/scaling_factor
-            # we scale also the variance estimates from CR
-            predicted = predicted/scaling_factor
-            predicted_random = predicted_random/scaling_factor
-        elif cr_opts.image_scaling=='grand_mean_scaling':
-            scaling_factor = grand_mean
-            timeseries = timeseries/scaling_factor
-            timeseries *= 100 # we scale BOLD in % fluctuations
-            # we scale also the variance estimates from CR
-            predicted = predicted/scaling_factor
-            predicted_random = predicted_random/scaling_factor
-        elif cr_opts.image_scaling=='voxelwise_standardization':
-            # each voxel is scaled according to its STD
-            temporal_std = timeseries.std(axis=0) 
-            timeseries = timeseries/temporal_std
-            nan_voxels = np.isnan(timeseries).sum(axis=0)>1
-            timeseries[:,nan_voxels] = 0
-            # we scale also the variance estimates from CR
-            predicted = predicted/temporal_std
-            nan_voxels = np.isnan(predicted).sum(axis=0)>1
-            predicted[:,nan_voxels] = 0
-            predicted_random = predicted_random/temporal_std
-            nan_voxels = np.isnan(predicted_random).sum(axis=0)>1
-            predicted_random[:,nan_voxels] = 0
-        elif cr_opts.image_scaling=='voxelwise_mean':
-            # each voxel is scaled according to its mean
-            timeseries = timeseries/voxelwise_mean
-            nan_voxels = np.isnan(timeseries).sum(axis=0)>1
-            timeseries[:,nan_voxels] = 0
-            timeseries *= 100 # we scale BOLD in % fluctuations
+            W = solver.solve(Y)
+            W_random = random_solver.solve(Y)
 
+            # the residuals are orthogonal to the predicted timeseries, thus E[res**2]=E[Y**2]-E[predicted**2]
+            Y_mean = Y.mean(axis=0)
+            Y_var = Y.var(axis=0)
+            res_var = Y_var+Y_mean**2-quadratic_form(X_gram, W)-(Y_mean-X_mean.dot(W))**2
+            VE_spatial[block] = 1-(res_var/Y_var)
+
+            # the temporal VE is computed across voxels at each timepoint
+            Y_moments.update(Y)
+            res_sum += Y.sum(axis=1)-X.dot(W.sum(axis=1))
+            res_sum_squares += (Y**2).sum(axis=1)-2*(X*W.dot(Y.T).T).sum(axis=1)+(X.dot(W.dot(W.T))*X).sum(axis=1)
+
+            if len(cr_opts.conf_list) > 0:
+                # if confound regression is applied
+                Y = solver.residuals(Y, W=W, out=Y)
+
+            '''
+            #10 - Scaling of timeseries variance.
+            '''
+            if cr_opts.image_scaling=='grand_mean_scaling':
+                Y = Y/grand_mean
+                Y *= 100 # we scale BOLD in % fluctuations
+                # we scale also the variance estimates from CR
+                W = W/grand_mean
+                W_random = W_random/grand_mean
+            elif cr_opts.image_scaling=='voxelwise_standardization':
+                # each voxel is scaled according to its STD
+                voxel_std = Y.std(axis=0) 
+                Y = Y/voxel_std
+                nan_voxels = np.isnan(Y).sum(axis=0)>1
+                Y[:,nan_voxels] = 0
+                # we scale also the variance estimates from CR
+                W = W/voxel_std
+                nan_voxels = np.isnan(W).sum(axis=0)>0
+                W[:,nan_voxels] = 0
+                W_random = W_random/voxel_std
+                nan_voxels = np.isnan(W_random).sum(axis=0)>0
+                W_random[:,nan_voxels] = 0
+            elif cr_opts.image_scaling=='voxelwise_mean':
+                # each voxel is scaled according to its mean
+                Y = Y/voxelwise_mean[block]
+                nan_voxels = np.isnan(Y).sum(axis=0)>1
+                Y[:,nan_voxels] = 0
+                Y *= 100 # we scale BOLD in % fluctuations
+
+                # we scale also the variance estimates from CR
+                W = W/voxelwise_mean[block]
+                nan_voxels = np.isnan(W).sum(axis=0)>0
+                W[:,nan_voxels] = 0
+                W_random = W_random/voxelwise_mean[block]
+                nan_voxels = np.isnan(W_random).sum(axis=0)>0
+                W_random[:,nan_voxels] = 0
+
+            # after variance scaling, compute the variability estimates
+            cleaned_volumes[:,masker.flat_indices[block]] = Y
+            cleaned_moments.update(Y)
+            temporal_std[block] = Y.std(axis=0)
+            predicted_var = np.maximum(quadratic_form(X_cov, W), 0)
+            predicted_random_var = np.maximum(quadratic_form(X_random_cov, W_random), 0)
+            predicted_std[block] = np.sqrt(predicted_var)
+            predicted_random_std[block] = np.sqrt(predicted_random_var)
+            predicted_sum += X_mean.dot(W).sum()
+            predicted_sum_squares += quadratic_form(X_gram, W).sum()
+            predicted_WWt += W.dot(W.T)
+
+            # here we correct the previous STD estimates by substrating the variance explained by that of the overfitting with random regressors
+            var_dif = predicted_var - predicted_random_var
+            var_dif[var_dif<0] = 0 # when there's more variance explained in random regressors, set variance explained to 0
+            corrected_predicted_std[block] = np.sqrt(var_dif)
+        del timeseries,Y
+        if apply_filter and multi_strategy:
+            cache[filtering_key] = filtered_timeseries
+
+        VE_temporal = 1-((res_sum_squares/num_voxels-(res_sum/num_voxels)**2)/Y_moments.var)
+        predicted_time = np.sqrt(np.maximum((X.dot(predicted_WWt)*X).sum(axis=1), 0)/num_voxels)
+        predicted_global_std = np.sqrt(max(predicted_sum_squares/num_voxels-(predicted_sum/num_voxels)**2, 0))
+
+        if cr_opts.image_scaling=='global_variance':
+            # the total standard deviation is only known after all voxels were processed, so the 
+            # scaling is applied at the end
+            scaling_factor = cleaned_moments.std
+            cleaned_volumes /= scaling_factor
             # we scale also the variance estimates from CR
-            predicted = predicted/voxelwise_mean
-            nan_voxels = np.isnan(predicted).sum(axis=0)>1
-            predicted[:,nan_voxels] = 0
-            predicted_random = predicted_random/voxelwise_mean
-            nan_voxels = np.isnan(predicted_random).sum(axis=0)>1
-            predicted_random[:,nan_voxels] = 0
-
-        # after variance scaling, compute the variability estimates
-        temporal_std = timeseries.std(axis=0)
-        predicted_std = predicted.std(axis=0)
-        predicted_time = np.sqrt((predicted.T**2).mean(axis=0))
-        predicted_random_std = predicted_random.std(axis=0)
-        predicted_global_std = predicted.std()
-
-        # here we correct the previous STD estimates by substrating the variance explained by that of the overfitting with random regressors
-        var_dif = predicted.var(axis=0) - predicted_random.var(axis=0)
-        var_dif[var_dif<0] = 0 # when there's more variance explained in random regressors, set variance explained to 0
-        corrected_predicted_std = np.sqrt(var_dif)
+            temporal_std /= scaling_factor
+            predicted_std /= scaling_factor
+            predicted_random_std /= scaling_factor
+            corrected_predicted_std /= scaling_factor
+            predicted_time /= scaling_factor
+            predicted_global_std /= scaling_factor
 
         # save output files
         VE_spatial_map = recover_3D(brain_mask_file, VE_spatial)
@@ -481,7 +670,8 @@ class Regress(BaseInterface):
         CR_STD_spatial_map = recover_3D(brain_mask_file, predicted_std)
         random_CR_STD_spatial_map = recover_3D(brain_mask_file, predicted_random_std)
         corrected_CR_STD_spatial_map = recover_3D(brain_mask_file, corrected_predicted_std)
-        timeseries_img = recover_4D(brain_mask_file, timeseries, bold_file)
+        timeseries_img = masker.image_from_volumes(cleaned_volumes, ref_4d=bold_file)
+        del cleaned_volumes
 
         if cr_opts.smoothing_filter is not None:
             '''
@@ -489,7 +679,8 @@ class Regress(BaseInterface):
             '''
             import nibabel as nb
             affine = nb.load(bold_file).affine[:3,:3] # still not sure how to match nibabel's affine reliably
-            timeseries_img = smooth_image(timeseries_img, affine, cr_opts.smoothing_filter)
+            # only the bounding box of the brain mask is smoothed
+            timeseries_img = smooth_image(timeseries_img, affine, cr_opts.smoothing_filter, mask=masker.volume_indices, n_procs=self.inputs.n_procs)
 
         cleaned_path = cr_out+'/'+filename_split[0]+'_cleaned.nii.gz'
         sitk.WriteImage(timeseries_img, cleaned_path)
@@ -521,17 +712,9 @@ class Regress(BaseInterface):
 
         data_dict = {'FD_trace':FD_trace, 'DVARS':DVARS, 'time_range':time_range, 'frame_mask':frame_mask, 'confounds_array':confounds_array, 'VE_temporal':VE_temporal, 'confounds_csv':confounds_file, 'predicted_time':predicted_time, 'tDOF':tDOF, 'CR_global_std':predicted_global_std}
 
-        setattr(self, 'cleaned_path', cleaned_path)
-        setattr(self, 'VE_file_path', VE_file_path)
-        setattr(self, 'STD_file_path', STD_file_path)
-        setattr(self, 'CR_STD_file_path', CR_STD_file_path)
-        setattr(self, 'random_CR_STD_file_path', random_CR_STD_file_path)
-        setattr(self, 'corrected_CR_STD_file_path', corrected_CR_STD_file_path)
-        setattr(self, 'frame_mask_file', frame_mask_file)
-        setattr(self, 'data_dict', data_dict)
-        setattr(self, 'background_mask_fig', background_mask_fig_path)
-
-        return runtime
+        return {'cleaned_path':cleaned_path, 'VE_file_path':VE_file_path, 'STD_file_path':STD_file_path, 'CR_STD_file_path':CR_STD_file_path, 
+                'random_CR_STD_file_path':random_CR_STD_file_path, 'corrected_CR_STD_file_path':corrected_CR_STD_file_path, 
+                'frame_mask_file':frame_mask_file, 'data_dict':data_dict, 'aroma_out':aroma_out, 'background_mask_fig':background_mask_fig_path}
 
     def _list_outputs(self):
         return {'cleaned_path': getattr(self, 'cleaned_path'),
@@ -544,4 +727,5 @@ class Regress(BaseInterface):
                 'data_dict': getattr(self, 'data_dict'),
                 'aroma_out': getattr(self, 'aroma_out'),
                 'background_mask_fig': getattr(self, 'background_mask_fig'),
-                }
\ No newline at end of file
+                'strategy_outputs': getattr(self, 'strategy_outputs'),
+                }
@@ -133,13 +133,104 @@ def init_main_confound_correction_wf(preprocess_opts, cr_opts):
     if cr_opts.image_scaling=='background_noise':
         workflow.connect([
             (confound_correction_wf, confound_correction_datasink, [
-                ("outputnode.background_fig", "background_masking_fig"),
+                ("outputnode.background_mask_fig", "background_masking_fig"),
                 ]),
             ])
 
+    # each additional strategy is written in its own output tree, with the same outputs as the main options
+    from rabies.confound_correction_pkg.utils import get_strategy_opts
+    for strategy in cr_opts.strategies:
+        strategy_name = strategy['name']
+        strategy_opts = get_strategy_opts(cr_opts, strategy)
+        strategy_outputs_node = pe.Node(Function(input_names=['strategy_outputs', 'strategy_name'],
+                                            output_names=['cleaned_path', 'VE_file_path', 'STD_file_path', 'CR_STD_file_path', 'random_CR_STD_file_path', 
+                                                          'corrected_CR_STD_file_path', 'frame_mask_file', 'data_dict_file', 'aroma_out', 'background_mask_fig'],
+                                        function=select_strategy_outputs),
+                                name=f'{strategy_name}_strategy_outputs')
+        strategy_outputs_node.inputs.strategy_name = strategy_name
+
+        strategy_plot_CR_overfit_node = pe.Node(Function(input_names=['mask_file', 'STD_file_path', 'CR_STD_file_path', 'random_CR_STD_file_path', 'corrected_CR_STD_file_path'],
+                                            output_names=['figure_path'],
+                                        function=plot_CR_overfit),
+                                name=f'{strategy_name}_plot_CR_overfit_node')
+
+        strategy_datasink = pe.Node(DataSink(base_directory=f'{cr_output}/strategies/{strategy_name}',
+                                                        container="confound_correction_datasink"),
+                                                name=f"{strategy_name}_confound_correction_datasink")
+        workflow.connect([
+            (confound_correction_wf, strategy_outputs_node, [
+                ("outputnode.strategy_outputs", "strategy_outputs"),
+                ]),
+            (strategy_outputs_node, strategy_plot_CR_overfit_node, [
+                ("STD_file_path", "STD_file_path"),
+                ("CR_STD_file_path", "CR_STD_file_path"),
+                ("random_CR_STD_file_path", "random_CR_STD_file_path"),
+                ("corrected_CR_STD_file_path", "corrected_CR_STD_file_path"),
+                ]),
+            (strategy_outputs_node, strategy_datasink, [
+                ("cleaned_path", "cleaned_timeseries"),
+                ("VE_file_path", "VE_map"),
+                ("STD_file_path", "STD_map"),
+                ("CR_STD_file_path", "CR_STD_map"),
+                ("random_CR_STD_file_path", "random_CR_STD_map"),
+                ("corrected_CR_STD_file_path", "corrected_CR_STD_map"),
+                ("data_dict_file", "data_dict"),
+                ]),
+            (strategy_plot_CR_overfit_node, strategy_datasink, [
+                ("figure_path", "plot_CR_overfit"),
+                ]),
+            ])
+        if strategy_opts.ica_aroma['apply']:
+            workflow.connect([
+                (strategy_outputs_node, strategy_datasink, [
+                    ("aroma_out", "aroma_out"),
+                    ]),
+                ])
+        if strategy_opts.frame_censoring['DVARS_censoring'] or strategy_opts.frame_censoring['FD_censoring']:
+            workflow.connect([
+                (strategy_outputs_node, strategy_datasink, [
+                    ("frame_mask_file", "frame_censoring_mask"),
+                    ]),
+                ])
+        if strategy_opts.image_scaling=='background_noise':
+            workflow.connect([
+                (strategy_outputs_node, strategy_datasink, [
+                    ("background_mask_fig", "background_masking_fig"),
+                    ]),
+                ])
+        if cr_opts.nativespace_analysis:
+            workflow.connect([
+                (preproc_outputnode, strategy_plot_CR_overfit_node, [
+                    ("native_brain_mask", "mask_file"),
+                    ]),
+                ])
+        else:
+            workflow.connect([
+                (preproc_outputnode, strategy_plot_CR_overfit_node, [
+                    ("commonspace_mask", "mask_file"),
+                    ]),
+                ])
+
     return workflow
 
 
+def select_strategy_outputs(strategy_outputs, strategy_name):
+    # returns the outputs of a given strategy; the data_dict from confound correction is pickled so that it can be sinked
+    import os
+    import pathlib
+    import pickle
+    outputs = strategy_outputs[strategy_name]
+    data_dict = outputs['data_dict']
+    if isinstance(data_dict, dict):
+        filename_split = pathlib.Path(outputs['cleaned_path']).name.rsplit("_cleaned.nii")
+        data_dict_file = os.path.abspath(f'{filename_split[0]}_data_dict.pkl')
+        with open(data_dict_file, 'wb') as handle:
+            pickle.dump(data_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    else: # the scan was removed from further processing, and an empty file is provided
+        data_dict_file = data_dict
+    return outputs['cleaned_path'], outputs['VE_file_path'], outputs['STD_file_path'], outputs['CR_STD_file_path'], outputs['random_CR_STD_file_path'], \
+        outputs['corrected_CR_STD_file_path'], outputs['frame_mask_file'], data_dict_file, outputs['aroma_out'], outputs['background_mask_fig']
+
 
 def read_preproc_datasinks(preproc_output, nativespace=False, fast_commonspace=False, atlas_reg_script='SyN'):
     import pathlib
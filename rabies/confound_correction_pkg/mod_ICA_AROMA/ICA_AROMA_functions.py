@@ -121,11 +121,11 @@ def run_ICA_AROMA(outDir,inFile,mc,TR,mask="",mask_csf="",denType="nonaggr",melD
 
     print('  - extracting the CSF & Edge fraction features')
     #modified inputs for the spatial features, by providing the required masks manually
-    edgeFract, csfFract = aromafunc.mod_feature_spatial(fslDir, outDir, melIC, mask_csf, mask_edge, mask_out)
+    edgeFract, csfFract = aromafunc.mod_feature_spatial(melIC, mask_csf, mask_edge, mask_out)
 
     print('  - extracting the Maximum RP correlation feature')
     melmix = os.path.join(outDir, 'melodic.ica', 'melodic_mix')
-    maxRPcorr = aromafunc.feature_time_series(melmix, mc)
+    maxRPcorr = aromafunc.feature_time_series(melmix, mc, random_seed=random_seed)
 
     print('  - extracting the High-frequency content feature')
     melFTmix = os.path.join(outDir, 'melodic.ica', 'melodic_FTmix')
@@ -349,15 +349,44 @@ def cross_correlation(a, b):
     return np.corrcoef(a.T, b.T)[:ncols_a, ncols_a:]
 
 
-def feature_time_series(melmix, mc):
+def subset_correlations(X, Y, excluded_rows, num_rows):
+    """Correlation between the columns of X and Y within subsets of rows, for a batch of subsets.
+    The sums over each subset are obtained by removing the contribution of the excluded rows
+    from the sums over all rows, so that only the excluded rows are visited for each subset.
+
+    Parameters
+    ---------------------------------------------------------------------------------
+    X:              time by column matrix, with standardized columns
+    Y:              time by column matrix, with standardized columns
+    excluded_rows:  subset by row index matrix of the rows left out of each subset
+    num_rows:       number of rows included in each subset
+
+    Returns
+    ---------------------------------------------------------------------------------
+    subset by X column by Y column array of correlations (NaN for columns which are
+    constant within a subset)"""
+    X_out = X[excluded_rows]
+    Y_out = Y[excluded_rows]
+    X_sum = X.sum(axis=0) - X_out.sum(axis=1)
+    Y_sum = Y.sum(axis=0) - Y_out.sum(axis=1)
+    X_var = (X**2).sum(axis=0) - (X_out**2).sum(axis=1) - X_sum**2/num_rows
+    Y_var = (Y**2).sum(axis=0) - (Y_out**2).sum(axis=1) - Y_sum**2/num_rows
+    cov = X.T.dot(Y) - np.matmul(X_out.transpose(0,2,1), Y_out) - X_sum[:,:,np.newaxis]*Y_sum[:,np.newaxis,:]/num_rows
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cov/np.sqrt(X_var[:,:,np.newaxis]*Y_var[:,np.newaxis,:])
+
+
+def feature_time_series(melmix, mc, random_seed=1, batch_size=100):
     """ This function extracts the maximum RP correlation feature scores.
     It determines the maximum robust correlation of each component time-series
     with a model of 72 realignment parameters.
 
     Parameters
     ---------------------------------------------------------------------------------
-    melmix:     Full path of the melodic_mix text file
-    mc:     Full path of the text file containing the realignment parameters
+    melmix:     Full path of the melodic_mix text file, or the time by component array
+    mc:     Full path of the text file containing the realignment parameters, or the time by parameter array
+    random_seed:    seed for the random subsets of the bootstrap
+    batch_size:     number of random subsets evaluated at once
 
     Returns
     ---------------------------------------------------------------------------------
@@ -366,15 +395,20 @@ def feature_time_series(melmix, mc):
 
     # Import required modules
     import numpy as np
-    import random
 
     # Read melodic mix file (IC time-series), subsequently define a set of squared time-series
-    mix = np.loadtxt(melmix)
+    if isinstance(melmix, np.ndarray):
+        mix = melmix.astype(float)
+    else:
+        mix = np.loadtxt(melmix)
     if len(mix.shape)==1:
         mix = mix[:,np.newaxis]
 
     # Read motion parameter file
-    rp6 = np.loadtxt(mc)
+    if isinstance(mc, np.ndarray):
+        rp6 = mc.astype(float)
+    else:
+        rp6 = np.loadtxt(mc)
     _, nparams = rp6.shape
 
     # Determine the derivatives of the RPs (add zeros at time-point zero)
@@ -402,22 +436,31 @@ def feature_time_series(melmix, mc):
     nmixrows, nmixcols = mix.shape
     nrows_to_choose = int(round(0.9 * nmixrows))
 
+    # The columns are standardized once over all rows, which keeps the subset sums well-conditioned
+    def standardize(X):
+        X = X - X.mean(axis=0)
+        std = X.std(axis=0)
+        std[std == 0] = 1
+        return X/std
+    mix_squared, mix = standardize(mix**2), standardize(mix)
+    rp_squared, rp_model = standardize(rp_model**2), standardize(rp_model)
+
     # Max correlations for multiple splits of the dataset (for a robust estimate)
+    # the splits are evaluated by batches, where each split is a random subset of 90%
+    # of the dataset rows (*without* replacement)
+    rng = np.random.default_rng(random_seed)
     max_correls = np.empty((nsplits, nmixcols))
-    for i in range(nsplits):
-        # Select a random subset of 90% of the dataset rows (*without* replacement)
-        chosen_rows = random.sample(population=range(nmixrows),
-                                    k=nrows_to_choose)
+    for start in range(0, nsplits, batch_size):
+        end = min(start+batch_size, nsplits)
+        excluded_rows = np.argsort(rng.random((end-start, nmixrows)), axis=1)[:, nrows_to_choose:]
 
         # Combined correlations between RP and IC time-series, squared and non squared
-        correl_nonsquared = cross_correlation(mix[chosen_rows],
-                                              rp_model[chosen_rows])
-        correl_squared = cross_correlation(mix[chosen_rows]**2,
-                                           rp_model[chosen_rows]**2)
-        correl_both = np.hstack((correl_squared, correl_nonsquared))
+        correl_squared = subset_correlations(mix_squared, rp_squared, excluded_rows, nrows_to_choose)
+        correl_nonsquared = subset_correlations(mix, rp_model, excluded_rows, nrows_to_choose)
+        correl_both = np.concatenate((correl_squared, correl_nonsquared), axis=2)
 
         # Maximum absolute temporal correlation for every IC
-        max_correls[i] = np.abs(correl_both).max(axis=1)
+        max_correls[start:end] = np.abs(correl_both).max(axis=2)
 
     # Feature score is the mean of the maximum correlation over all the random splits
     # Avoid propagating occasional nans that arise in artificial test cases
@@ -432,7 +475,7 @@ def feature_frequency(melFTmix, TR):
 
     Parameters
     ---------------------------------------------------------------------------------
-    melFTmix:   Full path of the melodic_FTmix text file
+    melFTmix:   Full path of the melodic_FTmix text file, or the frequency by component array
     TR:     TR (in seconds) of the fMRI data (float)
 
     Returns
@@ -450,7 +493,10 @@ def feature_frequency(melFTmix, TR):
     Ny = old_div(Fs, 2)
 
     # Load melodic_FTmix file
-    FT = np.loadtxt(melFTmix)
+    if isinstance(melFTmix, np.ndarray):
+        FT = melFTmix
+    else:
+        FT = np.loadtxt(melFTmix)
     if len(FT.shape)==1:
         FT = FT[:,np.newaxis]
 
@@ -482,47 +528,32 @@ def compute_edge_mask(in_mask,out_file, num_edge_voxels):
     #custom function for computing edge mask from an input brain mask
     import numpy as np
     import nibabel as nb
+    from rabies.morphology import edge_mask
     img=nb.load(in_mask)
     mask_array=np.asarray(img.dataobj)
-    shape=mask_array.shape
-
-    #iterate through all voxels from the three dimensions and look if it contains surrounding voxels
-    edge_mask=np.zeros(shape, dtype=bool)
-    num_voxel=0
-    while num_voxel<num_edge_voxels:
-        for x in range(shape[0]):
-            for y in range(shape[1]):
-                for z in range(shape[2]):
-                    #only look if the voxel is part of the mask
-                    if mask_array[x,y,z]:
-                        if (mask_array[x-1:x+2,y-1:y+2,z-1:z+2]==0).sum()>0:
-                            edge_mask[x,y,z]=1
-        mask_array=mask_array-edge_mask
-        num_voxel+=1
-
-    nb.Nifti1Image(edge_mask, img.affine, img.header).to_filename(out_file)
+    nb.Nifti1Image(edge_mask(mask_array, num_edge_voxels=num_edge_voxels), img.affine, img.header).to_filename(out_file)
 
 def compute_out_mask(in_mask,out_file):
     #custom function for computing a mask for the outside of the brain
     import numpy as np
     import nibabel as nb
+    from rabies.morphology import out_mask
     img=nb.load(in_mask)
     mask_array=np.asarray(img.dataobj)
+    nb.Nifti1Image(out_mask(mask_array), img.affine, img.header).to_filename(out_file)
 
-    #iterate through all voxels from the three dimensions and look if it contains surrounding voxels
-    out_mask=np.asarray(mask_array==0,dtype=bool)
-    nb.Nifti1Image(out_mask, img.affine, img.header).to_filename(out_file)
-
-def mod_feature_spatial(fslDir, tempDir, melIC, mask_csf, mask_edge, mask_out):
+def mod_feature_spatial(melIC, mask_csf, mask_edge, mask_out):
     #This is a modified version of the orginial ICA-AROMA function where the CSF and edge masks are provided manually.
+    #The thresholded Z-maps and the masks are loaded once, and the masked sums are computed for all ICs at once.
     """
     This function extracts the spatial feature scores. For each IC it determines the fraction of the mixture modeled thresholded Z-maps respecitvely located within the CSF or at the brain edges, using predefined standardized masks.
 
     Parameters
     ---------------------------------------------------------------------------------
-    fslDir:     Full path of the bin-directory of FSL
-    tempDir:    Full path of a directory where temporary files can be stored (called 'temp_IC.nii.gz')
     melIC:      Full path of the nii.gz file containing mixture-modeled threholded (p>0.5) Z-maps, which overlays with the provided masks.
+    mask_csf:   Full path of the CSF mask
+    mask_edge:  Full path of the brain edge mask
+    mask_out:   Full path of the mask for the outside of the brain
 
     Returns
     ---------------------------------------------------------------------------------
@@ -531,106 +562,58 @@ def mod_feature_spatial(fslDir, tempDir, melIC, mask_csf, mask_edge, mask_out):
 
     # Import required modules
     import numpy as np
-    import os
-    import subprocess
-
-    # Get the number of ICs
-    numICs = int(subprocess.getoutput('%sfslinfo %s | grep dim4 | head -n1 | awk \'{print $2}\'' % (fslDir, melIC) ))
-
-    # Loop over ICs
-    edgeFract = np.zeros(numICs)
-    csfFract = np.zeros(numICs)
-    for i in range(0, numICs):
-        # Define temporary IC-file
-        tempIC = os.path.join(tempDir, 'temp_IC.nii.gz')
-
-        # Extract IC from the merged melodic_IC_thr2MNI2mm file
-        os.system(' '.join([os.path.join(fslDir, 'fslroi'),
-                  melIC,
-                  tempIC,
-                  str(i),
-                  '1']))
-
-        # Change to absolute Z-values
-        os.system(' '.join([os.path.join(fslDir, 'fslmaths'),
-                  tempIC,
-                  '-abs',
-                  tempIC]))
-
-        # Get sum of Z-values within the total Z-map (calculate via the mean and number of non-zero voxels)
-        totVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-V | awk \'{print $1}\''])))
-
-        if not (totVox == 0):
-            totMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-M'])))
-        else:
-            print('     - The spatial map of component ' + str(i + 1) + ' is empty. Please check!')
-            totMean = 0
-
-        totSum = totMean * totVox
-
-        # Get sum of Z-values of the voxels located within the CSF (calculate via the mean and number of non-zero voxels)
-        csfVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-k ', mask_csf,
-                                                    '-V | awk \'{print $1}\''])))
-
-        if not (csfVox == 0):
-            csfMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-k ', mask_csf,
-                                                           '-M'])))
-        else:
-            csfMean = 0
+    import nibabel as nb
 
-        csfSum = csfMean * csfVox
+    # Load the absolute Z-values as a voxel by IC matrix
+    IC_array = np.asarray(nb.load(melIC).dataobj, dtype=np.float32)
+    if IC_array.ndim == 3:
+        IC_array = IC_array[..., np.newaxis]
+    numICs = IC_array.shape[3]
+    IC_array = np.abs(IC_array.reshape(-1, numICs))
 
-        # Get sum of Z-values of the voxels located within the Edge (calculate via the mean and number of non-zero voxels)
-        edgeVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                     tempIC,
-                                                     '-k ', mask_edge,
-                                                     '-V | awk \'{print $1}\''])))
-        if not (edgeVox == 0):
-            edgeMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                            tempIC,
-                                                            '-k ', mask_edge,
-                                                            '-M'])))
-        else:
-            edgeMean = 0
+    # Each mask is a row of weights over the voxels, as for the masking with fslstats -k
+    masks = np.stack([np.asarray(nb.load(mask_file).dataobj).reshape(-1) != 0
+                      for mask_file in [mask_csf, mask_edge, mask_out]]).astype(np.float32)
+    if not masks.shape[1] == IC_array.shape[0]:
+        raise ValueError(f"The masks don't match the dimensions of {melIC}.")
 
-        edgeSum = edgeMean * edgeVox
+    return spatial_feature_scores(IC_array, masks)
 
-        # Get sum of Z-values of the voxels located outside the brain (calculate via the mean and number of non-zero voxels)
-        outVox = int(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                    tempIC,
-                                                    '-k ', mask_out,
-                                                    '-V | awk \'{print $1}\''])))
-        if not (outVox == 0):
-            outMean = float(subprocess.getoutput(' '.join([os.path.join(fslDir, 'fslstats'),
-                                                           tempIC,
-                                                           '-k ', mask_out,
-                                                           '-M'])))
-        else:
-            outMean = 0
 
-        outSum = outMean * outVox
+def spatial_feature_scores(IC_array, masks):
+    """Derives the edge and CSF fractions from the absolute thresholded Z-values of each IC.
 
-        # Determine edge and CSF fraction
-        if totSum==csfSum:
-            edgeFract[i] = 1
-            csfFract[i] = 1
-        elif not (totSum == 0):
-            edgeFract[i] = old_div((outSum + edgeSum), (totSum - csfSum))
-            csfFract[i] = old_div(csfSum, totSum)
-        else:
-            edgeFract[i] = 0
-            csfFract[i] = 0
+    Parameters
+    ---------------------------------------------------------------------------------
+    IC_array:   voxel by IC matrix of absolute Z-values
+    masks:      3 by voxel matrix of the CSF, edge and out masks
 
-    # Remove the temporary IC-file
-    os.remove(tempIC)
+    Returns
+    ---------------------------------------------------------------------------------
+    edgeFract:  Array of the edge fraction feature scores for the components
+    csfFract:   Array of the CSF fraction feature scores for the components"""
+
+    # Sum of Z-values within the total Z-map, within the CSF, edge and outside of the brain, and outside of the CSF,
+    # all accumulated in float64 by the same product. A component lies entirely within the CSF only if its sum
+    # outside of the CSF is exactly 0, which avoids comparing two differently rounded sums.
+    numICs = IC_array.shape[1]
+    IC_array = np.asarray(IC_array, dtype=np.float64)
+    masks = np.asarray(masks, dtype=np.float64)
+    totSum, csfSum, edgeSum, outSum, nonCsfSum = np.concatenate(
+        (np.ones([1, masks.shape[1]]), masks, 1-masks[:1]), axis=0).dot(IC_array)
+
+    for i in np.where(totSum == 0)[0]:
+        print('     - The spatial map of component ' + str(i + 1) + ' is empty. Please check!')
+
+    # Determine edge and CSF fraction
+    edgeFract = np.zeros(numICs)
+    csfFract = np.zeros(numICs)
+    all_csf = nonCsfSum == 0
+    valid = ~all_csf & (totSum != 0)
+    edgeFract[all_csf] = 1
+    csfFract[all_csf] = 1
+    edgeFract[valid] = (outSum[valid] + edgeSum[valid]) / nonCsfSum[valid]
+    csfFract[valid] = csfSum[valid] / totSum[valid]
 
     # Return feature scores
     return edgeFract, csfFract
@@ -0,0 +1,245 @@
+###RABIES modification
+# In-process backend for ICA-AROMA, which replaces MELODIC and fsl_regfilt with NumPy/scikit-learn
+# operations on the masked time by voxel matrix, so that no intermediate image is written to disk.
+import os
+import numpy as np
+
+
+def noise_spectrum(num_eigenvalues, n_samples, num_bins=10000):
+    # expected non-zero eigenvalues, in decreasing order, of the covariance of unit variance Gaussian noise 
+    # over num_eigenvalues dimensions estimated from n_samples (Marchenko-Pastur distribution). With more 
+    # dimensions than samples, the n_samples non-zero eigenvalues are those of the covariance over n_samples 
+    # dimensions estimated from num_eigenvalues samples, scaled by num_eigenvalues/n_samples.
+    num_nonzero = min(num_eigenvalues, n_samples)
+    ratio = num_nonzero/max(num_eigenvalues, n_samples)
+    scale = max(num_eigenvalues/n_samples, 1.0)
+    lower, upper = (1-np.sqrt(ratio))**2, (1+np.sqrt(ratio))**2
+    x = np.linspace(lower, upper, num_bins)
+    density = np.sqrt(np.maximum((upper-x)*(x-lower), 0))/(2*np.pi*ratio*np.maximum(x, x[1]))
+    cdf = np.cumsum(density)
+    cdf /= cdf[-1]
+    quantiles = (np.arange(num_nonzero)[::-1]+0.5)/num_nonzero
+    return scale*np.interp(quantiles, cdf, x)
+
+
+def estimate_dimensionality(spectrum, n_samples, num_observations=None, threshold=1.5, tol=1e-6):
+    """ This function estimates the number of components from the eigenvalues of the data covariance.
+    As in MELODIC, the eigenspectrum is adjusted by the spectrum expected from Gaussian noise given
+    the number of samples, which is otherwise spread enough to inflate the estimate. The noise level
+    is the median of the lower half of the adjusted spectrum, and the components are the leading
+    eigenvalues exceeding that level by the given threshold factor.
+
+    Parameters
+    ---------------------------------------------------------------------------------
+    spectrum:   eigenvalues of the covariance matrix
+    n_samples:  number of samples from which the covariance was estimated (i.e. voxels)
+    num_observations:   number of dimensions of the original data, if spectrum only holds its
+        leading eigenvalues (e.g. after a group PCA reduction), which may exceed n_samples
+
+    Returns
+    ---------------------------------------------------------------------------------
+    dim:    the estimated number of components"""
+
+    # the eigenvalues at the precision of the data (e.g. the dimensions removed by detrending) are excluded
+    spectrum = np.sort(np.asarray(spectrum, dtype=np.float64))[::-1]
+    spectrum = spectrum[spectrum > spectrum[0]*tol]
+    if num_observations is None:
+        num_observations = len(spectrum)
+    noise = noise_spectrum(num_observations, n_samples)
+    spectrum = spectrum[:len(noise)]
+    adjusted = spectrum/noise[:len(spectrum)]
+    noise_level = np.median(adjusted[len(adjusted)//2:])
+    above = adjusted > threshold*noise_level
+    dim = len(above) if above.all() else int(np.argmin(above))
+    return max(dim, 1)
+
+
+def spatial_ICA(timeseries, dim=0, random_seed=1, max_iter=500, tol=1e-4, variance_normalize=True, num_observations=None):
+    """ This function derives spatially independent components from a time by voxel matrix, following
+    the steps of MELODIC: voxelwise variance normalization, PCA reduction to the estimated (or specified)
+    dimensionality, FastICA on the whitened data, and conversion of the maps to Z-statistics using the
+    voxelwise standard deviation of the residuals.
+
+    Parameters
+    ---------------------------------------------------------------------------------
+    timeseries: time by voxel matrix, temporally centered
+    dim:        Dimensionality of ICA (0 for an automatic estimate)
+    random_seed:    seed for FastICA
+    variance_normalize: whether to normalize the variance of each voxel first (e.g. not needed if
+        the rows are eigen-timeseries from a group PCA of variance-normalized scans)
+    num_observations:   number of timepoints in the original data, if the rows are the leading
+        eigen-timeseries from a group PCA, for the dimensionality estimate
+
+    Returns
+    ---------------------------------------------------------------------------------
+    mix:        time by component mixing matrix
+    z_maps:     component by voxel matrix of Z-statistical maps"""
+
+    from sklearn.decomposition import FastICA
+
+    num_timepoints, num_voxels = timeseries.shape
+    if variance_normalize:
+        std = timeseries.std(axis=0)
+        std[std == 0] = 1
+        X = timeseries/std
+    else:
+        X = timeseries
+
+    # PCA in the temporal domain from the time by time covariance
+    cov = X.dot(X.T).astype(np.float64)/num_voxels
+    eigenvalues, eigenvectors = np.linalg.eigh(cov)
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+
+    if dim == 0:
+        dim = estimate_dimensionality(eigenvalues, num_voxels, num_observations=num_observations)
+    dim = int(min(dim, (eigenvalues > eigenvalues[0]*1e-6).sum()))
+    print(f'  - deriving {dim} components')
+
+    # whitened data, with unit variance over voxels for each principal component
+    whitening = eigenvectors[:, :dim].T/np.sqrt(eigenvalues[:dim]*num_voxels)[:, np.newaxis]
+    Z = whitening.dot(X)*np.sqrt(num_voxels)
+
+    ica = FastICA(whiten=False, random_state=random_seed, max_iter=max_iter, tol=tol)
+    sources = ica.fit_transform(Z.T).T # component by voxel
+
+    # the mixing matrix is the least squares fit of the maps to the data, and the final maps are
+    # re-estimated from the mixing matrix, as for the temporal regression in MELODIC
+    mix = np.linalg.lstsq(sources.T, X.T, rcond=None)[0].T
+    gram = mix.T.dot(mix)
+    maps = np.linalg.solve(gram, mix.T.dot(X))
+
+    # Z-statistics from the voxelwise residual variance, which is derived from the explained variance
+    residual_var = ((X**2).sum(axis=0) - np.einsum('iv,ij,jv->v', maps, gram, maps))/max(num_timepoints-dim, 1)
+    residual_std = np.sqrt(np.maximum(residual_var, 0))
+    residual_std[residual_std == 0] = np.inf
+    z_maps = maps/residual_std
+    return mix, z_maps
+
+
+def mixture_model_threshold(z_maps, p_threshold=0.5, max_iter=200, tol=1e-6, null_threshold=1.96):
+    """ This function thresholds Z-statistical maps with a mixture model, in the manner of
+    the --mmthresh option of MELODIC. For each map, a three-class Gaussian mixture model is
+    fitted with expectation-maximization, with a central class for the null distribution and
+    two classes for the positive and negative tails. Voxels where the posterior probability of
+    the tail classes is above p_threshold are kept. If the tails vanish (i.e. the model did not
+    converge on an activation), a simple null hypothesis test on |Z| is used instead.
+
+    Returns
+    ---------------------------------------------------------------------------------
+    thresholded component by voxel Z-maps, where the voxels below threshold are set to 0"""
+
+    thresholded = np.zeros(z_maps.shape)
+    for i, z in enumerate(np.asarray(z_maps, dtype=np.float64)):
+        mu0 = np.median(z)
+        sigma0 = max(np.median(np.abs(z-mu0))*1.4826, 1e-6)
+        means = np.array([mu0, mu0+3*sigma0, mu0-3*sigma0])
+        stds = np.array([sigma0, sigma0, sigma0])
+        weights = np.array([0.9, 0.05, 0.05])
+
+        log_likelihood = -np.inf
+        for iteration in range(max_iter):
+            # E-step
+            log_prob = np.log(np.maximum(weights, 1e-300))[:,np.newaxis] - np.log(stds)[:,np.newaxis] \
+                - 0.5*((z[np.newaxis,:]-means[:,np.newaxis])/stds[:,np.newaxis])**2
+            max_log = log_prob.max(axis=0)
+            prob = np.exp(log_prob-max_log)
+            total = prob.sum(axis=0)
+            resp = prob/total
+
+            # M-step
+            counts = resp.sum(axis=1)
+            weights = counts/z.shape[0]
+            valid = counts > 1e-8
+            means[valid] = (resp[valid].dot(z))/counts[valid]
+            stds[valid] = np.sqrt((resp[valid]*(z[np.newaxis,:]-means[valid,np.newaxis])**2).sum(axis=1)/counts[valid])
+            stds = np.maximum(stds, 1e-6)
+
+            prev_log_likelihood = log_likelihood
+            log_likelihood = (max_log + np.log(total)).sum()
+            if np.abs(log_likelihood-prev_log_likelihood) < tol*np.abs(log_likelihood):
+                break
+
+        # the central class is the one with the largest weight
+        null_class = np.argmax(weights)
+        tail_prob = 1-resp[null_class]
+        keep = tail_prob > p_threshold
+        if keep.sum() == 0 or weights[null_class] > 1-1e-6:
+            keep = np.abs(z) > null_threshold
+        thresholded[i, keep] = z[keep]
+    return thresholded
+
+
+def power_spectrum(mix):
+    # power spectrum of each component timecourse, from the lowest frequency to Nyquist, as in melodic_FTmix
+    return (np.abs(np.fft.rfft(mix, axis=0))**2)[1:]
+
+
+def run_ICA_AROMA_native(outDir, timeseries, motion_params, TR, csf_vector, edge_vector, dim=0, random_seed=1):
+    """ This function executes ICA-AROMA on a masked time by voxel matrix in memory, and applies the
+    non-aggressive denoising on that matrix.
+
+    Parameters
+    ---------------------------------------------------------------------------------
+    outDir:     Full path of the output directory for the classification outputs
+    timeseries: time by voxel matrix within the brain mask, temporally detrended. The denoising is
+        applied in place.
+    motion_params:  time by 6 matrix of the realignment parameters
+    TR:     TR (in seconds) of the fMRI data
+    csf_vector:     boolean vector over the voxels of the CSF mask
+    edge_vector:    boolean vector over the voxels of the brain edge mask
+    dim:        Dimensionality of ICA (0 for an automatic estimate)
+
+    Returns
+    ---------------------------------------------------------------------------------
+    timeseries: the denoised timeseries, or None if the ICA failed
+    motionICs:  Array containing the indices of the components identified as motion components"""
+
+    import rabies.confound_correction_pkg.mod_ICA_AROMA.classification_plots as classification_plots
+    import rabies.confound_correction_pkg.mod_ICA_AROMA.ICA_AROMA_functions as aromafunc
+    from rabies.analysis_pkg.least_squares import LeastSquaresSolver
+
+    print('\n------------------------------- RUNNING ICA-AROMA ------------------------------- ')
+    print('--------------- \'ICA-based Automatic Removal Of Motion Artifacts\' --------------- \n')
+    os.makedirs(outDir, exist_ok=True)
+
+    print('Step 1) ICA')
+    try:
+        mix, z_maps = spatial_ICA(timeseries, dim=dim, random_seed=random_seed)
+        IC_thr = mixture_model_threshold(z_maps)
+    except (np.linalg.LinAlgError, ValueError) as e:
+        print(f'ICA FAILED ({e}). RETURNING EMPTY FILES.')
+        return None, None
+    np.savetxt(os.path.join(outDir, 'ICA_mix'), mix)
+
+    print('Step 2) Automatic classification of the components')
+    print('  - extracting the CSF & Edge fraction features')
+    # the maps are restricted to the brain mask, thus the out mask is empty
+    masks = np.stack([csf_vector, edge_vector, np.zeros(csf_vector.shape)]).astype(np.float32)
+    edgeFract, csfFract = aromafunc.spatial_feature_scores(np.abs(IC_thr.T), masks)
+
+    print('  - extracting the Maximum RP correlation feature')
+    maxRPcorr = aromafunc.feature_time_series(mix, motion_params, random_seed=random_seed)
+
+    print('  - extracting the High-frequency content feature')
+    HFC = aromafunc.feature_frequency(power_spectrum(mix), TR)
+
+    print('  - classification')
+    motionICs = np.atleast_1d(aromafunc.classification(outDir, maxRPcorr, edgeFract, HFC, csfFract))
+    classification_plots.classification_plot(os.path.join(outDir, 'classification_overview.txt'),
+                                             outDir)
+
+    if motionICs.size > 0:
+        print('Step 3) Data denoising')
+        # non-aggressive denoising: all components are fitted, and only the motion components are removed
+        solver = LeastSquaresSolver(mix)
+        for start in range(0, timeseries.shape[1], solver.block_size):
+            block = slice(start, min(start+solver.block_size, timeseries.shape[1]))
+            W = solver.solve(timeseries[:, block])
+            timeseries[:, block] -= mix[:, motionICs].dot(W[motionICs])
+    else:
+        print("  - None of the components were classified as motion, so no denoising is applied.")
+
+    print('\n----------------------------------- Finished -----------------------------------\n')
+    return timeseries, motionICs
+###end of RABIES modification
@@ -1,7 +1,8 @@
 import os
+from collections import OrderedDict
 import numpy as np
 import SimpleITK as sitk
-from rabies.analysis_pkg.analysis_math import closed_form
+from rabies.analysis_pkg.least_squares import LeastSquaresSolver, get_solver
 
 
 def tree_list(dirName):
@@ -133,15 +134,44 @@ def prep_CR(bold_file, confounds_file, FD_file, cr_opts):
     else:
         time_range = range(sitk.ReadImage(bold_file).GetSize()[3])
 
-    data_dict = {'FD_trace':FD_trace, 'confounds_array':confounds_array, 'confounds_6rigid_array':confounds_6rigid_array, 'confounds_csv':confounds_file, 'time_range':time_range}
+    data_dict = {'FD_trace':FD_trace, 'confounds_array':confounds_array, 'confounds_6rigid_array':confounds_6rigid_array, 'confounds_csv':confounds_file, 'FD_csv':FD_file, 'time_range':time_range}
     return data_dict
 
+
+def get_strategy_opts(cr_opts, strategy):
+    # returns a copy of the confound correction options, where the options from a --strategies entry are replaced
+    import copy
+    strategy_opts = copy.deepcopy(cr_opts)
+    strategy_opts.strategies = []
+    for key,value in strategy.items():
+        if key=='name':
+            continue
+        elif key in ['FD_censoring', 'FD_threshold', 'DVARS_censoring', 'minimum_timepoint']:
+            strategy_opts.frame_censoring[key] = value
+        else:
+            setattr(strategy_opts, key, value)
+    return strategy_opts
+
+def compute_DVARS(timeseries, block_size=None):
+    # the temporal derivative is computed by blocks of voxels to avoid a copy of the entire timeseries
+    num_voxels = timeseries.shape[1]
+    if block_size is None:
+        block_size = max(num_voxels,1)
+    sum_squares = np.zeros(timeseries.shape[0])
+    for start in range(0, num_voxels, block_size):
+        end = min(start+block_size, num_voxels)
+        derivative = np.diff(timeseries[:,start:end].astype(float), axis=0)
+        sum_squares[1:] += (derivative**2).sum(axis=1)
+    # the first timepoint has no derivative, and is set to 0
+    return np.sqrt(sum_squares/num_voxels)
+
+
 def temporal_censoring(timeseries, FD_trace, 
-        FD_censoring, FD_threshold, DVARS_censoring, minimum_timepoint):
+        FD_censoring, FD_threshold, DVARS_censoring, minimum_timepoint, block_size=None, DVARS=None):
 
-    # compute the DVARS before denoising
-    derivative=np.concatenate((np.empty([1,timeseries.shape[1]]),timeseries[1:,:]-timeseries[:-1,:]))
-    DVARS=np.sqrt((derivative**2).mean(axis=1))
+    # compute the DVARS before denoising, unless it was already computed
+    if DVARS is None:
+        DVARS=compute_DVARS(timeseries, block_size=block_size)
 
     # apply the temporal censoring
     frame_mask = np.ones(timeseries.shape[0]).astype(bool)
@@ -201,6 +231,43 @@ def select_confound_timecourses(conf_list,confounds_file,FD_file):
     return np.asarray(confounds[conf_keys])
 
 
+class MomentAccumulator():
+    """
+    Accumulates the mean and variance of an array provided by blocks of columns (e.g. voxels), 
+    using the pairwise update of Chan et al. (1979). With axis=None, the moments are taken over 
+    all values; with axis=1, they are taken for each row (e.g. timepoint) across columns. The 
+    variance matches numpy's var with ddof=0.
+    """
+
+    def __init__(self, axis=None):
+        self.axis = axis
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+
+    def update(self, block):
+        if block.size == 0:
+            return
+        block_count = block.size if self.axis is None else block.shape[self.axis]
+        block_mean = block.mean(axis=self.axis, keepdims=self.axis is not None)
+        block_M2 = ((block-block_mean)**2).sum(axis=self.axis)
+        if self.axis is not None:
+            block_mean = block_mean.squeeze(axis=self.axis)
+        count = self.count+block_count
+        delta = block_mean-self.mean
+        self.mean = self.mean+delta*(block_count/count)
+        self.M2 = self.M2+block_M2+(delta**2)*(self.count*block_count/count)
+        self.count = count
+
+    @property
+    def var(self):
+        return self.M2/self.count
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
 def remove_trend(timeseries, frame_mask, second_order=False, keep_intercept=False):
     num_timepoints = len(frame_mask)
     
@@ -212,18 +279,10 @@ def remove_trend(timeseries, frame_mask, second_order=False, keep_intercept=Fals
     if second_order:
         X = np.concatenate((X, X**2), axis=1) # second order polynomial
     X = np.concatenate((X, np.ones([X.shape[0], 1])), axis=1) # add an intercept at the end
-    Y=timeseries
-    W = closed_form(X,Y)
-    
-    predicted = X.dot(W)
-    #plt.plot(time[frame_mask], timeseries.mean(axis=1))
-    #plt.plot(time[frame_mask], predicted.mean(axis=1))
-    
-    res = (Y-predicted) # add back the intercept after
-    if keep_intercept:
-        fitted_intercept = X[:,-1:].dot(W[-1:,:]) # predicted intercept
-        res += fitted_intercept
-    #plt.plot(time[frame_mask], res.mean(axis=1))
+    # the same design is re-used for the timeseries and confounds, so its factorization is cached
+    solver = get_solver(X)
+    # if keep_intercept, the fitted intercept is added back after removing the trend
+    res = solver.residuals(timeseries, keep_intercept=keep_intercept)
     return res
     
 
@@ -280,34 +339,99 @@ def lombscargle_mathias_simulate(t, w, cw, sw,theta):
     return y
 
 
-def lombscargle_fill(x,time_step,time_mask):
-    num_timepoints=len(time_mask)
-    time=np.linspace(time_step,num_timepoints*time_step,num_timepoints)
+class LombScargleFill():
+    """
+    Fills censored timepoints by simulating data from the Lomb-Scargle periodogram of the remaining 
+    timepoints (see lombscargle_mathias). For a given time mask and TR, the periodogram fit and the 
+    simulation over the entire time are together a fixed linear operator mapping the masked timepoints 
+    onto the full timeseries. This operator is computed once, so that filling any number of 
+    timeseries only requires a single matrix product, processed by chunks of timeseries.
+
+    time_mask: boolean vector of the timepoints kept
+    time_step: the TR
+    num_freqs: the number of frequencies evaluated between low_freq and high_freq. By default, the 
+        grid resolution is set from the duration of the scan (with an oversampling factor of 4 
+        relative to the 1/duration resolution), within a maximum of max_freqs frequencies.
+    """
 
-    low_freq = 0.005
-    high_freq = 1
-    freqs=np.linspace(low_freq,high_freq,1000)
-    w = freqs*2*np.pi
+    def __init__(self, time_mask, time_step, low_freq=0.005, high_freq=1, num_freqs=None, oversampling=4, max_freqs=1000):
+        self.time_mask = np.asarray(time_mask).astype(bool)
+        num_timepoints = len(self.time_mask)
+        time = np.linspace(time_step,num_timepoints*time_step,num_timepoints)
+
+        if num_freqs is None:
+            freq_resolution = 1/(oversampling*num_timepoints*time_step)
+            num_freqs = int(np.ceil((high_freq-low_freq)/freq_resolution))+1
+            num_freqs = min(max(num_freqs, 2), max_freqs)
+        freqs = np.linspace(low_freq,high_freq,num_freqs)
+        w = freqs*2*np.pi
+        self.w = w
+
+        t = time[self.time_mask]
+        w_t = w[:,np.newaxis].dot(t[np.newaxis,:])
+        theta = (1/(2*w))*np.arctan( \
+            np.sin(2*w_t).sum(axis=1)/ \
+            np.cos(2*w_t).sum(axis=1))
+        del w_t
+
+        # basis over the masked timepoints, used for fitting
+        wt = (t[:,np.newaxis]-theta[np.newaxis,:])*w
+        c_fit = np.cos(wt)
+        s_fit = np.sin(wt)
+        # basis over the entire time, used for simulating
+        wt = (time[:,np.newaxis]-theta[np.newaxis,:])*w
+        c_sim = np.cos(wt)
+        s_sim = np.sin(wt)
+        del wt
+
+        # timepoint by masked timepoint operator
+        self.operator = (c_sim/(c_fit**2).sum(axis=0)).dot(c_fit.T) + (s_sim/(s_fit**2).sum(axis=0)).dot(s_fit.T)
+
+    def fill(self, x, chunk_size=10000):
+        # x: masked timepoints by timeseries
+        time_mask = self.time_mask
+        if not x.shape[0] == time_mask.sum():
+            raise ValueError("Input arrays do not have the same size.")
+        y_fill = np.zeros([len(time_mask), x.shape[1]])
+        for start in range(0, x.shape[1], chunk_size):
+            end = min(start+chunk_size, x.shape[1])
+            x_chunk = x[:,start:end]
+            y = self.operator.dot(x_chunk)
+
+            # standardize according to masked data points
+            y -= y[time_mask].mean(axis=0)
+            y /= y[time_mask].std(axis=0)
+
+            # re-scale according to original mean/std
+            y *= x_chunk.std(axis=0)
+            y += x_chunk.mean(axis=0)
+
+            y_fill[time_mask,start:end] = x_chunk
+            y_fill[time_mask==0,start:end] = y[(time_mask==0)]
+        return y_fill
+
+
+_lombscargle_cache = OrderedDict()
+_lombscargle_cache_size = 4
+
+
+def get_lombscargle_filler(time_mask, time_step):
+    # the operator is cached per time mask and TR, since it is shared across the timeseries, the 
+    # confound regressors, and the repeated fills during confound correction
+    time_mask = np.asarray(time_mask).astype(bool)
+    key = (float(time_step), time_mask.tobytes())
+    if key in _lombscargle_cache:
+        _lombscargle_cache.move_to_end(key)
+        return _lombscargle_cache[key]
+    filler = LombScargleFill(time_mask, time_step)
+    _lombscargle_cache[key] = filler
+    if len(_lombscargle_cache) > _lombscargle_cache_size:
+        _lombscargle_cache.popitem(last=False)
+    return filler
 
-    t = time[time_mask]
-    cw,sw,theta = lombscargle_mathias(t, x, w)
-    
-    # simulate over entire time
-    t=time
-    y = lombscargle_mathias_simulate(t, w, cw, sw,theta)
-    
-    # standardize according to masked data poaxis=0ints    
-    y -= y[time_mask].mean(axis=0)
-    y /= y[time_mask].std(axis=0)
-    
-    # re-scale according to original mean/std
-    y *= x.std(axis=0)
-    y += x.mean(axis=0)
-    
-    y_fill = np.zeros(y.shape)
-    y_fill[time_mask,:] = x
-    y_fill[time_mask==0,:] = y[(time_mask==0)]
-    return y_fill
+
+def lombscargle_fill(x,time_step,time_mask):
+    return get_lombscargle_filler(time_mask, time_step).fill(x)
 
 
 def butterworth(signals, TR, high_pass, low_pass):
@@ -333,36 +457,30 @@ def butterworth(signals, TR, high_pass, low_pass):
 
 
 ######### Taken from https://stackoverflow.com/questions/39543002/returning-a-real-valued-phase-scrambled-timeseries
-def phaseScrambleTS(ts):
-    from scipy.fftpack import fft, ifft
-    """Returns a TS: original TS power is preserved; TS phase is shuffled."""
-    fs = fft(ts, axis=0)
-    pow_fs = np.abs(fs) ** 2.
-    phase_fs = np.angle(fs)
-    phase_fsr = phase_fs.copy()
-    if len(ts) % 2 == 0:
-        phase_fsr_lh = phase_fsr[1:int(len(phase_fsr)/2)]
-    else:
-        phase_fsr_lh = phase_fsr[1:int(len(phase_fsr)/2) + 1]
-    np.random.shuffle(phase_fsr_lh)
-    if len(ts) % 2 == 0:
-        phase_fsr_rh = -phase_fsr_lh[::-1]
-        phase_fsr = np.concatenate((np.array((phase_fsr[0],)), phase_fsr_lh,
-                                    np.array((phase_fsr[int(len(phase_fsr)/2)],)),
-                                    phase_fsr_rh))
-    else:
-        phase_fsr_rh = -phase_fsr_lh[::-1]
-        phase_fsr = np.concatenate((np.array((phase_fsr[0],)), phase_fsr_lh, phase_fsr_rh))
-    fsrp = np.sqrt(pow_fs) * (np.cos(phase_fsr) + 1j * np.sin(phase_fsr))
-    tsrp = ifft(fsrp, axis=0)
-    if not np.allclose(tsrp.imag, np.zeros(tsrp.shape)):
-        max_imag = (np.abs(tsrp.imag)).max()
-        imag_str = f'\nNOTE: a non-negligible imaginary component was discarded.\n\tMax: {max_imag}'
-        print(imag_str)
-    return tsrp.real
-
-
-def phase_randomized_regressors(confounds_array, frame_mask, TR):
+def phase_scramble(ts, rng, num_surrogates=1):
+    """
+    Returns phase-randomized surrogates of each timeseries: the power spectrum is preserved, and the 
+    phases of the positive frequencies (excluding the DC and Nyquist components) are shuffled, then 
+    mirrored onto the negative frequencies so that the surrogate is real.
+
+    ts: time by timeseries array
+    rng: a numpy.random.Generator
+    num_surrogates: the number of surrogates drawn for each timeseries
+    returns an array of shape num_surrogates X time X timeseries, where each surrogate and 
+        timeseries is shuffled independently
+    """
+    num_timepoints = ts.shape[0]
+    fs = np.fft.rfft(ts, axis=0)
+    phase_fs = np.repeat(np.angle(fs)[np.newaxis], num_surrogates, axis=0)
+    num_shuffled = int((num_timepoints-1)/2)
+    # independent permutations of the frequencies for each surrogate and timeseries
+    shuffled = phase_fs[:,1:num_shuffled+1]
+    order = np.argsort(rng.random(shuffled.shape), axis=1)
+    phase_fs[:,1:num_shuffled+1] = np.take_along_axis(shuffled, order, axis=1)
+    return np.fft.irfft(np.abs(fs)*np.exp(1j*phase_fs), n=num_timepoints, axis=1)
+
+
+def phase_randomized_regressors(confounds_array, frame_mask, TR, seed=1, batch_size=20, max_iter=100, corr_thresh=0.1):
     """
     METHOD FROM BRIGHT AND MURPHY 2015
     "The true noise regressors were phase-randomised to create simulated noise regressors with similar frequency 
@@ -373,122 +491,215 @@ def phase_randomized_regressors(confounds_array, frame_mask, TR):
     regressor was r b 0.1). The entire set of resulting time-series was then orthogonalised to the complete set 
     of original regressors to make them independent from the true noise."
 
+    Candidate surrogates are drawn by batches of batch_size for all regressors at once, and the first candidate 
+    below corr_thresh is kept for each regressor, up to max_iter candidates.
     """
     from rabies.confound_correction_pkg.utils import lombscargle_fill
+    rng = np.random.default_rng(seed)
     num_conf = confounds_array.shape[1]
+    solver = LeastSquaresSolver(confounds_array)
     randomized_confounds_array = np.zeros(confounds_array.shape)
-    for n in range(num_conf):
-        corr=1
-        iter=1
-        while(corr>0.1):
-            x=confounds_array[:,n:n+1]
-            # fill missing datapoints to obtain a good reading of frequency spectrum
-            y = lombscargle_fill(x,TR,frame_mask)
-            # phase randomize
-            y_r = phaseScrambleTS(y)
-            # re-apply the time mask to the same number of timepoints
-            y_m = y_r[frame_mask]
-            corr = np.abs(np.corrcoef(x.T,y_m.T)[0,1])
-            if iter>100: # set a maximum number of iterations
-                from nipype import logging
-                log = logging.getLogger('nipype.workflow')
-                log.warning("Could not set uncorrelated random regressors!")
-                break
-            iter += 1
-            
-        #### impose orthogonality relative to every original regressor      
-        y_m -= np.matmul(confounds_array, closed_form(confounds_array, y_m))
-        randomized_confounds_array[:,n:n+1] = y_m
-    return randomized_confounds_array
-
-
-def smooth_image(img, affine, fwhm):
-    # apply nilearn's Gaussian smoothing on a SITK image
-    from nilearn.image.image import _smooth_array
-    from rabies.utils import copyInfo_4DImage, copyInfo_3DImage
+    if num_conf == 0:
+        return randomized_confounds_array
+
+    # fill missing datapoints to obtain a good reading of frequency spectrum
+    y = lombscargle_fill(confounds_array,TR,frame_mask)
+
+    x = confounds_array-confounds_array.mean(axis=0)
+    x_norm = np.sqrt((x**2).sum(axis=0))
+    remaining = np.arange(num_conf)
+    num_drawn = 0
+    while len(remaining)>0 and num_drawn<max_iter:
+        num_surrogates = min(batch_size, max_iter-num_drawn)
+        # phase randomize, then re-apply the time mask to the same number of timepoints
+        y_r = phase_scramble(y[:,remaining], rng, num_surrogates=num_surrogates)[:,frame_mask,:]
+        y_c = y_r-y_r.mean(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = np.abs(np.einsum('ijk,jk->ik', y_c, x[:,remaining])/(np.sqrt((y_c**2).sum(axis=1))*x_norm[remaining]))
+        accepted = ~(corr>corr_thresh) # a NaN correlation (e.g. constant regressor) is not rejected
+        found = accepted.any(axis=0)
+        # the first accepted candidate is kept; if none, the last candidate is kept in case this is the last batch
+        candidate_idx = np.where(found, accepted.argmax(axis=0), num_surrogates-1)
+        randomized_confounds_array[:,remaining] = y_r[candidate_idx,:,np.arange(len(remaining))].T
+        remaining = remaining[~found]
+        num_drawn += num_surrogates
+
+    if len(remaining)>0:
+        from nipype import logging
+        log = logging.getLogger('nipype.workflow')
+        log.warning("Could not set uncorrelated random regressors!")
 
+    #### impose orthogonality relative to every original regressor
+    return solver.residuals(randomized_confounds_array)
+
+
+def fwhm_to_sigma(affine, fwhm):
+    # converts a FWHM in mm into the standard deviation of the Gaussian kernel in voxels, as in nilearn's 
+    # smoothing; the affine is a 3 by 3 matrix of the spacing*direction for the 3 spatial dimensions (x,y,z)
+    vox_size = np.sqrt(np.sum(np.asarray(affine)[:3,:3] ** 2, axis=0))
+    return fwhm / (np.sqrt(8 * np.log(2)) * vox_size)
+
+
+def smooth_array(array, sigma, mask=None, n_procs=1, copy=True, truncate=4.0):
+    """
+    Separable Gaussian smoothing of a 3D array, or of a stack of 3D arrays (e.g. the volumes of a 4D image, or 
+    a set of 3D maps) along the first axis. The 1D Gaussian passes are applied in float32 and in place, and 
+    the volumes are smoothed in parallel with a thread pool. Non-finite values are set to 0 beforehand.
+
+    array: numpy array in SimpleITK axis order, i.e. (z,y,x) or (volume,z,y,x)
+    sigma: the standard deviation of the Gaussian kernel in voxels along (z,y,x)
+    mask: an optional boolean array of shape (z,y,x). Only the bounding box of the mask is smoothed; values 
+        within the bounding box are identical to smoothing the entire volume, and values outside are left unchanged.
+    copy: if False and the array is already float32, the array is smoothed in place
+    """
+    from scipy.ndimage import gaussian_filter1d
+    from concurrent.futures import ThreadPoolExecutor
+
+    if copy:
+        array = np.array(array, dtype=np.float32)
+    else:
+        array = np.asarray(array, dtype=np.float32)
+    stack = array if array.ndim==4 else array[np.newaxis]
+    spatial_shape = stack.shape[1:]
+    sigma = np.asarray(sigma, dtype=float)
+
+    if mask is None:
+        bbox = tuple(slice(0, dim) for dim in spatial_shape)
+        crop_bbox = bbox
+    else:
+        nonzero = np.nonzero(np.asarray(mask).astype(bool))
+        # the crop is padded by the kernel radius, so that the values within the bounding box are exact
+        radius = [int(truncate*s+0.5) if s > 0 else 0 for s in sigma]
+        bbox = tuple(slice(idx.min(), idx.max()+1) for idx in nonzero)
+        crop_bbox = tuple(slice(max(b.start-r, 0), min(b.stop+r, dim)) for b,r,dim in zip(bbox, radius, spatial_shape))
+    # the bounding box relative to the padded crop
+    inner = tuple(slice(b.start-c.start, b.stop-c.start) for b,c in zip(bbox, crop_bbox))
+
+    def smooth_volume(i):
+        crop = np.ascontiguousarray(stack[i][crop_bbox])
+        crop[~np.isfinite(crop)] = 0
+        for axis in range(3):
+            if sigma[axis] > 0:
+                gaussian_filter1d(crop, sigma[axis], axis=axis, output=crop, truncate=truncate)
+        stack[i][bbox] = crop[inner]
+
+    with ThreadPoolExecutor(max_workers=max(int(n_procs), 1)) as executor:
+        list(executor.map(smooth_volume, range(stack.shape[0])))
+    return array
+
+
+def smooth_image(img, affine, fwhm, mask=None, n_procs=1):
+    # apply Gaussian smoothing on a SITK image, matching nilearn's smooth_img
     # the affine is a 3 by 3 matrix of the spacing*direction for the 3 spatial dimensions
     #spacing_3d = np.array(timeseries_img.GetSpacing())[:3]
     #direction_4d = np.array(timeseries_img.GetDirection())
     #direction_3d = np.array([list(direction_4d[:3]),list(direction_4d[4:7]),list(direction_4d[8:11])])
     #affine = direction_3d*spacing_3d
+    from rabies.utils import copyInfo_4DImage, copyInfo_3DImage
 
+    # the sigma is defined along x,y,z, while the SimpleITK array is ordered z,y,x
+    sigma = fwhm_to_sigma(affine, fwhm)[::-1]
     dim = img.GetDimension()
+    smoothed_arr = smooth_array(sitk.GetArrayFromImage(img), sigma, mask=mask, n_procs=n_procs, copy=False)
     if dim==4:
-        array_4d = sitk.GetArrayFromImage(img)
-        arr = array_4d.transpose(3,2,1,0) # re-orient the array to match the affine
-    elif dim==3:
-        array_3d = sitk.GetArrayFromImage(img)
-        arr = array_3d.transpose(2,1,0) # re-orient the array to match the affine
-    smoothed_arr = _smooth_array(arr, affine, fwhm=fwhm, ensure_finite=True, copy=True)
-    if dim==4:
-        smoothed_arr = smoothed_arr.transpose(3,2,1,0)
         smoothed_img = copyInfo_4DImage(sitk.GetImageFromArray(
             smoothed_arr, isVector=False), img, img)
     elif dim==3:
-        smoothed_arr = smoothed_arr.transpose(2,1,0)
         smoothed_img = copyInfo_3DImage(sitk.GetImageFromArray(
             smoothed_arr, isVector=False), img)
 
     return smoothed_img
 
 
-def get_background_mask(bold_file, plotting=False):
+def file_content_hash(filename, chunk_size=2**24):
+    # sha1 digest of a file's content, read by chunks
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def background_cache_file(bold_file):
+    # the background estimates are cached next to the raw input, keyed on the file's content
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(bold_file)), '.rabies_cache')
+    return f'{cache_dir}/background_mask_{file_content_hash(bold_file)}.npz'
+
+
+def compute_background_mask(bold_file):
     """
     Function that takes a 4D EPI timeseries and computes a background mask 
-    excluding contributions from biological tissues.
+    excluding contributions from biological tissues. Returns the mask, the mean 
+    of background voxels across the timeseries, the temporal std map, and the 
+    histogram of background voxel values.
     """
-    import tempfile
-    import matplotlib.pyplot as plt
-    from rabies.utils import run_command
-    from rabies.utils import copyInfo_3DImage
-    tmppath = tempfile.mkdtemp()
+    from rabies.utils import otsu_labels
 
-    data_img = sitk.ReadImage(bold_file, sitk.sitkFloat32)
-    data_array = sitk.GetArrayFromImage(data_img)
+    data_array = sitk.GetArrayFromImage(sitk.ReadImage(bold_file, sitk.sitkFloat32))
     median = np.median(data_array, axis=0)
     temporal_std = data_array.std(axis=0)
-    
-    median_img = copyInfo_3DImage(sitk.GetImageFromArray(
-        median, isVector=False), data_img)
-    sitk.WriteImage(median_img, f'{tmppath}/median.nii.gz')
-    
-    std_img = copyInfo_3DImage(sitk.GetImageFromArray(
-        temporal_std, isVector=False), data_img)
-    sitk.WriteImage(std_img, f'{tmppath}/std_map.nii.gz')
-    
+
     ### first iteration of otsu thresholding, taking the background
-    command = f'ThresholdImage 3 {tmppath}/median.nii.gz {tmppath}/weight.nii.gz Otsu 4'
-    rc = run_command(command)
-    otsu_img = sitk.ReadImage(f'{tmppath}/weight.nii.gz', sitk.sitkFloat32)
-    otsu_array = sitk.GetArrayFromImage(otsu_img)
-    background_mask = otsu_array<1
-    
-    not_zeros_indices = temporal_std!=0
-    background_mask *= not_zeros_indices # make sure there are no 0s
-    
-    volume_img = copyInfo_3DImage(sitk.GetImageFromArray(
-        background_mask.astype(float), isVector=False), otsu_img)
-    sitk.WriteImage(volume_img, f'{tmppath}/background_mask.nii.gz')
-    
+    background_mask = otsu_labels(median, num_thresholds=4)<1
+    background_mask *= temporal_std!=0 # make sure there are no 0s
+
     ### second iteration of otsu thresholding, taking the lower distribution
     # there were residual effects from the brain influencing the distribution
-    command = f'ThresholdImage 3 {tmppath}/std_map.nii.gz {tmppath}/weight2.nii.gz Otsu 1 {tmppath}/background_mask.nii.gz'
-    rc = run_command(command)
-    otsu_img = sitk.ReadImage(f'{tmppath}/weight2.nii.gz', sitk.sitkFloat32)
-    otsu_array = sitk.GetArrayFromImage(otsu_img)
-    background_mask *= (otsu_array<2)
-    mask_img = copyInfo_3DImage(sitk.GetImageFromArray(
-        background_mask.astype(float), isVector=False), otsu_img)
-    sitk.WriteImage(mask_img, f'{tmppath}/background_mask.nii.gz')
-
-    from rabies.visualization import otsu_scaling, plot_3d
-    
+    background_mask *= otsu_labels(temporal_std, num_thresholds=1, mask=background_mask)<2
+
+    background_values = data_array[:,background_mask]
+    scaling_factor = float(background_values.mean())
+    hist_counts, hist_edges = np.histogram(background_values, bins=100)
+    return background_mask, scaling_factor, temporal_std, hist_counts, hist_edges
+
+
+def get_background_mask(bold_file, plotting=False, cache=True):
+    """
+    Returns the background mask of a 4D EPI timeseries, together with the mean of 
+    background voxels across the timeseries. The estimates are cached next to the 
+    input file, keyed on its content, so that they are only derived once per scan.
+    """
+    import matplotlib.pyplot as plt
+    from rabies.utils import copyInfo_3DImage
+
+    cache_file = background_cache_file(bold_file) if cache else None
+    if cache_file is not None and os.path.isfile(cache_file):
+        with np.load(cache_file) as cached:
+            background_mask, scaling_factor, temporal_std, hist_counts, hist_edges = [
+                cached[key] for key in ['background_mask', 'scaling_factor', 'temporal_std', 'hist_counts', 'hist_edges']]
+        scaling_factor = float(scaling_factor)
+    else:
+        background_mask, scaling_factor, temporal_std, hist_counts, hist_edges = compute_background_mask(bold_file)
+        if cache_file is not None:
+            try:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                tmp_file = f'{cache_file}.{os.getpid()}.tmp.npz'
+                np.savez(tmp_file, background_mask=background_mask, scaling_factor=scaling_factor, 
+                         temporal_std=temporal_std, hist_counts=hist_counts, hist_edges=hist_edges)
+                os.replace(tmp_file, cache_file)
+            except OSError: # the input directory may be read-only
+                pass
+
     fig_path = None
     if plotting:
         import pathlib
+        from rabies.visualization import otsu_scaling, plot_3d
         filename_split = pathlib.Path(bold_file).name.rsplit(".nii")[0]
 
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(bold_file)
+        reader.ReadImageInformation()
+        ref_img = sitk.Image([1]*reader.GetDimension(), sitk.sitkUInt8)
+        ref_img.SetSpacing(reader.GetSpacing())
+        ref_img.SetOrigin(reader.GetOrigin())
+        ref_img.SetDirection(reader.GetDirection())
+
+        std_img = copyInfo_3DImage(sitk.GetImageFromArray(
+            temporal_std, isVector=False), ref_img)
+        mask_img = copyInfo_3DImage(sitk.GetImageFromArray(
+            background_mask.astype(float), isVector=False), ref_img)
+
         fig = plt.figure(figsize=(24,6))
         #fig.suptitle(name, fontsize=30, color='white')
         ax1 = fig.add_subplot(3,2,1)
@@ -496,13 +707,11 @@ def get_background_mask(bold_file, plotting=False):
         ax3 = fig.add_subplot(3,2,5)
         ax4 = fig.add_subplot(1,4,3)
 
-        ax4.hist(data_array[:,background_mask].flatten(), bins=100)
+        ax4.hist(hist_edges[:-1], bins=hist_edges, weights=hist_counts)
         ax4.set_title('Noise Distribution (should be Rician)', fontsize=20, color='white')
 
-        
-        from rabies.visualization import otsu_scaling, plot_3d
         planes = ('sagittal', 'coronal', 'horizontal')
-        scaled = otsu_scaling(f'{tmppath}/std_map.nii.gz')
+        scaled = otsu_scaling(std_img)
         
         plot_3d([ax1,ax2,ax3],scaled,fig,vmin=0,vmax=1,cmap='viridis', alpha=1, cbar=False, num_slices=6, planes=planes)
         plot_3d([ax1,ax2,ax3],mask_img,fig=fig,vmin=-1,vmax=1,cmap='bwr', alpha=0.3, cbar=False, num_slices=6, planes=planes)
@@ -510,6 +719,7 @@ def get_background_mask(bold_file, plotting=False):
 
         fig_path = os.path.abspath(f'{filename_split}_background_masking.png')
         fig.savefig(fig_path, bbox_inches='tight')
+        plt.close(fig)
 
-    return background_mask, data_array, fig_path
+    return background_mask, scaling_factor, fig_path
         
@@ -0,0 +1,49 @@
+import numpy as np
+from scipy import ndimage
+
+'''
+BINARY MORPHOLOGY FOR MASKS
+'''
+
+
+def neighbourhood(ndim=3, connectivity=None):
+    # structuring element of the voxel neighbourhood; by default, the full 3x3x3 neighbourhood
+    # (connectivity=ndim), whereas connectivity=1 only includes voxels sharing a face
+    if connectivity is None:
+        connectivity = ndim
+    return ndimage.generate_binary_structure(ndim, connectivity)
+
+
+def erode_mask(mask_array, num_voxels=1, connectivity=None):
+    # erosion by num_voxels layers; the outside of the array is treated as part of the mask,
+    # so that voxels at the array border are not eroded for that reason only
+    mask_array = np.asarray(mask_array).astype(bool)
+    if num_voxels < 1:
+        return mask_array
+    return ndimage.binary_erosion(mask_array, structure=neighbourhood(mask_array.ndim, connectivity),
+                                  iterations=int(num_voxels), border_value=1)
+
+
+def dilate_mask(mask_array, num_voxels=1, connectivity=None):
+    mask_array = np.asarray(mask_array).astype(bool)
+    if num_voxels < 1:
+        return mask_array
+    return ndimage.binary_dilation(mask_array, structure=neighbourhood(mask_array.ndim, connectivity),
+                                   iterations=int(num_voxels))
+
+
+def edge_mask(mask_array, num_edge_voxels=1, connectivity=None):
+    # voxels of the mask within num_edge_voxels of the outside of the mask
+    mask_array = np.asarray(mask_array).astype(bool)
+    return mask_array & ~erode_mask(mask_array, num_edge_voxels, connectivity)
+
+
+def shell_mask(mask_array, num_voxels=1, connectivity=None):
+    # voxels outside of the mask within num_voxels of its edge
+    mask_array = np.asarray(mask_array).astype(bool)
+    return dilate_mask(mask_array, num_voxels, connectivity) & ~mask_array
+
+
+def out_mask(mask_array):
+    # voxels outside of the mask
+    return ~np.asarray(mask_array).astype(bool)
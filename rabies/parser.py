@@ -613,7 +613,7 @@ def get_parser():
             "\n"
         )
     confound_correction.add_argument(
-        '--ica_aroma', type=str, default='apply=false,dim=0,random_seed=1',
+        '--ica_aroma', type=str, default='apply=false,dim=0,random_seed=1,backend=melodic',
         help=
             "Apply ICA-AROMA denoising (Pruim et al. 2015). The original classifier was modified to incorporate \n"
             "rodent-adapted masks and classification hyperparameters.\n"
@@ -622,6 +622,53 @@ def get_parser():
             "* dim: Specify a pre-determined number of MELODIC components to derive. '0' will use an automatic \n"
             " estimator. \n"
             "* random_seed: For reproducibility, this option sets a fixed random seed for MELODIC. \n"
+            "* backend: Specify 'melodic' to run the ICA with FSL's MELODIC, or 'native' to run ICA-AROMA in \n"
+            " memory without FSL. The native backend estimates the dimensionality from the PCA eigenspectrum \n"
+            " adjusted for the expected noise spectrum, derives the components with FastICA, thresholds the maps \n"
+            " with a Gaussian mixture model and applies the non-aggressive denoising directly on the masked \n"
+            " timeseries. \n"
+            "*** Specify 'melodic' or 'native'. If not provided, 'melodic' is used. \n"
+            "(default: %(default)s)\n"
+            "\n"
+        )
+    confound_correction.add_argument(
+        '--voxel_streaming', type=str, default='apply=false,block_size=10000',
+        help=
+            "Apply the voxelwise steps of confound correction (detrending, Lomb-Scargle fill, frequency \n"
+            "filtering, confound regression and scaling) by blocks of voxels. The confound-side operations \n"
+            "are conducted once, and the voxelwise statistics are accumulated block by block, so that the \n"
+            "memory usage is bounded by the block size rather than the whole brain. The timeseries are \n"
+            "then held in float32, and the cleaned timeseries are saved in float32. This is recommended \n"
+            "for high-resolution images. \n"
+            "Whole-brain arrays are still held for: the masked input timeseries (detrended in place when a \n"
+            "single strategy is applied, whereas a censored copy is kept with --strategies), the volumes of the \n"
+            "output image into which the cleaned blocks are written, the filtered timeseries shared across \n"
+            "--strategies, and ICA-AROMA and spatial smoothing, which operate on the whole image. \n"
+            "* apply: apply confound correction by blocks of voxels.\n"
+            "*** Specify 'true' or 'false'. \n"
+            "* block_size: the number of voxels processed at once. \n"
+            "(default: %(default)s)\n"
+            "\n"
+        )
+    confound_correction.add_argument(
+        '--strategies', type=str,
+        nargs="*",  # 0 or more values expected => creates a list
+        default=[],
+        help=
+            "Apply additional confound correction strategies on the same run. Each scan is loaded once, and \n"
+            "the steps which are identical across strategies (frame censoring, detrending, Lomb-Scargle \n"
+            "simulation and frequency filtering) are only computed once. Each strategy is a list of options \n"
+            "which replace the main options, and must provide a name, e.g. \n"
+            "'name=gsr,conf_list=mot_6+global_signal,highpass=0.01'. The outputs of each strategy are saved \n"
+            "in output_dir/strategies/{name}/. The analysis stage is conducted on the outputs from the main \n"
+            "options. \n"
+            "* name: name of the strategy, used for the output folder. Must be unique, and only contain \n"
+            "  letters, numbers, '_' or '-'.\n"
+            "* conf_list: list of nuisance regressors separated by '+', or 'none'. \n"
+            "* highpass/lowpass/smoothing_filter: a float, or 'None'. \n"
+            "* edge_cutoff: a float. \n"
+            "* image_scaling/detrending_order: same choices as --image_scaling and --detrending_order. \n"
+            "* FD_censoring/FD_threshold/DVARS_censoring/minimum_timepoint: same as for --frame_censoring. \n"
             "(default: %(default)s)\n"
             "\n"
         )
@@ -748,6 +795,14 @@ def get_parser():
             "(default: %(default)s)\n"
             "\n"
         )
+    analysis.add_argument("--multi_seed_FC", dest='multi_seed_FC', action='store_true',
+        help=
+            "Compute the connectivity maps of all seeds from --seed_list in a single step for each scan,\n"
+            "instead of one step per seed and scan. Seeds are resampled once, and the correlation maps \n"
+            "are saved as a single 4D file with one volume per seed, in the order of --seed_list.\n"
+            "(default: %(default)s)\n"
+            "\n"
+        )
     analysis.add_argument("--FC_matrix", dest='FC_matrix', action='store_true',
         help=
             "Compute whole-brain connectivity matrices using Pearson's r between ROI timeseries.\n"
@@ -763,6 +818,26 @@ def get_parser():
             "(default: %(default)s)\n"
             "\n"
         )
+    analysis.add_argument(
+        '--voxelwise_FC', type=str, default='dtype=float32,sparsification=none,threshold=0',
+        help=
+            "Options for the voxelwise FC matrix with --ROI_type voxelwise. The matrix is computed by blocks \n"
+            "and written to disk as a voxel by voxel array in {scan}_FC_matrix.npy (load with numpy.load), or \n"
+            "if sparsified, as a sparse adjacency matrix in {scan}_FC_matrix_sparse.npz (scipy CSR format, load \n"
+            "with scipy.sparse.load_npz). Voxelwise matrices are no longer written as .csv files, as with \n"
+            "--ROI_type parcellated.\n"
+            "* dtype: the precision of the stored correlation values. Sparse matrices are stored at least as \n"
+            "  float32, as scipy.sparse does not support float16.\n"
+            "*** Specify 'float32' or 'float16'. \n"
+            "* sparsification: keep only a subset of the edges, stored as a sparse matrix.\n"
+            "*** none: the dense matrix is stored.\n"
+            "*** top_k: keep the k strongest edges for each voxel, where k is set by threshold.\n"
+            "*** absolute: keep the edges with an absolute correlation above threshold.\n"
+            "*** proportional: keep the proportion of strongest edges defined by threshold (between 0 and 1).\n"
+            "* threshold: the value associated to the sparsification method.\n"
+            "(default: %(default)s)\n"
+            "\n"
+        )
     analysis.add_argument(
         "--ROI_csv", action='store', type=Path, 
         default=f"{rabies_path}/DSURQE_40micron_labels.nii.gz",
@@ -773,7 +848,7 @@ def get_parser():
             "\n"
         )
     analysis.add_argument(
-        '--group_ica', type=str, default='apply=false,dim=0,random_seed=1',
+        '--group_ica', type=str, default='apply=false,dim=0,random_seed=1,backend=melodic',
         help=
             "Perform group-ICA using FSL's MELODIC on the whole dataset's cleaned timeseries.\n"
             "Note that confound correction must have been conducted on commonspace outputs.\n"
@@ -782,6 +857,11 @@ def get_parser():
             "* dim: Specify a pre-determined number of MELODIC components to derive. '0' will use an automatic \n"
             " estimator. \n"
             "* random_seed: For reproducibility, this option sets a fixed random seed for MELODIC. \n"
+            "* backend: Specify 'melodic' to run the group-ICA with FSL's MELODIC on the temporal concatenation \n"
+            " of all scans, or 'native' to run it in memory without FSL. The native backend reads one scan at a \n"
+            " time and reduces the data incrementally with MELODIC's Incremental Group-PCA (MIGP), so that the \n"
+            " memory usage does not grow with the number of scans, before running FastICA on the reduced data. \n"
+            "*** Specify 'melodic' or 'native'. If not provided, 'melodic' is used. \n"
             "(default: %(default)s)\n"
             "\n"
         )
@@ -794,6 +874,19 @@ def get_parser():
             "(default: %(default)s)\n"
             "\n"
         )
+    analysis.add_argument(
+        '--group_DR', type=str, default='apply=false,memory_gb=1',
+        help=
+            "Compute dual regression (for --DR_ICA and --data_diagnosis) for all scans within a single \n"
+            "process instead of one process per scan. Scans are streamed from disk and processed in batches \n"
+            "with the same spatial regression projector, which reduces overhead for large datasets. \n"
+            "Requires that confound correction was conducted on commonspace outputs.\n"
+            "* apply: compute dual regression as a group.\n"
+            "*** Specify 'true' or 'false'. \n"
+            "* memory_gb: the maximal amount of memory (in GB) occupied by a batch of scans.\n"
+            "(default: %(default)s)\n"
+            "\n"
+        )
     analysis.add_argument(
         '--NPR_temporal_comp', type=int, default=-1,
         help=
@@ -868,17 +961,80 @@ def read_parser(parser):
             name='frame_censoring')
 
         opts.ica_aroma = parse_argument(opt=opts.ica_aroma, 
-            key_value_pairs = {'apply':['true', 'false'], 'dim':int, 'random_seed':int},
-            name='ica_aroma')
+            key_value_pairs = {'apply':['true', 'false'], 'dim':int, 'random_seed':int, 'backend':['melodic', 'native']},
+            name='ica_aroma', defaults={'backend':'melodic'})
+
+        opts.voxel_streaming = parse_argument(opt=opts.voxel_streaming, 
+            key_value_pairs = {'apply':['true', 'false'], 'block_size':int},
+            name='voxel_streaming')
+
+        opts.strategies = [parse_strategy(opt=strategy) for strategy in opts.strategies]
+        strategy_names = [strategy['name'] for strategy in opts.strategies]
+        if not len(set(strategy_names))==len(strategy_names):
+            raise ValueError(f"Each of the --strategies must have a different name, but {strategy_names} were provided.")
 
     elif opts.rabies_stage == 'analysis':
         opts.group_ica = parse_argument(opt=opts.group_ica, 
-            key_value_pairs = {'apply':['true', 'false'], 'dim':int, 'random_seed':int},
-            name='group_ica')
+            key_value_pairs = {'apply':['true', 'false'], 'dim':int, 'random_seed':int, 'backend':['melodic', 'native']},
+            name='group_ica', defaults={'backend':'melodic'})
+
+        opts.voxelwise_FC = parse_argument(opt=opts.voxelwise_FC, 
+            key_value_pairs = {'dtype':['float32', 'float16'], 'sparsification':['none', 'top_k', 'absolute', 'proportional'],
+                'threshold':float},
+            name='voxelwise_FC')
+
+        opts.group_DR = parse_argument(opt=opts.group_DR, 
+            key_value_pairs = {'apply':['true', 'false'], 'memory_gb':float},
+            name='group_DR')
 
     return opts
 
-def parse_argument(opt, key_value_pairs, name):
+def parse_strategy(opt):
+    # parses an entry of --strategies, where only the provided options are returned
+    conf_choices = ["WM_signal", "CSF_signal", "vascular_signal", "global_signal", "aCompCor", "mot_6", "mot_24", "mean_FD"]
+    scaling_choices = ["None", "background_noise", "global_variance", "voxelwise_standardization", "grand_mean_scaling", "voxelwise_mean"]
+    def optional_float(value):
+        if value=='None':
+            return None
+        return float(value)
+    key_value_pairs = {'name':str, 'conf_list':'conf_list', 'highpass':optional_float, 'lowpass':optional_float, 
+        'smoothing_filter':optional_float, 'edge_cutoff':float, 'image_scaling':scaling_choices, 'detrending_order':['linear', 'quadratic'],
+        'FD_censoring':['true', 'false'], 'FD_threshold':float, 'DVARS_censoring':['true', 'false'], 'minimum_timepoint':int}
+    key_list = list(key_value_pairs.keys())
+    opt_dict = {}
+    for e in opt.split(','):
+        s = e.split('=')
+        if not len(s)==2:
+            raise ValueError(f"Provided option must follow the 'key=value' syntax, {e} was found instead.")
+        [key,value] = s
+        if not key in key_list:
+            raise ValueError(f"The provided key {key} is not part of the available options {key_list} for --strategies.")
+        if key_value_pairs[key]=='conf_list':
+            value = [] if value=='none' else value.split('+')
+            for conf in value:
+                if not conf in conf_choices:
+                    raise ValueError(f"The provided regressor {conf} is not part of the available options {conf_choices}.")
+        elif isinstance(key_value_pairs[key], list):
+            if not value in key_value_pairs[key]:
+                raise ValueError(f"The provided value {value} is not part of the available options {key_value_pairs[key]} for the key {key}.")
+            if value=='true':
+                value=True
+            elif value=='false':
+                value=False
+        else:
+            value = key_value_pairs[key](value)
+        opt_dict[key]=value
+
+    if not 'name' in opt_dict.keys():
+        raise ValueError(f"A name must be provided for each of the --strategies, but {opt} has none.")
+    # the name is used for workflow node names and output folders
+    import re
+    if not re.fullmatch('[A-Za-z0-9_-]+', opt_dict['name']):
+        raise ValueError(f"The name {opt_dict['name']} of --strategies must only contain letters, numbers, '_' or '-'.")
+    return opt_dict
+
+def parse_argument(opt, key_value_pairs, name, defaults=None):
+    # keys from defaults are optional, and take their default value when not provided
     key_list = list(key_value_pairs.keys())
     l = opt.split(',')
     opt_dict = {}
@@ -904,5 +1060,8 @@ def parse_argument(opt, key_value_pairs, name):
 
     for key in key_list:
         if not key in list(opt_dict.keys()):
+            if defaults is not None and key in defaults:
+                opt_dict[key]=defaults[key]
+                continue
             raise ValueError(f"The key {key} is missing from the necessary attributes for --{name}.")
     return opt_dict
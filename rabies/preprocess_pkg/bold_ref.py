@@ -8,7 +8,7 @@ from nipype.interfaces.base import (
 )
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
-from rabies.utils import copyInfo_4DImage, copyInfo_3DImage, run_command
+from rabies.utils import copyInfo_4DImage, copyInfo_3DImage, run_command, Image4D
 from .hmc import antsMotionCorr
 
 def init_bold_reference_wf(opts, name='gen_bold_ref'):
@@ -100,14 +100,12 @@ class EstimateReferenceImage(BaseInterface):
         from nipype import logging
         log = logging.getLogger('nipype.workflow')
 
-        in_nii = sitk.ReadImage(self.inputs.in_file,
-                                self.inputs.rabies_data_type)
-        if not in_nii.GetDimension()==4:
-            raise ValueError(f"Input image {self.inputs.in_file} is not 4-dimensional.")
+        # only the frames used for the reference are read from the file
+        in_img = Image4D(self.inputs.in_file, self.inputs.rabies_data_type)
+        in_nii = in_img.ref_img
+        data_slice = in_img.get_frames_array(0, 50)
 
-        data_slice = sitk.GetArrayFromImage(in_nii)[:50, :, :, :]
-
-        n_volumes_to_discard = _get_vols_to_discard(in_nii)
+        n_volumes_to_discard = _get_vols_to_discard(data_slice)
 
         filename_split = pathlib.Path(self.inputs.in_file).name.rsplit(".nii")
         out_ref_fname = os.path.abspath(
@@ -121,8 +119,7 @@ class EstimateReferenceImage(BaseInterface):
 
             out_bold_file = os.path.abspath(
                 f'{filename_split[0]}_cropped_dummy.nii.gz')
-            img_array = sitk.GetArrayFromImage(
-                in_nii)[n_volumes_to_discard:, :, :, :]
+            img_array = in_img.get_frames_array(n_volumes_to_discard, in_img.num_volumes)
 
             image_4d = copyInfo_4DImage(sitk.GetImageFromArray(
                 img_array, isVector=False), in_nii, in_nii)
@@ -137,7 +134,7 @@ class EstimateReferenceImage(BaseInterface):
                     "Detected no dummy scans. Generating the ref EPI based on multiple volumes.")
             # if no dummy scans, will generate a median from a subset of max 100
             # slices of the time series
-            if in_nii.GetSize()[-1] > 100:
+            if in_img.num_volumes > 100:
                 slice_fname = os.path.abspath("slice.nii.gz")
                 image_4d = copyInfo_4DImage(sitk.GetImageFromArray(
                     data_slice[20:100, :, :, :], isVector=False), in_nii, in_nii)
@@ -194,12 +191,12 @@ class EstimateReferenceImage(BaseInterface):
                 'bold_file': getattr(self, 'bold_file')}
 
 
-def _get_vols_to_discard(img):
+def _get_vols_to_discard(data_slice):
     '''
-    Takes a nifti file, extracts the mean signal of the first 50 volumes and computes which are outliers.
+    Takes the array of the first 50 volumes, extracts the mean signal and computes which are outliers.
     is_outlier function: computes Modified Z-Scores (https://www.itl.nist.gov/div898/handbook/eda/section3/eda35h.htm) to determine which volumes are outliers.
     '''
     from nipype.algorithms.confounds import is_outlier
-    data_slice = sitk.GetArrayFromImage(img)[:50, :, :, :]
+    data_slice = data_slice[:50, :, :, :]
     global_signal = data_slice.mean(axis=-1).mean(axis=-1).mean(axis=-1)
     return is_outlier(global_signal)
@@ -84,43 +84,30 @@ class EstimateConfounds(BaseInterface):
     def _run_interface(self, runtime):
         import numpy as np
         import os
-        from rabies.utils import run_command
         import pathlib  # Better path manipulation
         filename_split = pathlib.Path(self.inputs.bold).name.rsplit(".nii")
 
-        # generate a .nii file representing the positioning or framewise displacement for each voxel within the brain_mask
-        # first the voxelwise positioning map
-        command = f'antsMotionCorrStats -m {self.inputs.movpar_file} -o {filename_split[0]}_pos_file.csv -x {self.inputs.raw_brain_mask} \
-                    -d {self.inputs.raw_bold} -s {filename_split[0]}_pos_voxelwise.nii.gz'
-        rc = run_command(command)
-        pos_voxelwise = os.path.abspath(
-            f"{filename_split[0]}_pos_file.nii.gz")
+        # generate .nii files representing the positioning and framewise displacement for each voxel within the brain_mask,
+        # together with the mean and max framewise displacement for each frame
+        [FD_csv, FD_voxelwise, pos_voxelwise] = compute_motion_displacement(self.inputs.movpar_file, 
+                                    self.inputs.raw_brain_mask, self.inputs.raw_bold, filename_split[0])
 
-        # then the voxelwise framewise displacement map
-        command = f'antsMotionCorrStats -m {self.inputs.movpar_file} -o {filename_split[0]}_FD_file.csv -x {self.inputs.raw_brain_mask} \
-                    -d {self.inputs.raw_bold} -s {filename_split[0]}_FD_voxelwise.nii.gz -f 1'
-        rc = run_command(command)
-
-        FD_csv = os.path.abspath(f"{filename_split[0]}_FD_file.csv")
-        FD_voxelwise = os.path.abspath(f"{filename_split[0]}_FD_file.nii.gz")
+        # the EPI is read once, and the mask traces and aCompCor timeseries are derived from the voxels 
+        # within the union of the masks
+        mask_files = {'WM_signal':self.inputs.WM_mask, 'CSF_signal':self.inputs.CSF_mask, 
+                      'vascular_signal':self.inputs.vascular_mask, 'global_signal':self.inputs.brain_mask}
+        timeseries, membership, noise_idx = load_confound_timeseries(self.inputs.bold, mask_files, 
+                                    noise_masks=[self.inputs.WM_mask, self.inputs.CSF_mask], rabies_data_type=self.inputs.rabies_data_type)
+        mask_traces = extract_mask_traces(timeseries, membership)
 
         confounds = []
         csv_columns = []
-        WM_signal = extract_mask_trace(self.inputs.bold, self.inputs.WM_mask)
-        confounds.append(WM_signal)
-        csv_columns += ['WM_signal']
-
-        CSF_signal = extract_mask_trace(self.inputs.bold, self.inputs.CSF_mask)
-        confounds.append(CSF_signal)
-        csv_columns += ['CSF_signal']
-
-        vascular_signal = extract_mask_trace(
-            self.inputs.bold, self.inputs.vascular_mask)
-        confounds.append(vascular_signal)
-        csv_columns += ['vascular_signal']
+        for key in ['WM_signal', 'CSF_signal', 'vascular_signal']:
+            confounds.append(mask_traces[key])
+            csv_columns += [key]
 
-        [aCompCor, num_comp] = compute_aCompCor(
-            self.inputs.bold, self.inputs.WM_mask, self.inputs.CSF_mask, method=self.inputs.aCompCor_method, rabies_data_type=self.inputs.rabies_data_type)
+        [aCompCor, num_comp] = compute_aCompCor(timeseries[:,noise_idx], method=self.inputs.aCompCor_method)
+        del timeseries
         for param in range(aCompCor.shape[1]):
             confounds.append(aCompCor[:, param])
         comp_column = []
@@ -128,9 +115,7 @@ class EstimateConfounds(BaseInterface):
             comp_column.append('aCompCor'+str(comp+1))
         csv_columns += comp_column
 
-        global_signal = extract_mask_trace(
-            self.inputs.bold, self.inputs.brain_mask)
-        confounds.append(global_signal)
+        confounds.append(mask_traces['global_signal'])
         csv_columns += ['global_signal']
         motion_24,motion_24_header = motion_24_params(self.inputs.movpar_file)
         for param in range(motion_24.shape[1]):
@@ -153,6 +138,88 @@ class EstimateConfounds(BaseInterface):
                 'FD_voxelwise': getattr(self, 'FD_voxelwise')}
 
 
+def mask_physical_points(mask_array, ref_image):
+    '''
+    Returns the physical coordinates (voxel by xyz) of the voxels within a mask array, 
+    given the geometry of the reference image (which can be a 3D image, or an image reader for a 4D image).
+    '''
+    import numpy as np
+    spacing = np.array(ref_image.GetSpacing()[:3])
+    origin = np.array(ref_image.GetOrigin()[:3])
+    ndim = len(ref_image.GetSpacing())
+    direction = np.array(ref_image.GetDirection()).reshape(ndim, ndim)[:3, :3]
+    # the numpy array is indexed z,y,x, whereas image indices are x,y,z
+    indices = np.stack(np.nonzero(mask_array)[::-1], axis=1)
+    return origin + (indices*spacing).dot(direction.T)
+
+
+def motion_displacement(transforms, points):
+    '''
+    Computes, for each frame, the displacement of the given physical points (voxel by xyz) by the motion 
+    transform of the frame, as in antsMotionCorrStats. The positioning is the distance between each point 
+    and its transformed location, and the framewise displacement is the distance between the point transformed 
+    by the current and by the previous frame's transform (0 for the first frame). Both are returned as 
+    frame by voxel arrays.
+    '''
+    import numpy as np
+    num_frames = len(transforms)
+    pos = np.zeros([num_frames, points.shape[0]], dtype=np.float32)
+    FD = np.zeros([num_frames, points.shape[0]], dtype=np.float32)
+    previous = None
+    for i, transform in enumerate(transforms):
+        # the transform maps x to A(x-c)+t+c, for the matrix A, translation t and center c
+        A = np.array(transform.GetMatrix()).reshape(3, 3)
+        center = np.array(transform.GetCenter())
+        offset = np.array(transform.GetTranslation()) + center - A.dot(center)
+        moved = points.dot(A.T) + offset
+        pos[i] = np.sqrt(((moved-points)**2).sum(axis=1))
+        if previous is not None:
+            FD[i] = np.sqrt(((moved-previous)**2).sum(axis=1))
+        previous = moved
+    return pos, FD
+
+
+def compute_motion_displacement(movpar_file, mask_file, ref_bold, filename_template):
+    '''
+    Derives from the motion parameters the voxelwise positioning and framewise displacement maps within 
+    the brain mask of the raw EPI, as well as a CSV file with the mean and max framewise displacement 
+    across voxels for each frame. Only the header of the raw EPI is read, to obtain the 4D geometry.
+    '''
+    import os
+    import numpy as np
+    import pandas as pd
+    import SimpleITK as sitk
+    from rabies.utils import copyInfo_4DImage
+    from rabies.preprocess_pkg.hmc import get_motcorr_transforms
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(ref_bold)
+    reader.ReadImageInformation()
+    num_volumes = reader.GetSize()[3] if reader.GetDimension() == 4 else None
+    transforms = get_motcorr_transforms(movpar_file, num_volumes=num_volumes)
+
+    mask_img = sitk.ReadImage(mask_file)
+    mask_array = sitk.GetArrayFromImage(mask_img) != 0
+    points = mask_physical_points(mask_array, mask_img)
+    pos, FD = motion_displacement(transforms, points)
+
+    FD_csv = os.path.abspath(f"{filename_template}_FD_file.csv")
+    df = pd.DataFrame(np.stack([FD.mean(axis=1), FD.max(axis=1)], axis=1).astype(np.float64), columns=['Mean', 'Max'])
+    df.to_csv(FD_csv, index=False)
+
+    outputs = [FD_csv]
+    for voxelwise, suffix in zip([FD, pos], ['FD_file', 'pos_file']):
+        array = np.zeros([voxelwise.shape[0]]+list(mask_array.shape), dtype=np.float32)
+        array[:, mask_array] = voxelwise
+        image = sitk.GetImageFromArray(array, isVector=False)
+        if num_volumes is not None:
+            copyInfo_4DImage(image, mask_img, reader)
+        out_file = os.path.abspath(f"{filename_template}_{suffix}.nii.gz")
+        sitk.WriteImage(image, out_file)
+        outputs.append(out_file)
+    return outputs
+
+
 def write_confound_csv(confound_array, column_names, filename_template):
     import pandas as pd
     df = pd.DataFrame(confound_array)
@@ -162,47 +229,92 @@ def write_confound_csv(confound_array, column_names, filename_template):
     return csv_path
 
 
-def compute_aCompCor(bold, WM_mask, CSF_mask, method='50%', rabies_data_type=8):
+def load_confound_timeseries(bold, mask_files, noise_masks=[], rabies_data_type=8):
+    '''
+    Reads the 4D EPI once, and returns the timeseries of the voxels within the union of the masks 
+    (time by voxel), together with the membership of these voxels to each mask, and the indices 
+    of the voxels within the noise ROI (the union of noise_masks) used for aCompCor.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+
+    mask_arrays = {key:sitk.GetArrayFromImage(sitk.ReadImage(mask_files[key], rabies_data_type)) 
+                   for key in mask_files.keys()}
+    noise_arrays = [sitk.GetArrayFromImage(sitk.ReadImage(mask, rabies_data_type)) for mask in noise_masks]
+    noise_mask = (np.sum(noise_arrays, axis=0) > 0) if len(noise_arrays)>0 else None
+
+    union = np.zeros(list(mask_arrays.values())[0].shape, dtype=bool)
+    for mask_array in mask_arrays.values():
+        union |= mask_array != 0
+    if noise_mask is not None:
+        union |= noise_mask
+
+    data_array = sitk.GetArrayFromImage(sitk.ReadImage(bold, sitk.sitkFloat32))
+    if not data_array.shape[1:] == union.shape:
+        raise ValueError(f"The dimensions of {bold} don't match the masks.")
+    timeseries = data_array.reshape(data_array.shape[0], -1)[:, np.flatnonzero(union)]
+    del data_array
+
+    membership = {key:(mask_arrays[key] != 0)[union] for key in mask_arrays.keys()}
+    noise_idx = np.flatnonzero(noise_mask[union]) if noise_mask is not None else np.array([], dtype=int)
+    return timeseries, membership, noise_idx
+
+
+def extract_mask_traces(timeseries, membership):
+    '''
+    Computes the mean trace of each mask with a single product between the timeseries and a 
+    voxel by mask matrix of weights (1/number of voxels for the voxels of the mask).
+    '''
+    import numpy as np
+    keys = list(membership.keys())
+    weights = np.stack([membership[key] for key in keys], axis=1).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights /= weights.sum(axis=0) # an empty mask gives a NaN trace
+    traces = timeseries.dot(weights)
+    return {key:traces[:,i] for i,key in enumerate(keys)}
+
+
+def compute_aCompCor(noise_timeseries, method='50%'):
     '''
     Compute the anatomical comp corr through PCA over a defined ROI (mask) within
     the EPI, and retain either the first 5 components' time series or up to 50% of
     the variance explained as in Muschelli et al. 2014.
+    The voxel timeseries (time by voxel) are linearly detrended and standardized, and a single 
+    eigendecomposition of their time by time Gram matrix (i.e. the thin SVD of the timeseries) 
+    provides both the explained variance used for the number of components and the component 
+    timecourses.
     '''
-    import SimpleITK as sitk
-    from sklearn.decomposition import PCA
-
-    WM_data = sitk.GetArrayFromImage(sitk.ReadImage(
-        WM_mask, rabies_data_type))
-    CSF_data = sitk.GetArrayFromImage(sitk.ReadImage(
-        CSF_mask, rabies_data_type))
-    combined = (WM_data+CSF_data) > 0
-    from rabies.utils import copyInfo_3DImage
-    noise_mask = copyInfo_3DImage(sitk.GetImageFromArray(combined.astype(
-        int), isVector=False), sitk.ReadImage(WM_mask, sitk.sitkInt16))
-    sitk.WriteImage(noise_mask, 'noise_mask.nii.gz')
-
-    from nilearn.input_data import NiftiMasker
+    import numpy as np
+
     # detrend and standardize the voxel time series before PCA
-    masker = NiftiMasker(mask_img='noise_mask.nii.gz',
-                         standardize=True, detrend=True)
-    mask_timeseries = masker.fit_transform(
-        bold)  # shape n_timepoints x n_voxels
+    Y = np.array(noise_timeseries, dtype=np.float64)
+    num_timepoints = Y.shape[0]
+    Y -= Y.mean(axis=0)
+    t = np.arange(num_timepoints, dtype=np.float64)
+    t -= t.mean()
+    Y -= np.outer(t, t.dot(Y)/t.dot(t))
+    std = Y.std(axis=0)
+    std[std == 0] = 1
+    Y /= std
+
+    eigenvalues, eigenvectors = np.linalg.eigh(Y.dot(Y.T))
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues = np.maximum(eigenvalues[order], 0)
+    eigenvectors = eigenvectors[:, order]
 
     if method == '50%':
-        pca = PCA()
-        pca.fit(mask_timeseries)
-        explained_variance = pca.explained_variance_ratio_
-        cum_var = 0
-        num_comp = 0
+        explained_variance = eigenvalues/eigenvalues.sum()
         # evaluate the # of components to explain 50% of the variance
-        while(cum_var <= 0.5):
-            cum_var += explained_variance[num_comp]
-            num_comp += 1
+        num_comp = int(np.searchsorted(np.cumsum(explained_variance), 0.5, side='right'))+1
     elif method == 'first_5':
         num_comp = 5
+    num_comp = min(num_comp, num_timepoints)
 
-    pca = PCA(n_components=num_comp)
-    comp_timeseries = pca.fit_transform(mask_timeseries)
+    # the component timecourses U*S, with the sign set so that the largest absolute value is positive
+    comp_timeseries = eigenvectors[:, :num_comp]*np.sqrt(eigenvalues[:num_comp])
+    signs = np.sign(comp_timeseries[np.abs(comp_timeseries).argmax(axis=0), range(num_comp)])
+    signs[signs == 0] = 1
+    comp_timeseries *= signs
     from nipype import logging
     log = logging.getLogger('nipype.workflow')
     log.debug("Extracting "+str(num_comp)+" components for aCompCorr.")
@@ -252,14 +364,6 @@ def extract_rigid_movpar(movpar_csv):
     return movpar
 
 
-def extract_mask_trace(bold, mask):
-    import numpy as np
-    import nilearn.masking
-    mask_signal = nilearn.masking.apply_mask(bold, mask)
-    mean_trace = np.mean(mask_signal, 1)
-    return mean_trace
-
-
 def extract_labels(atlas):
     import nilearn.regions
     nilearn.regions.connected_label_regions(atlas)
@@ -6,7 +6,7 @@ from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
     File, BaseInterface
 )
-from rabies.utils import run_command
+from rabies.utils import run_command, Image4D
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 
@@ -190,6 +190,46 @@ class antsMotionCorr(BaseInterface):
                 'avg_image': getattr(self, 'avg_image')}
 
 
+def read_motcorr_params(motcorr_params):
+    # reads the MOCOparams.csv file from antsMotionCorr, and returns the transform parameters with one row per volume;
+    # the first two columns (MetricPre and MetricPost) are dropped
+    params = np.loadtxt(motcorr_params, delimiter=',', skiprows=1, ndmin=2)
+    return params[:,2:]
+
+
+def get_motcorr_transforms(motcorr_params, num_volumes=None):
+    # builds in memory the transform of each volume from the antsMotionCorr parameters, in the same way as
+    # antsMotionCorrStats: 6 parameters define a rigid Euler3DTransform (3 rotations then 3 translations),
+    # and 12 parameters an affine transform (9 matrix elements then 3 translations), centered at the origin
+    params = read_motcorr_params(motcorr_params)
+    if num_volumes is not None and not params.shape[0] == num_volumes:
+        raise ValueError(
+            f"The motion parameters {motcorr_params} have {params.shape[0]} volumes, while {num_volumes} were expected.")
+
+    transforms = []
+    for volume_params in params:
+        if len(volume_params) == 6:
+            transform = sitk.Euler3DTransform()
+        elif len(volume_params) == 12:
+            transform = sitk.AffineTransform(3)
+        else:
+            raise ValueError(
+                f"Unrecognized number of motion parameters ({len(volume_params)}) in {motcorr_params}.")
+        transform.SetParameters([float(param) for param in volume_params])
+        transforms.append(transform)
+    return transforms
+
+
+def write_motcorr_transforms(motcorr_params, out_prefix='motcorr_vol'):
+    # writes the transform of each volume as a .mat file, for tools that require transform files
+    transform_files = []
+    for x, transform in enumerate(get_motcorr_transforms(motcorr_params)):
+        transform_file = os.path.abspath(f'{out_prefix}{x}.mat')
+        sitk.WriteTransform(transform, transform_file)
+        transform_files.append(transform_file)
+    return transform_files
+
+
 def register_slice(fixed_image, moving_image):
     # function for 2D registration
     dimension = 2
@@ -229,8 +269,8 @@ def slice_specific_registration(i, ref_file, timeseries_file):
 
     log.debug('Slice-specific correction on volume '+str(i+1))
     ref_image = sitk.ReadImage(ref_file, sitk.sitkFloat32)
-    timeseries_image = sitk.ReadImage(timeseries_file, sitk.sitkFloat32)
-    volume_array = sitk.GetArrayFromImage(timeseries_image)[i, :, :, :]
+    # only the frames up to volume i are read, as a single frame range
+    volume_array = Image4D(timeseries_file, sitk.sitkFloat32).get_frames_array(i, i+1)[0]
 
     for j in range(volume_array.shape[1]):
         slice_array = volume_array[:, j, :]
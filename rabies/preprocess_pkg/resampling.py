@@ -6,7 +6,7 @@ from nipype.interfaces.base import (
 )
 
 from .bold_ref import init_bold_reference_wf
-from rabies.utils import slice_applyTransforms, Merge
+from rabies.utils import ResampleVolumes
 
 def init_bold_preproc_trans_wf(opts, resampling_dim, name='bold_native_trans_wf'):
     """
@@ -78,13 +78,13 @@ def init_bold_preproc_trans_wf(opts, resampling_dim, name='bold_native_trans_wf'
             fields=['bold', 'bold_ref', 'brain_mask', 'WM_mask', 'CSF_mask', 'vascular_mask', 'labels', 'raw_brain_mask']),
         name='outputnode')
 
-    bold_transform = pe.Node(slice_applyTransforms(
-        rabies_data_type=opts.data_type), name='bold_transform', mem_gb=1*opts.scale_min_memory)
+    resampling_n_procs = int(opts.local_threads/4)+1
+    bold_transform = pe.Node(ResampleVolumes(
+        rabies_data_type=opts.data_type, clip_negative=True, n_procs=resampling_n_procs), name='bold_transform', 
+        mem_gb=4*opts.scale_min_memory, n_procs=resampling_n_procs)
     bold_transform.inputs.apply_motcorr = (not opts.apply_slice_mc)
     bold_transform.inputs.resampling_dim = resampling_dim
-
-    merge = pe.Node(Merge(rabies_data_type=opts.data_type, clip_negative=True), name='merge', mem_gb=4*opts.scale_min_memory)
-    merge.plugin_args = {
+    bold_transform.plugin_args = {
         'qsub_args': f'-pe smp {str(3*opts.min_proc)}', 'overwrite': True}
 
     # Generate a new BOLD reference
@@ -115,17 +115,16 @@ def init_bold_preproc_trans_wf(opts, resampling_dim, name='bold_native_trans_wf'
     raw_brain_mask.inputs.mask = str(opts.brain_mask)
 
     workflow.connect([
-        (inputnode, merge, [('name_source', 'header_source')]),
         (inputnode, bold_transform, [
+            ('name_source', 'name_source'),
             ('bold_file', 'in_file'),
             ('motcorr_params', 'motcorr_params'),
             ('transforms_list', 'transforms'),
             ('inverses', 'inverses'),
             ('ref_file', 'ref_file')
             ]),
-        (bold_transform, merge, [('out_files', 'in_files')]),
-        (merge, bold_reference_wf, [('out_file', 'inputnode.bold_file')]),
-        (merge, outputnode, [('out_file', 'bold')]),
+        (bold_transform, bold_reference_wf, [('out_file', 'inputnode.bold_file')]),
+        (bold_transform, outputnode, [('out_file', 'bold')]),
         (inputnode, brain_mask_to_EPI, [
             ('name_source', 'name_source'),
             ('mask_transforms_list', 'transforms'),
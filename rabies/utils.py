@@ -12,31 +12,120 @@ from nipype.interfaces.base import (
 ######################
 
 
+class Masker():
+    """
+    Extracts the voxels within a brain mask from 3D or 4D images, and reconstructs images from 
+    voxel vectors. The mask is read once, and voxels are gathered/scattered in a single vectorized 
+    operation over the flat voxel indices, into the dtype chosen by the caller.
+
+    mask: the mask file, or a SimpleITK image
+    crop: if True, reconstructed images are cropped to the bounding box of the mask, and 
+        images of the bounding box dimensions are also accepted for extraction
+    """
+
+    def __init__(self, mask, crop=False):
+        if isinstance(mask, sitk.Image):
+            mask_img = mask
+        else:
+            mask_img = sitk.ReadImage(str(mask))
+        volume_indices = sitk.GetArrayFromImage(mask_img).astype(bool)
+        self.crop = crop
+
+        if crop:
+            # bounding box of the mask, in numpy (z,y,x) order
+            nonzero = np.nonzero(volume_indices)
+            lower = [int(axis.min()) if len(axis) > 0 else 0 for axis in nonzero]
+            upper = [int(axis.max())+1 if len(axis) > 0 else 1 for axis in nonzero]
+            self.bbox = tuple(slice(l, u) for l, u in zip(lower, upper))
+            # sitk regions are defined in (x,y,z) order
+            mask_img = sitk.RegionOfInterest(mask_img, size=[u-l for l, u in zip(lower, upper)][::-1], index=lower[::-1])
+            volume_indices = volume_indices[self.bbox]
+
+        self.ref_img = mask_img
+        self.volume_indices = volume_indices
+        self.shape = volume_indices.shape
+        self.flat_indices = np.flatnonzero(volume_indices)
+
+    @property
+    def num_voxels(self):
+        return len(self.flat_indices)
+
+    def extract(self, img, dtype=None):
+        # img: an image file, a SimpleITK image or a numpy array, in 3D or 4D
+        # returns a voxel vector for 3D images, or a volume by voxel array for 4D images
+        if isinstance(img, sitk.Image):
+            array = sitk.GetArrayFromImage(img)
+        elif isinstance(img, np.ndarray):
+            array = img
+        else:
+            array = sitk.GetArrayFromImage(sitk.ReadImage(str(img)))
+
+        spatial_shape = array.shape[-3:]
+        if self.crop and not spatial_shape == self.shape:
+            array = array[(Ellipsis,)+self.bbox]
+        if not array.shape[-3:] == self.shape:
+            raise ValueError(
+                f"The image dimensions {spatial_shape} don't match the mask {self.shape}.")
+
+        if array.ndim == 3:
+            vector = array.reshape(-1)[self.flat_indices]
+        else:
+            vector = array.reshape(array.shape[0], -1)[:, self.flat_indices]
+        if dtype is not None:
+            vector = vector.astype(dtype, copy=False)
+        return vector
+
+    def recover(self, vector_maps, ref_4d=None, dtype=np.float64):
+        # vector_maps: a voxel vector, returning a 3D image, or a volume by voxel array, returning a 4D image
+        # ref_4d: reference image (file or SimpleITK image) providing the metadata of the 4th dimension
+        vector_maps = np.asarray(vector_maps)
+        if vector_maps.ndim == 1:
+            volume = np.zeros(int(np.prod(self.shape)), dtype=dtype)
+            volume[self.flat_indices] = vector_maps
+            return copyInfo_3DImage(sitk.GetImageFromArray(
+                volume.reshape(self.shape), isVector=False), self.ref_img)
+
+        volumes = self.empty_volumes(vector_maps.shape[0], dtype=dtype)
+        volumes[:, self.flat_indices] = vector_maps
+        return self.image_from_volumes(volumes, ref_4d)
+
+    def empty_volumes(self, num_volumes, dtype=np.float64):
+        # volume by flattened voxel array of zeros, which can be filled by blocks of mask voxels 
+        # (i.e. volumes[:, flat_indices[block]]) before conversion to an image with image_from_volumes
+        return np.zeros([num_volumes, int(np.prod(self.shape))], dtype=dtype)
+
+    def image_from_volumes(self, volumes, ref_4d):
+        # converts a volume by flattened voxel array to a 4D image, with the metadata of the 4th dimension from ref_4d
+        if not isinstance(ref_4d, sitk.Image):
+            reader = sitk.ImageFileReader() # only the header of the reference is needed
+            reader.SetFileName(str(ref_4d))
+            reader.ReadImageInformation()
+            ref_4d = reader
+        return copyInfo_4DImage(sitk.GetImageFromArray(
+            volumes.reshape((volumes.shape[0],)+self.shape), isVector=False), self.ref_img, ref_4d)
+
+
+_masker_cache = {}
+
+
+def get_masker(mask_file, crop=False):
+    # returns a Masker re-used across calls within the process for the same mask file
+    mask_file = os.path.abspath(str(mask_file))
+    key = (mask_file, os.path.getmtime(mask_file), crop)
+    if not key in _masker_cache:
+        if len(_masker_cache) > 16:
+            _masker_cache.clear()
+        _masker_cache[key] = Masker(mask_file, crop=crop)
+    return _masker_cache[key]
+
+
 def recover_3D(mask_file, vector_map):
-    mask_img = sitk.ReadImage(mask_file)
-    brain_mask = sitk.GetArrayFromImage(mask_img)
-    volume_indices=brain_mask.astype(bool)
-    volume=np.zeros(brain_mask.shape)
-    volume[volume_indices]=vector_map
-    volume_img = copyInfo_3DImage(sitk.GetImageFromArray(
-        volume, isVector=False), mask_img)
-    return volume_img
+    return get_masker(mask_file).recover(vector_map)
 
 
 def recover_4D(mask_file, vector_maps, ref_4d):
     #vector maps of shape num_volumeXnum_voxel
-    mask_img = sitk.ReadImage(mask_file)
-    brain_mask = sitk.GetArrayFromImage(mask_img)
-    volume_indices=brain_mask.astype(bool)
-    shape=(vector_maps.shape[0],brain_mask.shape[0],brain_mask.shape[1],brain_mask.shape[2])
-    volumes=np.zeros(shape)
-    for i in range(vector_maps.shape[0]):
-        volume=volumes[i,:,:,:]
-        volume[volume_indices]=vector_maps[i,:]
-        volumes[i,:,:,:]=volume
-    volume_img = copyInfo_4DImage(sitk.GetImageFromArray(
-        volumes, isVector=False), mask_img, sitk.ReadImage(ref_4d))
-    return volume_img
+    return get_masker(mask_file).recover(vector_maps, ref_4d=ref_4d)
 
 
 def resample_image_spacing(image, output_spacing):
@@ -102,10 +191,43 @@ def copyInfo_3DImage(image_3d, ref_3d):
     return image_3d
 
 
-class slice_applyTransformsInputSpec(BaseInterfaceInputSpec):
+def otsu_thresholds(values, num_thresholds=1, num_bins=200):
+    # multi-class Otsu thresholds over an array of values, computed by SimpleITK in memory
+    values = np.asarray(values, dtype=np.float32).reshape(1, 1, -1)
+    otsu = sitk.OtsuMultipleThresholdsImageFilter()
+    otsu.SetNumberOfThresholds(int(num_thresholds))
+    otsu.SetNumberOfHistogramBins(int(num_bins))
+    otsu.Execute(sitk.GetImageFromArray(values, isVector=False))
+    return np.array(otsu.GetThresholds())
+
+
+def otsu_labels(array, num_thresholds=1, mask=None, num_bins=200):
+    '''
+    Labels each voxel of an array according to multi-class Otsu thresholding, reproducing the 
+    labels of ANTs' ThresholdImage with the Otsu option without writing temporary files. Voxels 
+    are labelled from 0 (lowest class) to num_thresholds. If a mask is provided, the thresholds 
+    are derived from the voxels within the mask, which are labelled from 1 to num_thresholds+1, 
+    and voxels outside the mask are set to 0.
+    '''
+    array = np.asarray(array)
+    if mask is None:
+        thresholds = otsu_thresholds(array, num_thresholds, num_bins=num_bins)
+        return np.searchsorted(thresholds, array, side='left')
+    mask = np.asarray(mask).astype(bool)
+    labels = np.zeros(array.shape, dtype=int)
+    if mask.sum()==0:
+        return labels
+    thresholds = otsu_thresholds(array[mask], num_thresholds, num_bins=num_bins)
+    labels[mask] = np.searchsorted(thresholds, array[mask], side='left')+1
+    return labels
+
+
+class ResampleVolumesInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="Input 4D EPI")
     ref_file = File(exists=True, mandatory=True,
                     desc="The reference 3D space to which the EPI will be warped.")
+    name_source = File(exists=True, mandatory=True,
+                         desc='a Nifti file from which the header and the output name are taken')
     transforms = traits.List(desc="List of transforms to apply to every volume.")
     inverses = traits.List(
         desc="Define whether some transforms must be inverse, with a boolean list where true defines inverse e.g.[0,1,0]")
@@ -115,75 +237,125 @@ class slice_applyTransformsInputSpec(BaseInterfaceInputSpec):
         exists=True, desc="xforms from head motion estimation .csv file")
     resampling_dim = traits.Str(
         desc="Specification for the dimension of resampling.")
+    clip_negative = traits.Bool(
+        desc="Whether to clip out negative values.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
+    n_procs = traits.Int(1, usedefault=True,
+                         desc="Number of threads used to resample volumes in parallel.")
 
 
-class slice_applyTransformsOutputSpec(TraitedSpec):
-    out_files = traits.List(
-        desc="warped images after the application of the transforms")
+class ResampleVolumesOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='the resampled 4D timeseries')
 
 
-class slice_applyTransforms(BaseInterface):
+class ResampleVolumes(BaseInterface):
     """
     This interface will apply a set of transforms to an input 4D EPI as well as motion realignment if specified.
-    Susceptibility distortion correction can be applied through the provided transforms. A list of the corrected
-    single volumes will be provided as outputs, and these volumes require to be merged to recover timeseries.
+    Susceptibility distortion correction can be applied through the provided transforms. For each volume, all 
+    transforms are combined into a single SimpleITK CompositeTransform, and volumes are resampled in memory 
+    in parallel threads, before writing the 4D timeseries once.
     """
 
-    input_spec = slice_applyTransformsInputSpec
-    output_spec = slice_applyTransformsOutputSpec
+    input_spec = ResampleVolumesInputSpec
+    output_spec = ResampleVolumesOutputSpec
 
     def _run_interface(self, runtime):
-        # resampling the reference image to the dimension of the EPI
+        from concurrent.futures import ThreadPoolExecutor
 
         img = sitk.ReadImage(self.inputs.in_file, self.inputs.rabies_data_type)
+        if not img.GetDimension() == 4:
+            raise ValueError("the input file must be of dimensions 4")
+        num_volumes = img.GetSize()[3]
 
+        # resampling the reference image to the dimension of the EPI
         if not self.inputs.resampling_dim == 'inputs_defined':
             shape = self.inputs.resampling_dim.split('x')
             spacing = (float(shape[0]), float(shape[1]), float(shape[2]))
         else:
             spacing = img.GetSpacing()[:3]
-        resampled = resample_image_spacing(sitk.ReadImage(
+        ref_img = resample_image_spacing(sitk.ReadImage(
             self.inputs.ref_file, self.inputs.rabies_data_type), spacing)
-        sitk.WriteImage(resampled, 'resampled.nii.gz')
-
-        # Splitting bold file into lists of single volumes
-        [bold_volumes, num_volumes] = split_volumes(
-            self.inputs.in_file, "bold_", self.inputs.rabies_data_type)
 
+        # the transforms shared by all volumes are read once
+        base_transform = get_composite_transform(self.inputs.transforms, self.inputs.inverses)
         if self.inputs.apply_motcorr:
-            motcorr_params = self.inputs.motcorr_params
-        ref_img = os.path.abspath('resampled.nii.gz')
-        warped_volumes = []
-
-        orig_transforms = self.inputs.transforms
-        orig_inverses = self.inputs.inverses
-        for x in range(0, num_volumes):
-            warped_vol_fname = os.path.abspath(
-                "deformed_volume" + str(x) + ".nii.gz")
-            warped_volumes.append(warped_vol_fname)
-
+            from rabies.preprocess_pkg.hmc import get_motcorr_transforms
+            motcorr_transforms = get_motcorr_transforms(self.inputs.motcorr_params, num_volumes)
+
+        # the motion realignment is the last transform listed for antsApplyTransforms (i.e. the closest to the 
+        # raw volume), thus it is applied last to the reference points, and must be added first
+        volume_transforms = []
+        for x in range(num_volumes):
+            transform = sitk.CompositeTransform(3)
             if self.inputs.apply_motcorr:
-                command = f'antsMotionCorrStats -m {motcorr_params} -o motcorr_vol{x}.mat -t {x}'
-                rc = run_command(command)
+                transform.AddTransform(motcorr_transforms[x])
+            transform.AddTransform(base_transform)
+            volume_transforms.append(transform)
+
+        # set default threader to platform to avoid freezing with MultiProc https://github.com/SimpleITK/SimpleITK/issues/1239
+        sitk.ProcessObject_SetGlobalDefaultThreader('Platform')
+        rabies_data_type = self.inputs.rabies_data_type
+        def resample_volume(x):
+            resampler = sitk.ResampleImageFilter()
+            resampler.SetReferenceImage(ref_img)
+            resampler.SetTransform(volume_transforms[x])
+            resampler.SetInterpolator(sitk.sitkBSpline5)
+            resampler.SetDefaultPixelValue(0)
+            resampler.SetOutputPixelType(rabies_data_type)
+            resampler.SetNumberOfThreads(1)
+            return sitk.GetArrayFromImage(resampler.Execute(img[:,:,:,x]))
+
+        with ThreadPoolExecutor(max_workers=self.inputs.n_procs) as executor:
+            volumes = list(executor.map(resample_volume, range(num_volumes)))
+        combined = np.stack(volumes, axis=0)
+        del volumes
 
-                transforms = orig_transforms+[f'motcorr_vol{x}.mat']
-                inverses = orig_inverses+[0]
-            else:
-                transforms = orig_transforms
-                inverses = orig_inverses
+        if self.inputs.clip_negative:
+            # clip potential negative values
+            combined[combined < 0] = 0
 
-            exec_applyTransforms(transforms, inverses, bold_volumes[x], ref_img, warped_vol_fname, mask=False)
-            # change image to specified data type
-            sitk.WriteImage(sitk.ReadImage(warped_vol_fname,
-                                           self.inputs.rabies_data_type), warped_vol_fname)
+        # set metadata and affine for the newly constructed 4D image
+        filename_split = pathlib.Path(
+            self.inputs.name_source).name.rsplit(".nii")
+        combined_file = os.path.abspath(
+            f"{filename_split[0]}_combined.nii.gz")
+        header_source = sitk.ReadImage(
+            self.inputs.name_source, self.inputs.rabies_data_type)
+        combined_image = copyInfo_4DImage(
+            sitk.GetImageFromArray(combined, isVector=False), ref_img, header_source)
+        sitk.WriteImage(combined_image, combined_file)
 
-        setattr(self, 'out_files', warped_volumes)
+        setattr(self, 'out_file', combined_file)
         return runtime
 
     def _list_outputs(self):
-        return {'out_files': getattr(self, 'out_files')}
+        return {'out_file': getattr(self, 'out_file')}
+
+
+def load_transform(transform_file, inverse=False):
+    # reads an ANTs transform file as a SimpleITK transform
+    if str(transform_file).endswith('.nii') or str(transform_file).endswith('.nii.gz'):
+        if inverse:
+            raise ValueError(
+                f"The displacement field {transform_file} can't be inverted. Provide the inverse warp instead.")
+        return sitk.DisplacementFieldTransform(sitk.ReadImage(str(transform_file), sitk.sitkVectorFloat64))
+    transform = sitk.ReadTransform(str(transform_file))
+    if inverse:
+        transform = transform.GetInverse()
+    return transform
+
+
+def get_composite_transform(transforms, inverses):
+    # tranforms is a list of transform files, set in order of call within antsApplyTransforms.
+    # antsApplyTransforms maps the points of the reference space through the first transform listed first, 
+    # whereas a CompositeTransform applies the last added transform first, so transforms are added in reverse order
+    composite = sitk.CompositeTransform(3)
+    for transform, inverse in reversed(list(zip(transforms, inverses))):
+        if transform=='NULL':
+            continue
+        composite.AddTransform(load_transform(transform, inverse=bool(inverse)))
+    return composite
 
 
 def exec_applyTransforms(transforms, inverses, input_image, ref_image, output_image, mask=False):
@@ -209,93 +381,103 @@ def exec_applyTransforms(transforms, inverses, input_image, ref_image, output_im
             "Missing output image. Transform call failed: "+command)
 
 
+class Image4D():
+    """
+    Lazy access to the volumes of a 4D image. For an image file, only the header is read at 
+    initialization, and volumes or frame ranges are read on demand by extracting the requested 
+    region with a SimpleITK ImageFileReader, so that the full 4D array is never materialized 
+    when only a subset of frames is needed. If a SimpleITK image is provided instead, numpy 
+    views over the image buffer are returned without copies.
+    A compressed file (.nii.gz) is decompressed from its start for every extracted region, so 
+    for these files, the whole image is read once when the first single volume is requested, 
+    and volumes are then served from memory. Contiguous frame ranges are still extracted directly.
+
+    img: a 4D image file or SimpleITK image
+    rabies_data_type: SimpleITK pixel type for the returned data (file inputs only)
+    """
+
+    def __init__(self, img, rabies_data_type=None):
+        if isinstance(img, sitk.Image):
+            self.image = img
+            self.size = img.GetSize()
+            self.compressed = False
+        else:
+            self.image = None
+            self.compressed = str(img).endswith('.gz')
+            self.reader = sitk.ImageFileReader()
+            self.reader.SetFileName(str(img))
+            if rabies_data_type is not None:
+                self.reader.SetOutputPixelType(rabies_data_type)
+            self.reader.ReadImageInformation()
+            self.size = self.reader.GetSize()
+        if not len(self.size) == 4:
+            raise ValueError(f"Input image {img} is not 4-dimensional.")
+        # a single frame holds all the image metadata, and serves as reference for copyInfo_3DImage/copyInfo_4DImage
+        self.ref_img = self.read_frames(0, 1)
+
+    @property
+    def num_volumes(self):
+        return self.size[3]
+
+    def read_frames(self, start, end):
+        # returns the frames from start to end (excluded) as a 4D SimpleITK image
+        end = min(end, self.num_volumes)
+        if self.image is not None:
+            return self.image[:,:,:,start:end]
+        self.reader.SetExtractIndex([0, 0, 0, start])
+        self.reader.SetExtractSize(list(self.size[:3])+[end-start])
+        return self.reader.Execute()
+
+    def get_frames_array(self, start, end):
+        # returns the frames from start to end (excluded) as a numpy array of shape time X z X y X x
+        if self.image is not None:
+            return sitk.GetArrayViewFromImage(self.image)[start:end]
+        return sitk.GetArrayFromImage(self.read_frames(start, end))
+
+    def load(self):
+        # reads the whole image once, after which all accesses are served from memory
+        if self.image is None:
+            self.reader.SetExtractIndex([0, 0, 0, 0])
+            self.reader.SetExtractSize(list(self.size))
+            self.image = self.reader.Execute()
+        return self.image
+
+    def get_volume(self, x):
+        # returns volume x as a 3D SimpleITK image
+        if self.image is None and self.compressed:
+            self.load()
+        if self.image is not None:
+            return self.image[:,:,:,x]
+        self.reader.SetExtractIndex([0, 0, 0, x])
+        self.reader.SetExtractSize(list(self.size[:3])+[0]) # a size of 0 collapses the 4th dimension
+        return self.reader.Execute()
+
+    def get_volume_array(self, x):
+        if self.image is not None:
+            return sitk.GetArrayViewFromImage(self.image)[x]
+        return sitk.GetArrayFromImage(self.get_volume(x))
+
+
 def split_volumes(in_file, output_prefix, rabies_data_type):
     '''
     Takes as input a 4D .nii file and splits it into separate time series
     volumes by splitting on the 4th dimension
     '''
-    in_nii = sitk.ReadImage(in_file, rabies_data_type)
-    num_dimensions = len(in_nii.GetSize())
-    num_volumes = in_nii.GetSize()[3]
-
-    if num_dimensions != 4:
-        raise ValueError("the input file must be of dimensions 4")
+    in_nii = Image4D(in_file, rabies_data_type)
+    num_volumes = in_nii.num_volumes
 
     volumes = []
     for x in range(0, num_volumes):
-        data_slice = sitk.GetArrayFromImage(in_nii)[x, :, :, :]
         slice_fname = os.path.abspath(
             output_prefix + "vol" + str(x) + ".nii.gz")
         image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
-            data_slice, isVector=False), in_nii)
+            in_nii.get_volume_array(x), isVector=False), in_nii.ref_img)
         sitk.WriteImage(image_3d, slice_fname)
         volumes.append(slice_fname)
 
     return [volumes, num_volumes]
 
 
-class MergeInputSpec(BaseInterfaceInputSpec):
-    in_files = InputMultiPath(File(exists=True), mandatory=True,
-                              desc='input list of files to merge, listed in the order to merge')
-    header_source = File(exists=True, mandatory=True,
-                         desc='a Nifti file from which the header should be copied')
-    clip_negative = traits.Bool(
-        desc="Whether to clip out negative values.")
-    rabies_data_type = traits.Int(mandatory=True,
-                                  desc="Integer specifying SimpleITK data type.")
-
-
-class MergeOutputSpec(TraitedSpec):
-    out_file = File(exists=True, desc='output merged file')
-
-
-class Merge(BaseInterface):
-    """
-    Takes a list of 3D Nifti files and merge them in the order listed.
-    """
-
-    input_spec = MergeInputSpec
-    output_spec = MergeOutputSpec
-
-    def _run_interface(self, runtime):
-        filename_split = pathlib.Path(
-            self.inputs.header_source).name.rsplit(".nii")
-
-        sample_volume = sitk.ReadImage(
-            self.inputs.in_files[0], self.inputs.rabies_data_type)
-        length = len(self.inputs.in_files)
-        shape = sitk.GetArrayFromImage(sample_volume).shape
-        combined = np.zeros((length, shape[0], shape[1], shape[2]))
-
-        i = 0
-        for file in self.inputs.in_files:
-            combined[i, :, :, :] = sitk.GetArrayFromImage(
-                sitk.ReadImage(file, self.inputs.rabies_data_type))[:, :, :]
-            i = i+1
-        if (i != length):
-            raise ValueError("Error occured with Merge.")
-        combined_files = os.path.abspath(
-            f"{filename_split[0]}_combined.nii.gz")
-
-        if self.inputs.clip_negative:
-            # clip potential negative values
-            combined[(combined < 0).astype(bool)] = 0
-        combined_image = sitk.GetImageFromArray(combined, isVector=False)
-
-        # set metadata and affine for the newly constructed 4D image
-        header_source = sitk.ReadImage(
-            self.inputs.header_source, self.inputs.rabies_data_type)
-        combined_image = copyInfo_4DImage(
-            combined_image, sample_volume, header_source)
-        sitk.WriteImage(combined_image, combined_files)
-
-        setattr(self, 'out_file', combined_files)
-        return runtime
-
-    def _list_outputs(self):
-        return {'out_file': getattr(self, 'out_file')}
-
-
 ######################
 #GENERAL
 ######################
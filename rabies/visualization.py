@@ -18,19 +18,20 @@ plt.rcParams.update({
     "savefig.facecolor": "black",
     "savefig.edgecolor": "black"})
 
-from rabies.utils import run_command
 
 
 def otsu_scaling(image_file):
-    img = sitk.ReadImage(image_file)
+    # image_file can be a file or a SimpleITK image
+    from rabies.utils import otsu_labels
+    if isinstance(image_file, sitk.Image):
+        img = image_file
+    else:
+        img = sitk.ReadImage(image_file)
     array = sitk.GetArrayFromImage(img)
 
     # select a smart vmax for the image display to enhance contrast
-    command = f'ThresholdImage 3 {image_file} otsu_weight.nii.gz Otsu 4'
-    rc = run_command(command)
-
     # clip off the background
-    mask = sitk.GetArrayFromImage(sitk.ReadImage('otsu_weight.nii.gz'))
+    mask = otsu_labels(array, num_thresholds=4)
     voxel_subset=array[mask>1.0]
 
     # select a maximal value which encompasses 90% of the voxels in the mask
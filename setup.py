@@ -26,7 +26,7 @@ REQUIRED = [
     'nibabel>=2.3.1',
     'nilearn>=0.4.2',
     'nipype>=1.1.4',
-    'numpy>=1.16.2',
+    'numpy>=1.17',
     'pandas',
     'pybids',
     'scikit-learn>=0.20.0',
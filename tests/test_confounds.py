@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from rabies.preprocess_pkg.confounds import mask_physical_points, motion_displacement, compute_motion_displacement
+from tests.test_transforms import write_motcorr_params
+
+
+def rotation_displacement(points, angle, center):
+    # distance travelled by points rotated by angle around the z axis going through center
+    radius = np.sqrt(((points[:, :2]-np.array(center)[:2])**2).sum(axis=1))
+    return 2*np.sin(angle/2)*radius
+
+
+def test_motion_displacement_rotation_about_center():
+    points = np.array([[0.0, 0.0, 0.0], [1.0, 2.0, 3.0], [-2.0, 0.5, 1.0], [4.0, -3.0, -2.0]])
+    center = (1.0, -1.0, 2.0)
+    angle = 0.2
+    translation = sitk.Euler3DTransform()
+    translation.SetTranslation((0.0, 0.3, -0.4))
+    rotation = sitk.Euler3DTransform(center, 0.0, 0.0, angle, (0.0, 0.0, 0.0))
+    pos, FD = motion_displacement([sitk.Euler3DTransform(), translation, rotation], points)
+
+    assert np.allclose(pos[0], 0) and np.allclose(FD[0], 0)
+    assert np.allclose(pos[1], 0.5) and np.allclose(FD[1], 0.5)
+    assert np.allclose(pos[2], rotation_displacement(points, angle, center), atol=1e-6)
+    # the points at the center of rotation are not displaced
+    assert np.allclose(motion_displacement([rotation], np.array([center]))[0], 0, atol=1e-6)
+    expected_FD = np.sqrt(((np.array([rotation.TransformPoint(p) for p in points])
+                            - np.array([translation.TransformPoint(p) for p in points]))**2).sum(axis=1))
+    assert np.allclose(FD[2], expected_FD, atol=1e-6)
+
+
+def make_raw_epi(tmp_path, num_volumes):
+    # the raw EPI and its brain mask share an oblique 3D geometry, away from the origin
+    shape = (6, 7, 8)
+    spacing = (0.3, 0.4, 0.5)
+    origin = (1.0, -2.0, 3.0)
+    direction = np.array(sitk.VersorTransform((0.2, 0.3, 0.9), 0.4).GetMatrix()).reshape(3, 3)
+
+    mask_array = np.zeros(shape, dtype=np.uint8)
+    mask_array[1:5, 2:6, 1:7] = 1
+    mask_img = sitk.GetImageFromArray(mask_array)
+    mask_img.SetSpacing(spacing)
+    mask_img.SetOrigin(origin)
+    mask_img.SetDirection(direction.flatten().tolist())
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    sitk.WriteImage(mask_img, mask_file)
+
+    bold_img = sitk.GetImageFromArray(np.zeros((num_volumes,)+shape, dtype=np.float32), isVector=False)
+    bold_img.SetSpacing(spacing+(1.5,))
+    bold_img.SetOrigin(origin+(0.0,))
+    direction_4d = np.eye(4)
+    direction_4d[:3, :3] = direction
+    bold_img.SetDirection(direction_4d.flatten().tolist())
+    bold_file = str(tmp_path / 'bold.nii.gz')
+    sitk.WriteImage(bold_img, bold_file)
+    return mask_file, bold_file
+
+
+def test_compute_motion_displacement(tmp_path):
+    # the motion parameters define rigid transforms centered at the origin
+    angle = 0.05
+    params = np.array([[0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                       [0.0, 0.0, 0.0, 0.1, 0.0, 0.0],
+                       [0.0, 0.0, angle, 0.1, 0.0, 0.0],
+                       [0.0, 0.0, angle, 0.1, 0.0, 0.0]])
+    motcorr_params = str(tmp_path / 'motcorr.csv')
+    write_motcorr_params(motcorr_params, params)
+    mask_file, bold_file = make_raw_epi(tmp_path, num_volumes=params.shape[0])
+
+    FD_csv, FD_file, pos_file = compute_motion_displacement(motcorr_params, mask_file, bold_file,
+                                                            filename_template=str(tmp_path / 'sub'))
+
+    mask_img = sitk.ReadImage(mask_file)
+    mask_array = sitk.GetArrayFromImage(mask_img) != 0
+    indices = np.argwhere(mask_array)[:, ::-1]
+    points = np.array([mask_img.TransformIndexToPhysicalPoint([int(i) for i in index]) for index in indices])
+    assert np.allclose(mask_physical_points(mask_array, mask_img), points)
+
+    # rotation around the z axis through the origin, following the translation
+    rotation = rotation_displacement(points, angle, (0.0, 0.0, 0.0))
+    rotated = np.array([sitk.Euler3DTransform((0.0, 0.0, 0.0), 0.0, 0.0, angle, (0.1, 0.0, 0.0)).TransformPoint(p)
+                        for p in points])
+    expected_pos = np.stack([np.zeros(len(points)), np.full(len(points), 0.1),
+                             np.sqrt(((rotated-points)**2).sum(axis=1)), np.sqrt(((rotated-points)**2).sum(axis=1))])
+    expected_FD = np.stack([np.zeros(len(points)), np.full(len(points), 0.1), rotation, np.zeros(len(points))])
+
+    bold_img = sitk.ReadImage(bold_file)
+    for out_file, expected in zip([FD_file, pos_file], [expected_FD, expected_pos]):
+        out_img = sitk.ReadImage(out_file)
+        # the voxelwise maps keep the geometry of the raw EPI, including the TR
+        assert out_img.GetSize() == bold_img.GetSize()
+        assert np.allclose(out_img.GetSpacing(), bold_img.GetSpacing())
+        assert np.allclose(out_img.GetOrigin(), bold_img.GetOrigin())
+        assert np.allclose(out_img.GetDirection(), bold_img.GetDirection(), atol=1e-6)
+        out_array = sitk.GetArrayFromImage(out_img)
+        assert np.allclose(out_array[:, mask_array], expected, atol=1e-5)
+        assert (out_array[:, ~mask_array] == 0).all()
+
+    df = pd.read_csv(FD_csv)
+    assert df.columns.tolist() == ['Mean', 'Max']
+    assert np.allclose(df['Mean'], expected_FD.mean(axis=1), atol=1e-6)
+    assert np.allclose(df['Max'], expected_FD.max(axis=1), atol=1e-6)
@@ -0,0 +1,21 @@
+import numpy as np
+
+from rabies.confound_correction_pkg.mod_ICA_AROMA.ICA_AROMA_functions import spatial_feature_scores
+
+
+def test_spatial_feature_scores_all_csf():
+    # float32 maps with many voxels, where a float32 matrix product and a float64 sum do not match exactly
+    rng = np.random.default_rng(0)
+    num_voxels = 20000
+    csf = rng.random(num_voxels) < 0.2
+    edge = (rng.random(num_voxels) < 0.2) & ~csf
+    out = (rng.random(num_voxels) < 0.1) & ~csf & ~edge
+    masks = np.stack([csf, edge, out]).astype(np.float32)
+
+    IC_array = np.abs(rng.standard_normal((num_voxels, 2))).astype(np.float32)*10
+    IC_array[~csf, 1] = 0  # the second component lies entirely within the CSF
+    edgeFract, csfFract = spatial_feature_scores(IC_array, masks)
+
+    assert edgeFract[1] == 1 and csfFract[1] == 1
+    assert np.isclose(csfFract[0], IC_array[csf, 0].sum(dtype=np.float64)/IC_array[:, 0].sum(dtype=np.float64))
+    assert np.isclose(edgeFract[0], IC_array[edge | out, 0].sum(dtype=np.float64)/IC_array[~csf, 0].sum(dtype=np.float64))
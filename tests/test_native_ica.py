@@ -0,0 +1,39 @@
+import numpy as np
+
+from rabies.analysis_pkg.analysis_math import MIGP
+from rabies.confound_correction_pkg.mod_ICA_AROMA.native_ICA_AROMA import noise_spectrum, estimate_dimensionality
+
+
+def test_noise_spectrum():
+    # the expected spectrum matches the eigenvalues of Gaussian noise, with fewer or more dimensions than samples
+    rng = np.random.default_rng(0)
+    num_samples = 1000
+    for num_dims in [300, 3000]:
+        X = rng.standard_normal((num_dims, num_samples))
+        eigenvalues = np.sort(np.linalg.eigvalsh(X.dot(X.T)/num_samples))[::-1][:min(num_dims, num_samples)]
+        spectrum = noise_spectrum(num_dims, num_samples)
+        assert len(spectrum) == len(eigenvalues)
+        assert np.allclose(spectrum[:-10], eigenvalues[:-10], rtol=0.05, atol=0.02)
+
+
+def test_group_dimensionality_stable_with_number_of_scans():
+    # the estimate from the MIGP reduction must not depend on whether the total number of
+    # timepoints exceeds the number of voxels
+    rng = np.random.default_rng(0)
+    num_voxels, num_sources, num_timepoints = 3000, 8, 100
+    maps = np.zeros((num_sources, num_voxels))
+    for i in range(num_sources):
+        voxels = rng.choice(num_voxels, 300, replace=False)
+        maps[i, voxels] = rng.standard_normal(300)*3
+
+    for num_scans in [5, 40]:
+        migp = MIGP(num_components=200)
+        for scan in range(num_scans):
+            timeseries = rng.laplace(size=(num_timepoints, num_sources)).dot(maps) \
+                + rng.standard_normal((num_timepoints, num_voxels))
+            migp.update(timeseries.astype(np.float32))
+        if migp.reduced.shape[0] > migp.num_components:
+            migp.reduce()
+        reduced = migp.reduced.astype(np.float64)
+        eigenvalues = np.linalg.eigvalsh(reduced.dot(reduced.T)/num_voxels)
+        assert estimate_dimensionality(eigenvalues, num_voxels, num_observations=migp.num_observations) == num_sources
@@ -0,0 +1,21 @@
+import sys
+
+from rabies.parser import get_parser, read_parser
+
+
+def parse(monkeypatch, args):
+    monkeypatch.setattr(sys, 'argv', ['rabies']+args)
+    return read_parser(get_parser())
+
+
+def test_ica_aroma_backend_default(monkeypatch):
+    # the backend can be omitted, as in commands written before the option was added
+    opts = parse(monkeypatch, ['confound_correction', 'in', 'out', '--ica_aroma', 'apply=true,dim=0,random_seed=1'])
+    assert opts.ica_aroma == {'apply': True, 'dim': 0, 'random_seed': 1, 'backend': 'melodic'}
+    opts = parse(monkeypatch, ['confound_correction', 'in', 'out', '--ica_aroma', 'apply=true,dim=0,random_seed=1,backend=native'])
+    assert opts.ica_aroma['backend'] == 'native'
+
+
+def test_group_ica_backend_default(monkeypatch):
+    opts = parse(monkeypatch, ['analysis', 'in', 'out', '--group_ica', 'apply=true,dim=0,random_seed=1'])
+    assert opts.group_ica == {'apply': True, 'dim': 0, 'random_seed': 1, 'backend': 'melodic'}
@@ -0,0 +1,133 @@
+import shutil
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from scipy import ndimage
+
+from rabies.utils import get_composite_transform, exec_applyTransforms, ResampleVolumes
+from rabies.preprocess_pkg.hmc import get_motcorr_transforms, write_motcorr_transforms
+
+
+def affine_matrix(transform):
+    # homogeneous 4x4 matrix of a linear transform, which maps x to A(x-c)+t+c
+    A = np.array(transform.GetMatrix()).reshape(3, 3)
+    center = np.array(transform.GetCenter())
+    M = np.eye(4)
+    M[:3, :3] = A
+    M[:3, 3] = np.array(transform.GetTranslation()) + center - A.dot(center)
+    return M
+
+
+def to_affine(M):
+    transform = sitk.AffineTransform(3)
+    transform.SetMatrix(M[:3, :3].flatten().tolist())
+    transform.SetTranslation(M[:3, 3].tolist())
+    return transform
+
+
+def make_transforms(tmp_path):
+    # a non-commuting pair of affine transforms, in the order of call within antsApplyTransforms
+    shear = sitk.AffineTransform(3)
+    shear.SetMatrix((1.0, 0.3, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+    shear.SetTranslation((1.5, 0.0, -0.5))
+    rotation = sitk.Euler3DTransform((0.0, 0.0, 0.0), 0.0, 0.0, 0.4, (0.0, 1.0, 0.0))
+    transform_files = []
+    for i, transform in enumerate([shear, to_affine(affine_matrix(rotation))]):
+        transform_file = str(tmp_path / f'transform{i}.mat')
+        sitk.WriteTransform(transform, transform_file)
+        transform_files.append(transform_file)
+    return transform_files, [shear, rotation]
+
+
+def make_image(shape=(12, 14, 16), num_volumes=None, seed=0):
+    rng = np.random.default_rng(seed)
+    if num_volumes is None:
+        array = ndimage.gaussian_filter(rng.standard_normal(shape), 2).astype(np.float32)
+        image = sitk.GetImageFromArray(array)
+        image.SetOrigin((-8.0, -7.0, -6.0))
+    else:
+        array = ndimage.gaussian_filter(rng.standard_normal((num_volumes,)+shape), (0, 2, 2, 2)).astype(np.float32)
+        image = sitk.GetImageFromArray(array, isVector=False)
+        image.SetOrigin((-8.0, -7.0, -6.0, 0.0))
+    return image
+
+
+def test_composite_transform_order(tmp_path):
+    # antsApplyTransforms maps the reference points through the first listed transform first
+    transform_files, transforms = make_transforms(tmp_path)
+    composite = get_composite_transform(transform_files, [0, 0])
+    expected = affine_matrix(transforms[1]).dot(affine_matrix(transforms[0]))
+    for point in [(1.0, 0.0, 0.0), (0.0, 2.0, -1.0), (3.0, -1.0, 2.0)]:
+        assert np.allclose(composite.TransformPoint(point), expected.dot(list(point)+[1])[:3])
+
+    # inverted transforms are inverted before composition
+    composite = get_composite_transform(transform_files, [1, 0])
+    expected = affine_matrix(transforms[1]).dot(np.linalg.inv(affine_matrix(transforms[0])))
+    assert np.allclose(composite.TransformPoint((1.0, 2.0, 3.0)), expected.dot([1, 2, 3, 1])[:3])
+
+    # NULL entries are skipped
+    composite = get_composite_transform(['NULL']+transform_files, [0, 0, 0])
+    assert np.allclose(composite.TransformPoint((1.0, 2.0, 3.0)),
+                       affine_matrix(transforms[1]).dot(affine_matrix(transforms[0])).dot([1, 2, 3, 1])[:3])
+
+
+def write_motcorr_params(filename, params):
+    with open(filename, 'w') as f:
+        f.write('MetricPre,MetricPost,'+','.join(f'MOCOparam{i}' for i in range(params.shape[1]))+'\n')
+        for volume_params in params:
+            f.write(','.join(str(value) for value in [0, 0]+list(volume_params))+'\n')
+
+
+def test_resample_volumes_order(tmp_path, monkeypatch):
+    # each volume is resampled through the base transforms and then through its motion realignment
+    monkeypatch.chdir(tmp_path)
+    transform_files, transforms = make_transforms(tmp_path)
+    num_volumes = 3
+    img = make_image(num_volumes=num_volumes)
+    in_file = str(tmp_path / 'bold.nii.gz')
+    sitk.WriteImage(img, in_file)
+    ref_file = str(tmp_path / 'ref.nii.gz')
+    sitk.WriteImage(img[:,:,:,0], ref_file)
+
+    params = np.array([[0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+                       [0.05, -0.02, 0.1, 0.5, -0.3, 0.2],
+                       [-0.1, 0.03, 0.02, -0.4, 0.6, 0.0]])
+    motcorr_params = str(tmp_path / 'motcorr.csv')
+    write_motcorr_params(motcorr_params, params)
+
+    resample = ResampleVolumes(in_file=in_file, ref_file=ref_file, name_source=in_file,
+                               transforms=transform_files, inverses=[0, 0], apply_motcorr=True,
+                               motcorr_params=motcorr_params, resampling_dim='inputs_defined',
+                               clip_negative=False, rabies_data_type=sitk.sitkFloat32)
+    out_array = sitk.GetArrayFromImage(sitk.ReadImage(resample.run().outputs.out_file))
+
+    ref_img = sitk.ReadImage(ref_file)
+    base = affine_matrix(transforms[1]).dot(affine_matrix(transforms[0]))
+    for x, motcorr in enumerate(get_motcorr_transforms(motcorr_params)):
+        # single affine of the whole chain, where the motion realignment is applied last to the reference points
+        transform = to_affine(affine_matrix(motcorr).dot(base))
+        expected = sitk.Resample(img[:,:,:,x], ref_img, transform, sitk.sitkBSpline5, 0.0, sitk.sitkFloat32)
+        assert np.allclose(out_array[x], sitk.GetArrayFromImage(expected), atol=1e-4)
+
+
+@pytest.mark.skipif(shutil.which('antsApplyTransforms') is None, reason='ANTs is not installed.')
+def test_composite_transform_matches_antsApplyTransforms(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    transform_files, transforms = make_transforms(tmp_path)
+    img = make_image()
+    in_file = str(tmp_path / 'img.nii.gz')
+    sitk.WriteImage(img, in_file)
+
+    params = np.array([[0.05, -0.02, 0.1, 0.5, -0.3, 0.2]])
+    motcorr_params = str(tmp_path / 'motcorr.csv')
+    write_motcorr_params(motcorr_params, params)
+    motcorr_files = write_motcorr_transforms(motcorr_params, out_prefix=str(tmp_path / 'motcorr_vol'))
+
+    for transform_list, inverses in [(transform_files, [0, 0]), (transform_files, [1, 0]),
+                                     (transform_files+motcorr_files, [0, 0, 0])]:
+        out_file = str(tmp_path / 'ants_out.nii.gz')
+        exec_applyTransforms(transform_list, inverses, in_file, in_file, out_file)
+        composite = get_composite_transform(transform_list, inverses)
+        expected = sitk.GetArrayFromImage(sitk.ReadImage(out_file, sitk.sitkFloat32))
+        resampled = sitk.Resample(img, img, composite, sitk.sitkBSpline5, 0.0, sitk.sitkFloat32)
+        assert np.allclose(sitk.GetArrayFromImage(resampled), expected, atol=1e-3*np.abs(expected).max())